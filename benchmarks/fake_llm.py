@@ -0,0 +1,179 @@
+import json
+import time
+import uuid
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+TOOL_NAME = 'knowledge_base_retriever'
+
+def _message_text(message) -> str:
+    content = message.get('content') or ''
+    if isinstance(content, list):
+        return "".join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content
+
+class FakeLLMServer:
+    """
+    Локальная замена LLM для бенчмарков: OpenAI-совместимый сервер `/v1/chat/completions`.
+
+    Ответы детерминированы. На первый ход агента сервер вызывает инструмент
+    `knowledge_base_retriever` с текстом вопроса (в формате nous: `<tool_call>...</tool_call>`,
+    либо нативным `tool_calls`, если в запросе переданы `tools`), а после результата
+    инструмента отвечает фиксированным числом слов. Задержка первого токена и задержка
+    между токенами настраиваются, поддерживается потоковый режим (SSE).
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, first_token_delay_ms=50.0, token_delay_ms=2.0, answer_words=60):
+        self.first_token_delay = first_token_delay_ms / 1000
+        self.token_delay = token_delay_ms / 1000
+        self.answer_words = answer_words
+        self.requests = 0
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-llm", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reply(self, body: dict) -> dict:
+        """Возвращает `{'content': ...}` или `{'tool_call': {...}}` для запроса chat/completions."""
+        messages = body.get('messages') or []
+        has_tool_result = any(
+            message.get('role') in ('tool', 'function') or '<tool_response>' in _message_text(message)
+            for message in messages
+        )
+        question = next(
+            (_message_text(m) for m in reversed(messages)
+             if m.get('role') == 'user' and '<tool_response>' not in _message_text(m)),
+            ''
+        )
+        if not has_tool_result:
+            arguments = {'query': question.strip()[:500]}
+            if body.get('tools'):
+                return {'tool_call': {'name': TOOL_NAME, 'arguments': json.dumps(arguments, ensure_ascii=False)}}
+            call = json.dumps({'name': TOOL_NAME, 'arguments': arguments}, ensure_ascii=False)
+            return {'content': f"<tool_call>\n{call}\n</tool_call>"}
+        words = " ".join(f"слово{i}" for i in range(self.answer_words))
+        return {'content': f"Согласно найденным документам: {words}."}
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _send_json(self, status, payload):
+                data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip('/').endswith('/models'):
+                    self._send_json(200, {'object': 'list', 'data': [{'id': 'fake-llm', 'object': 'model'}]})
+                else:
+                    self._send_json(404, {'error': {'message': 'not found'}})
+
+            def do_POST(self):
+                if not self.path.rstrip('/').endswith('/chat/completions'):
+                    self._send_json(404, {'error': {'message': 'not found'}})
+                    return
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length) or b'{}')
+                with server._lock:
+                    server.requests += 1
+                reply = server.reply(body)
+                time.sleep(server.first_token_delay)
+                completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+                model = body.get('model', 'fake-llm')
+                if body.get('stream'):
+                    self._stream(completion_id, model, reply)
+                else:
+                    self._complete(completion_id, model, reply)
+
+            def _complete(self, completion_id, model, reply):
+                message = {'role': 'assistant', 'content': reply.get('content')}
+                finish_reason = 'stop'
+                if 'tool_call' in reply:
+                    message['tool_calls'] = [{'id': 'call_0', 'type': 'function', 'function': reply['tool_call']}]
+                    finish_reason = 'tool_calls'
+                elif server.token_delay:
+                    time.sleep(server.token_delay * len(reply['content'].split()))
+                self._send_json(200, {
+                    'id': completion_id, 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+                    'usage': {'prompt_tokens': 0, 'completion_tokens': len((reply.get('content') or '').split()),
+                              'total_tokens': 0},
+                })
+
+            def _stream(self, completion_id, model, reply):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+
+                def send(delta, finish_reason=None):
+                    chunk = {
+                        'id': completion_id, 'object': 'chat.completion.chunk', 'created': int(time.time()),
+                        'model': model, 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}],
+                    }
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    self.wfile.flush()
+
+                if 'tool_call' in reply:
+                    send({'role': 'assistant', 'tool_calls': [
+                        {'index': 0, 'id': 'call_0', 'type': 'function', 'function': reply['tool_call']}
+                    ]})
+                    send({}, 'tool_calls')
+                else:
+                    tokens = reply['content'].split(' ')
+                    for i, token in enumerate(tokens):
+                        if i and server.token_delay:
+                            time.sleep(server.token_delay)
+                        send({'role': 'assistant', 'content': token if i == 0 else f" {token}"})
+                    send({}, 'stop')
+                self.wfile.write(b"data: [DONE]\n\n")
+                self.wfile.flush()
+                self.close_connection = True
+
+        return Handler
+
+def main(argv=None):
+    """Запуск отдельно: `python -m benchmarks.fake_llm --port 8089 --first-token-delay-ms 300`."""
+    parser = argparse.ArgumentParser(description="OpenAI-совместимая замена LLM для бенчмарков.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--first-token-delay-ms', type=float, default=50.0)
+    parser.add_argument('--token-delay-ms', type=float, default=2.0)
+    parser.add_argument('--answer-words', type=int, default=60)
+    args = parser.parse_args(argv)
+    server = FakeLLMServer(args.host, args.port, args.first_token_delay_ms, args.token_delay_ms, args.answer_words)
+    print(f"Фейковый LLM-сервер: {server.url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,323 @@
+import os
+import json
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from src.config import (
+    DOCS_DIR, VECTOR_STORE_BACKEND, K_RETRIEVED_CHUNKS, CHUNK_SIZE, CHUNK_OVERLAP, QUERY_EMBEDDING_CACHE_SIZE,
+    RERANK_CANDIDATES,
+)
+from src.embedder import QueryEmbedder
+from src.ingestion import sync_collection
+from src.lexical_index import LexicalIndex
+from src.vector_store import get_vector_store, search_in_store, search_chunks, hybrid_search
+from benchmarks.stats import summarize_latencies, format_table
+from benchmarks.synthetic_embedder import SyntheticEmbedder
+
+logger = logging.getLogger("benchmarks")
+
+QUESTIONS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'questions.json')
+SCENARIOS = ('ingest', 'search', 'retriever', 'recall', 'api')
+
+def load_questions(path=QUESTIONS_PATH) -> list[dict]:
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+def _normalize(text: str) -> str:
+    return " ".join(text.lower().replace('ё', 'е').split())
+
+def is_relevant(hit: dict, question: dict) -> bool:
+    """Чанк релевантен, если он из ожидаемого документа и содержит все ожидаемые фрагменты текста."""
+    sources = question.get('expected_sources') or []
+    if sources and (hit.get('metadata') or {}).get('source') not in sources:
+        return False
+    document = _normalize(hit.get('document') or '')
+    return all(_normalize(term) in document for term in question.get('expected_terms') or [])
+
+def make_embedder(kind: str, delay_ms: float):
+    if kind == 'real':
+        from src.data_processor import initialize_embedding_model
+        return initialize_embedding_model()
+    return SyntheticEmbedder(delay_ms_per_text=delay_ms)
+
+class Workspace:
+    """Временное хранилище векторов, индекс BM25 и служебные файлы одного запуска бенчмарка."""
+
+    def __init__(self, hybrid=True, reranker=None, backend='chroma', quantization=None):
+        self.path = tempfile.mkdtemp(prefix="svo-rag-bench-")
+        self.collection = get_vector_store(backend, os.path.join(self.path, backend), quantization=quantization)
+        self.lexical_index = LexicalIndex(os.path.join(self.path, 'lexical_index.json')) if hybrid else None
+        self.reranker = reranker
+
+    def sync(self, model, docs_dir) -> dict:
+        return sync_collection(
+            self.collection, model, docs_dir,
+            manifest_path=os.path.join(self.path, 'ingest_manifest.json'),
+            lexical_index=self.lexical_index,
+            version_path=os.path.join(self.path, 'kb_version'),
+        )
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+def bench_ingest(workspace, model, docs_dir) -> dict:
+    started = time.perf_counter()
+    stats = workspace.sync(model, docs_dir)
+    elapsed = time.perf_counter() - started
+    started = time.perf_counter()
+    workspace.sync(model, docs_dir)
+    resync = time.perf_counter() - started
+    return {
+        'files': stats['added_files'],
+        'chunks': stats['added_chunks'],
+        'seconds': elapsed,
+        'chunks_per_second': stats['added_chunks'] / elapsed if elapsed > 0 else 0.0,
+        'resync_unchanged_seconds': resync,
+        'chunk_size': CHUNK_SIZE,
+        'chunk_overlap': CHUNK_OVERLAP,
+    }
+
+def run_concurrent(func, payloads, concurrency) -> dict:
+    """Выполняет `func(payload)` для всех `payloads` в `concurrency` потоках и сводит задержки."""
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(payload):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            func(payload)
+        except Exception as e:
+            logger.error(f"Ошибка запроса в бенчмарке: {e}")
+            with lock:
+                errors += 1
+            return
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(timed, payloads))
+    summary = summarize_latencies(latencies, time.perf_counter() - started)
+    summary.update(concurrency=concurrency, errors=errors)
+    return summary
+
+def _cycle(questions, count) -> list[str]:
+    return [questions[i % len(questions)]['question'] for i in range(count)]
+
+def bench_search(workspace, query_embedder, questions, args) -> dict:
+    def search(query):
+        return search_in_store(query, query_embedder, workspace.collection, k=args.k,
+                               lexical_index=workspace.lexical_index)
+    return run_concurrent(search, _cycle(questions, args.requests), args.concurrency)
+
+def bench_retriever(workspace, query_embedder, questions, args) -> dict:
+    from src.agent_config import KnowledgeBaseRetriever
+    retriever = KnowledgeBaseRetriever(query_embedder, workspace.collection, lexical_index=workspace.lexical_index,
+                                       reranker=workspace.reranker)
+
+    context_lengths = []
+
+    def call(query):
+        context_lengths.append(len(retriever.call(json.dumps({'query': query}, ensure_ascii=False))))
+    summary = run_concurrent(call, _cycle(questions, args.requests), args.concurrency)
+    summary['k'] = K_RETRIEVED_CHUNKS
+    summary['mean_context_chars'] = sum(context_lengths) / len(context_lengths) if context_lengths else 0.0
+    return summary
+
+def bench_recall(workspace, query_embedder, questions, args) -> dict:
+    cutoffs = sorted({1, 3, 5, args.k})
+    found_at = []
+    returned = []
+    candidates = RERANK_CANDIDATES if workspace.reranker is not None else max(cutoffs)
+    for question in questions:
+        if workspace.lexical_index is not None:
+            hits = hybrid_search(question['question'], query_embedder, workspace.collection, workspace.lexical_index,
+                                 k=candidates)
+        else:
+            hits = search_chunks(question['question'], query_embedder, workspace.collection, k=candidates)
+        if workspace.reranker is not None:
+            hits = workspace.reranker.rerank(question['question'], hits)
+        returned.append(len(hits))
+        rank = next((i for i, hit in enumerate(hits, start=1) if is_relevant(hit, question)), None)
+        found_at.append(rank)
+        if rank is None:
+            logger.info(f"Не найден релевантный чанк: {question['question']}")
+    result = {'questions': len(questions)}
+    for cutoff in cutoffs:
+        result[f'recall@{cutoff}'] = sum(1 for rank in found_at if rank and rank <= cutoff) / len(questions)
+    result['mrr'] = sum(1 / rank for rank in found_at if rank) / len(questions)
+    if workspace.reranker is not None:
+        # При переранжировании k адаптивный: важна и точность, и средний размер выдачи
+        result['mean_chunks'] = sum(returned) / len(returned)
+    return result
+
+def bench_api(workspace, query_embedder, questions, args) -> dict:
+    import httpx
+    from src import server
+    from src.agent_config import KnowledgeBaseRetriever, InstrumentedAssistant, get_system_instruction
+    from src.agent_executor import AgentExecutor
+    from src.history_manager import HistoryStore, set_history_store
+    from benchmarks.fake_llm import FakeLLMServer
+
+    llm_server = FakeLLMServer(first_token_delay_ms=args.first_token_delay_ms, token_delay_ms=args.token_delay_ms,
+                               answer_words=args.answer_words).start()
+    history_store = HistoryStore(db_path=os.path.join(workspace.path, 'history.db'))
+    history_store.init_db()
+    set_history_store(history_store)
+
+    llm_cfg = {
+        'model': 'fake-llm',
+        'model_server': llm_server.url,
+        'api_key': 'EMPTY',
+        'generate_cfg': {'thought_in_content': False, 'fncall_prompt_type': 'nous'},
+    }
+    retriever = KnowledgeBaseRetriever(query_embedder, workspace.collection, cfg=llm_cfg,
+                                       lexical_index=workspace.lexical_index)
+    # Состояние сервера заполняется напрямую: обработчик startup не запускается
+    server.app_state.update({
+        'bot': InstrumentedAssistant(llm=llm_cfg, system_message=get_system_instruction(), function_list=[retriever]),
+        'agent_executor': AgentExecutor(),
+        'history_store': history_store,
+        'answer_cache': None,
+        'ready': True,
+        'phase': 'ready',
+    })
+
+    per_session = max(1, args.requests // args.sessions)
+    latencies = []
+    statuses = {}
+
+    async def session(client, session_index):
+        for i in range(per_session):
+            query = questions[(session_index + i) % len(questions)]['question']
+            started = time.perf_counter()
+            response = await client.post('/api/v1/ask', json={'query': query, 'session_id': f"bench-{session_index}"},
+                                         timeout=None)
+            elapsed = time.perf_counter() - started
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            if response.status_code == 200:
+                latencies.append(elapsed)
+
+    async def drive():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            started = time.perf_counter()
+            await asyncio.gather(*(session(client, s) for s in range(args.sessions)))
+            return time.perf_counter() - started
+
+    try:
+        wall = asyncio.run(drive())
+    finally:
+        server.app_state['agent_executor'].shutdown()
+        history_store.close()
+        llm_server.stop()
+
+    summary = summarize_latencies(latencies, wall)
+    summary.update(sessions=args.sessions, statuses={str(code): count for code, count in sorted(statuses.items())},
+                   llm_requests=llm_server.requests, first_token_delay_ms=args.first_token_delay_ms)
+    return summary
+
+def parse_args(argv=None):
+    """
+    Бенчмарк поиска, инструмента агента и API с локальной заменой LLM.
+
+    Примеры:
+        python -m benchmarks.run all
+        python -m benchmarks.run search --concurrency 16 --requests 500 --k 5
+        python -m benchmarks.run api --sessions 8 --requests 200 --first-token-delay-ms 300
+        python -m benchmarks.run recall --embedder real --json results.json
+        python -m benchmarks.run recall retriever --embedder real --rerank
+        python -m benchmarks.run search recall --vector-store local --quantization int8
+
+    Каждый запуск загружает документы из `--docs-dir` во временное хранилище векторов (`--vector-store`)
+    (замеряется скорость загрузки), после чего выполняются выбранные сценарии:
+
+    - `ingest`    — скорость загрузки (чанков в секунду) и время повторной синхронизации без изменений;
+    - `search`    — задержка и пропускная способность `search_in_store` при `--concurrency` потоках;
+    - `retriever` — то же для `KnowledgeBaseRetriever.call` (требуется qwen_agent);
+    - `recall`    — recall@k и MRR на размеченном наборе вопросов (`benchmarks/questions.json`);
+    - `api`       — задержка `/api/v1/ask` при `--sessions` одновременных сессиях с фейковым LLM
+                    (требуются fastapi, httpx и qwen_agent).
+
+    По умолчанию используется синтетическая эмбеддинг-модель (`--embedder synthetic`),
+    чтобы сравнивать изменения кода поиска без загрузки весов; `--embedder real` берет
+    модель из конфигурации. Настройки нарезки (`CHUNK_SIZE`, `CHUNK_OVERLAP`) берутся из `src/config.py`.
+    """
+    parser = argparse.ArgumentParser(description="Бенчмарк поиска и агента SVO RAG AI.")
+    parser.add_argument('scenarios', nargs='*', default=['all'], choices=SCENARIOS + ('all',),
+                        help="сценарии для запуска (по умолчанию все)")
+    parser.add_argument('--docs-dir', default=DOCS_DIR)
+    parser.add_argument('--questions', default=QUESTIONS_PATH, help="размеченный набор вопросов")
+    parser.add_argument('--embedder', choices=('synthetic', 'real'), default='synthetic')
+    parser.add_argument('--embed-delay-ms', type=float, default=0.0,
+                        help="задержка синтетической модели на один текст (имитация настоящей модели)")
+    parser.add_argument('--no-hybrid', action='store_true', help="только векторный поиск, без BM25")
+    parser.add_argument('--vector-store', choices=('chroma', 'local'), default=VECTOR_STORE_BACKEND,
+                        help="бэкенд хранилища векторов")
+    parser.add_argument('--quantization', choices=('int8',), default=None,
+                        help="квантование матрицы локального хранилища")
+    parser.add_argument('--rerank', action='store_true',
+                        help="переранжирование кандидатов кросс-энкодером из конфигурации (сценарии retriever и recall)")
+    parser.add_argument('--query-cache', action='store_true',
+                        help="включить LRU-кэш эмбеддингов запросов (по умолчанию каждый запрос кодируется)")
+    parser.add_argument('--k', type=int, default=K_RETRIEVED_CHUNKS, help="количество извлекаемых чанков")
+    parser.add_argument('--concurrency', type=int, default=8, help="потоков в сценариях search и retriever")
+    parser.add_argument('--sessions', type=int, default=8, help="одновременных сессий в сценарии api")
+    parser.add_argument('--requests', type=int, default=200, help="всего запросов в каждом сценарии")
+    parser.add_argument('--first-token-delay-ms', type=float, default=50.0)
+    parser.add_argument('--token-delay-ms', type=float, default=2.0)
+    parser.add_argument('--answer-words', type=int, default=60)
+    parser.add_argument('--json', help="сохранить результаты в JSON-файл")
+    parser.add_argument('--verbose', action='store_true', help="подробные логи приложения")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(levelname)s - [%(module)s] - %(message)s')
+    logger.setLevel(logging.INFO)
+    scenarios = SCENARIOS if 'all' in args.scenarios else tuple(args.scenarios)
+    questions = load_questions(args.questions)
+
+    model = make_embedder(args.embedder, args.embed_delay_ms)
+    reranker = None
+    if args.rerank:
+        from src.reranker import Reranker, initialize_reranker_model
+        reranker = Reranker(initialize_reranker_model())
+    workspace = Workspace(hybrid=not args.no_hybrid, reranker=reranker, backend=args.vector_store,
+                          quantization=args.quantization)
+    query_embedder = QueryEmbedder(model, cache_size=QUERY_EMBEDDING_CACHE_SIZE if args.query_cache else 0)
+    results = {'embedder': args.embedder, 'hybrid': not args.no_hybrid, 'rerank': args.rerank,
+               'vector_store': args.vector_store, 'quantization': args.quantization}
+    try:
+        results['ingest'] = bench_ingest(workspace, model, args.docs_dir)
+        benches = {'search': bench_search, 'retriever': bench_retriever, 'recall': bench_recall, 'api': bench_api}
+        for name in scenarios:
+            if name in benches:
+                logger.info(f"Сценарий: {name}")
+                results[name] = benches[name](workspace, query_embedder, questions, args)
+        results['query_embedder'] = query_embedder.stats()
+        if reranker is not None:
+            results['rerank_cache'] = reranker.stats()
+    finally:
+        query_embedder.close()
+        workspace.cleanup()
+
+    for name in ('ingest',) + tuple(name for name in SCENARIOS if name in results and name != 'ingest'):
+        print(format_table(name, results[name]))
+        print()
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
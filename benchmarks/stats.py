@@ -0,0 +1,35 @@
+import math
+
+def percentile(values, q: float) -> float:
+    """Перцентиль `q` (0–100) с линейной интерполяцией между соседними значениями."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower, upper = math.floor(position), math.ceil(position)
+    if lower == upper:
+        return ordered[lower]
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarize_latencies(latencies, wall_seconds: float) -> dict:
+    """Сводка по задержкам (в миллисекундах) и пропускная способность (запросов в секунду)."""
+    latencies_ms = [value * 1000 for value in latencies]
+    return {
+        'requests': len(latencies_ms),
+        'mean_ms': sum(latencies_ms) / len(latencies_ms) if latencies_ms else 0.0,
+        'p50_ms': percentile(latencies_ms, 50),
+        'p95_ms': percentile(latencies_ms, 95),
+        'p99_ms': percentile(latencies_ms, 99),
+        'max_ms': max(latencies_ms, default=0.0),
+        'throughput_rps': len(latencies_ms) / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+
+def format_table(title: str, rows: dict) -> str:
+    """Форматирует словарь метрик в простую текстовую таблицу."""
+    width = max((len(key) for key in rows), default=0)
+    lines = [title, "-" * len(title)]
+    for key, value in rows.items():
+        if isinstance(value, float):
+            value = f"{value:.3f}"
+        lines.append(f"{key.ljust(width)}  {value}")
+    return "\n".join(lines)
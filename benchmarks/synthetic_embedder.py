@@ -0,0 +1,53 @@
+import time
+import zlib
+import numpy as np
+from src.lexical_index import tokenize
+
+class SyntheticEmbedder:
+    """
+    Детерминированная эмбеддинг-модель для бенчмарков (hashing trick).
+
+    Стеммированные токены (тот же `tokenize`, что и в BM25) и символьные триграммы
+    раскладываются по `dim` корзинам со знаком, вектор нормируется. Модель не требует
+    torch и загрузки весов, но сохраняет лексическую близость текстов, поэтому поиск
+    по ней дает осмысленный (хотя и более слабый, чем у настоящей модели) recall.
+    `delay_ms_per_text` имитирует стоимость прохода настоящей модели.
+    """
+
+    def __init__(self, dim=384, delay_ms_per_text=0.0):
+        self.dim = dim
+        self.delay = delay_ms_per_text / 1000
+        self.calls = 0
+        self.encoded_texts = 0
+
+    def _embed(self, text: str) -> np.ndarray:
+        features, weights = [], []
+        for token in tokenize(text):
+            features.append(token)
+            weights.append(1.0)
+            padded = f"#{token}#"
+            for i in range(len(padded) - 2):
+                features.append(padded[i:i + 3])
+                weights.append(0.3)
+        vector = np.zeros(self.dim, dtype=np.float32)
+        if not features:
+            return vector
+        # crc32 детерминирован между запусками, в отличие от встроенного hash()
+        hashes = np.fromiter((zlib.crc32(feature.encode('utf-8')) for feature in features), dtype=np.uint64,
+                             count=len(features))
+        signs = np.where(hashes & 1, 1.0, -1.0).astype(np.float32)
+        np.add.at(vector, (hashes >> 1) % self.dim, signs * np.asarray(weights, dtype=np.float32))
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=False, convert_to_numpy=True,
+               normalize_embeddings=False, **kwargs) -> np.ndarray:
+        """Совместим по сигнатуре с `SentenceTransformer.encode`."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if self.delay:
+            time.sleep(self.delay * len(texts))
+        self.calls += 1
+        self.encoded_texts += len(texts)
+        vectors = np.stack([self._embed(text) for text in texts]) if texts else np.empty((0, self.dim), dtype=np.float32)
+        return vectors[0] if single else vectors
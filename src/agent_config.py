@@ -1,12 +1,27 @@
 import json5
 import logging
 import os
+import time
+from qwen_agent.agents import Assistant
 from qwen_agent.tools.base import BaseTool, register_tool
-from src.vector_store import search_in_store
-from src.config import LLM_MODEL_NAME, LLM_MODEL_SERVER, K_RETRIEVED_CHUNKS
+from src.vector_store import search_hits, build_metadata_filter
+from src.data_processor import DOC_TYPES, normalize_doc_number
+from src.context_builder import build_context, turn_seen_ids, NO_NEW_CHUNKS_MESSAGE
+from src.retrieval_cache import make_key
+from src.config import (
+    LLM_MODEL_NAME, LLM_MODEL_SERVER, LLM_FALLBACK_ENABLED, K_RETRIEVED_CHUNKS, RERANK_CANDIDATES,
+    K_SEARCH_CANDIDATES,
+)
+from src import llm_client  # noqa: F401 — регистрирует тип модели 'managed_oai'
+from src.request_context import record_stage, stage
 
 logger = logging.getLogger(__name__)
 
+NO_FILTERED_RESULTS_MESSAGE = (
+    "По заданным фильтрам (тип документа, номер документа, статья) ничего не найдено. "
+    "Повтори поиск без фильтров или с другими значениями."
+)
+
 # def get_llm_config():
 #     """Возвращает конфигурацию для LLM."""
 #     return {
@@ -20,8 +35,16 @@ logger = logging.getLogger(__name__)
 #     }
 
 def get_llm_config():
-    """Возвращает конфигурацию для LLM с использованием OpenRouter."""
+    """
+    Возвращает конфигурацию для LLM с использованием OpenRouter. При деградации OpenRouter
+    запросы переключаются на локальную модель (LLM_MODEL_NAME, см. src/llm_client.py).
+    """
+    fallbacks = []
+    if LLM_FALLBACK_ENABLED:
+        fallbacks.append({'model': LLM_MODEL_NAME, 'model_server': LLM_MODEL_SERVER, 'api_key': 'EMPTY'})
     return {
+        'model_type': 'managed_oai',
+        'fallbacks': fallbacks,
         'model': 'qwen/qwen3-235b-a22b:free',
         'model_server': 'https://openrouter.ai/api/v1',
         'api_key': os.getenv('OPENROUTER_API_KEY', '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'), # Замените на ваш ключ или оставьте getenv
@@ -101,41 +124,129 @@ class KnowledgeBaseRetriever(BaseTool):
     """
     description = (
         "Ищет и извлекает релевантную информацию из базы знаний по документам для ответа на вопрос пользователя. "
-        "Используй этот инструмент всегда, когда нужно получить информацию из документов."
+        "Используй этот инструмент всегда, когда нужно получить информацию из документов. "
+        "Если вопрос касается конкретного документа или статьи, сузь поиск параметрами doc_type, document и article."
     )
-    parameters = [{'name': 'query', 'type': 'string', 'description': 'Поисковый запрос, сформулированный на основе вопроса пользователя', 'required': True}]
+    parameters = [
+        {'name': 'query', 'type': 'string', 'description': 'Поисковый запрос, сформулированный на основе вопроса пользователя', 'required': True},
+        {'name': 'doc_type', 'type': 'string', 'description': f"Необязательно. Искать только в документах одного типа: {', '.join(DOC_TYPES)}", 'required': False},
+        {'name': 'document', 'type': 'string', 'description': 'Необязательно. Номер документа, если пользователь назвал конкретный документ (например, "400-ФЗ", "4301-1", "668н")', 'required': False},
+        {'name': 'article', 'type': 'string', 'description': 'Необязательно. Номер статьи закона (например, "4" или "12.1"); используй вместе с document', 'required': False},
+    ]
 
-    def __init__(self, embedding_model, chroma_collection, cfg=None):
+    def __init__(self, embedding_model, chroma_collection, cfg=None, lexical_index=None, reranker=None,
+                 retrieval_cache=None):
         super().__init__(cfg)
         if embedding_model is None or chroma_collection is None:
             raise ValueError("embedding_model и chroma_collection должны быть предоставлены.")
         self.embedding_model = embedding_model
         self.chroma_collection = chroma_collection
+        # Если задан лексический индекс, векторный поиск дополняется BM25 (гибридный поиск)
+        self.lexical_index = lexical_index
+        # Если задан переранжировщик, кандидаты запрашиваются с запасом и в контекст попадают только релевантные
+        self.reranker = reranker
+        # Если задан кэш поиска, повторные запросы не обращаются к модели и хранилищу векторов
+        self.retrieval_cache = retrieval_cache
+
+    def search(self, query: str, k: int, where=None) -> list:
+        """Кандидаты поиска по базе знаний (без кэша)."""
+        return search_hits(
+            query, self.embedding_model, self.chroma_collection,
+            k=k, lexical_index=self.lexical_index, where=where
+        )
+
+    def _cached_search(self, query: str, k: int, where=None) -> list:
+        if self.retrieval_cache is None:
+            return self.search(query, k, where)
+        key = make_key(query, k, where)
+        with stage('retrieval_cache_lookup'):
+            hits, version = self.retrieval_cache.get(key)
+        if hits is not None:
+            logger.info(f"Поиск информации по запросу: '{query}' (из кэша)")
+            return hits
+        hits = self.search(query, k, where)
+        self.retrieval_cache.put(key, hits, version)
+        return hits
 
     def call(self, params: str, **kwargs) -> str:
         query = ""
+        parsed_params = {}
         try:
             parsed_params = json5.loads(params)
             query = parsed_params.get('query', '') if isinstance(parsed_params, dict) else str(parsed_params)
         except Exception:
             query = params
         
-        query = query.strip().strip('"').strip("'")
+        query = str(query).strip().strip('"').strip("'")
         if not query:
             logger.warning("Получен пустой поисковый запрос.")
             return "Поиск не дал результатов."
 
+        where = self._metadata_filter(parsed_params if isinstance(parsed_params, dict) else {})
+
         try:
-            docs = search_in_store(query, self.embedding_model, self.chroma_collection, k=K_RETRIEVED_CHUNKS)
+            # Кандидаты запрашиваются с запасом и фиксированным k (результат не зависит от хода и кэшируется);
+            # чанки, уже выданные в этом ходе агента, отбрасываются после поиска
+            seen_ids = turn_seen_ids()
+            k = RERANK_CANDIDATES if self.reranker is not None else K_SEARCH_CANDIDATES
+            hits = self._cached_search(query, k, where)
             
-            if not docs:
+            if not hits:
                 logger.info("В базе знаний не найдено релевантных чанков.")
+                if where is not None:
+                    return NO_FILTERED_RESULTS_MESSAGE
                 return "Поиск не дал результатов."
 
-            final_context = "\n\n---\n\n".join(docs)
-            logger.info(f"Найдено {len(docs)} релевантн(ых) чанков.")
+            if self.reranker is not None:
+                hits = self.reranker.rerank(query, [hit for hit in hits if not seen_ids or hit['id'] not in seen_ids])
+
+            final_context = build_context(hits, seen_ids=seen_ids, max_chunks=K_RETRIEVED_CHUNKS)
+            if not final_context:
+                return NO_NEW_CHUNKS_MESSAGE
             return final_context
             
         except Exception as e:
             logger.error(f"Произошла ошибка при поиске в базе знаний: {e}", exc_info=True)
-            return "Ошибка при поиске в базе знаний." 
\ No newline at end of file
+            return "Ошибка при поиске в базе знаний." 
+
+    @staticmethod
+    def _metadata_filter(params: dict):
+        """Фильтр по метаданным из необязательных параметров инструмента; неизвестный тип документа игнорируется."""
+        doc_type = str(params.get('doc_type') or '').strip()
+        if doc_type and doc_type not in DOC_TYPES:
+            logger.warning(f"Неизвестный тип документа в запросе агента: '{doc_type}'. Фильтр по типу не применяется.")
+            doc_type = None
+        where = build_metadata_filter(
+            doc_type=doc_type,
+            doc_number=normalize_doc_number(str(params.get('document') or '')),
+            article=str(params.get('article') or '').strip().rstrip('.'),
+        )
+        if where is not None:
+            logger.info(f"Поиск с фильтром по метаданным: {where}")
+        return where
+
+class InstrumentedAssistant(Assistant):
+    """
+    Assistant с замером этапов хода агента: каждое обращение к LLM записывается
+    как этап `llm`, каждый вызов инструмента — как этап `tool`
+    (см. src/request_context.py). Поведение агента не меняется.
+    """
+
+    def _call_llm(self, *args, **kwargs):
+        started = time.perf_counter()
+        output = super()._call_llm(*args, **kwargs)
+        if isinstance(output, list):
+            record_stage('llm', time.perf_counter() - started)
+            return output
+        return self._timed_stream(output, started)
+
+    @staticmethod
+    def _timed_stream(output, started):
+        try:
+            yield from output
+        finally:
+            record_stage('llm', time.perf_counter() - started)
+
+    def _call_tool(self, *args, **kwargs):
+        with stage('tool'):
+            return super()._call_tool(*args, **kwargs)
@@ -0,0 +1,205 @@
+import time
+import asyncio
+import logging
+import threading
+import contextlib
+import contextvars
+import concurrent.futures
+from concurrent.futures import ThreadPoolExecutor
+from src.config import AGENT_MAX_CONCURRENCY, AGENT_QUEUE_SIZE, AGENT_REQUEST_TIMEOUT_SECONDS
+from src.request_context import record_stage
+from src.context_builder import begin_turn
+
+logger = logging.getLogger(__name__)
+
+class ExecutorOverloadedError(RuntimeError):
+    """Очередь агента заполнена: новый запрос не может быть принят."""
+
+class AgentTimeoutError(TimeoutError):
+    """Ход агента не уложился в отведенное время."""
+
+class AgentCancelledError(RuntimeError):
+    """Ход агента прерван (например, по таймауту запроса)."""
+
+# Сигнал отмены хода, выполняемого в текущем потоке (для ожиданий внутри вызовов LLM и инструментов)
+_cancel_event_var = contextvars.ContextVar('agent_cancel_event', default=None)
+
+def current_cancel_event():
+    """Возвращает `cancel_event` хода агента, выполняемого в текущем потоке, или None."""
+    return _cancel_event_var.get()
+
+def run_agent_turn(bot, messages, cancel_event=None, on_responses=None):
+    """
+    Синхронно выполняет один ход агента и возвращает итоговый список сообщений ассистента.
+    Между шагами генератора `bot.run` проверяется `cancel_event`, чтобы прерванный
+    по таймауту запрос освобождал рабочий поток при первой возможности.
+    Если передан `on_responses`, он вызывается с промежуточным списком сообщений на каждом шаге.
+    В пределах хода инструмент поиска не повторяет уже выданные агенту чанки.
+    `cancel_event` доступен коду внутри хода через `current_cancel_event`.
+    """
+    begin_turn()
+    token = _cancel_event_var.set(cancel_event)
+    try:
+        assistant_responses = []
+        for responses in bot.run(messages=messages):
+            if cancel_event is not None and cancel_event.is_set():
+                raise AgentCancelledError("Ход агента прерван.")
+            assistant_responses = responses
+            if on_responses is not None:
+                on_responses(responses)
+        return assistant_responses
+    finally:
+        _cancel_event_var.reset(token)
+
+class _Slot:
+    """Место в очереди исполнителя, выданное одному запросу."""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self.future = None
+        # Завершается, когда задача начала выполняться в рабочем потоке
+        self.started = concurrent.futures.Future()
+        self.cancel_event = threading.Event()
+        self._released = False
+
+    @property
+    def timeout(self):
+        return self._executor.timeout
+
+    async def run(self, func, *args, timeout=None, include_queue=True):
+        """
+        Выполняет `func(*args, cancel_event=...)` в пуле агента с таймаутом.
+        Контекстные переменные запроса передаются в рабочий поток.
+        С `include_queue=False` таймаут отсчитывается с начала выполнения, а не с постановки в очередь пула.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        self.submit(func, *args)
+        future = asyncio.wrap_future(self.future)
+        try:
+            if not include_queue:
+                await asyncio.wait([future, asyncio.wrap_future(self.started)], return_when=asyncio.FIRST_COMPLETED)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise self.timeout_error(timeout)
+        except asyncio.CancelledError:
+            self.cancel_event.set()
+            raise
+
+    def timeout_error(self, timeout=None) -> AgentTimeoutError:
+        """
+        Отмечает ход как прерванный по таймауту (сигнал отмены и счетчик `timed_out` исполнителя)
+        и возвращает исключение для выброса.
+        """
+        self.cancel_event.set()
+        self._executor.timed_out += 1
+        return AgentTimeoutError(f"Ход агента не завершился за {self.timeout if timeout is None else timeout} с.")
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Отправляет `func(*args, cancel_event=..., **kwargs)` в пул агента без ожидания результата
+        и возвращает concurrent.futures.Future. Контекстные переменные запроса передаются в поток,
+        время ожидания свободного потока записывается как этап `agent_queue`.
+        """
+        if self.future is not None:
+            raise RuntimeError("В одном слоте можно выполнить только одну задачу.")
+        context = contextvars.copy_context()
+        submitted = time.perf_counter()
+
+        def run():
+            record_stage('agent_queue', time.perf_counter() - submitted)
+            self.started.set_result(None)
+            return func(*args, cancel_event=self.cancel_event, **kwargs)
+
+        self.future = self._executor._pool.submit(context.run, run)
+        return self.future
+
+    def release(self):
+        """
+        Возвращает место в очередь. Если задача еще выполняется, она получает сигнал
+        отмены, а место освобождается после фактического завершения потока.
+        """
+        if self._released:
+            return
+        self._released = True
+        if self.future is None or self.future.done():
+            self._executor._release()
+        else:
+            self.cancel_event.set()
+            self.future.add_done_callback(self._executor._release)
+
+class AgentExecutor:
+    """
+    Исполнитель ходов агента вне цикла событий.
+
+    Ходы выполняются в выделенном пуле из `max_concurrency` потоков. Еще до `queue_size`
+    запросов могут ожидать в очереди; при ее заполнении новые запросы сразу
+    отклоняются `ExecutorOverloadedError` (HTTP 429), а не копятся бесконечно.
+    Место в очереди освобождается только когда рабочий поток действительно завершился,
+    поэтому запросы, прерванные по таймауту, не обходят ограничение.
+    """
+
+    def __init__(self, max_concurrency=AGENT_MAX_CONCURRENCY, queue_size=AGENT_QUEUE_SIZE,
+                 timeout=AGENT_REQUEST_TIMEOUT_SECONDS):
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="agent")
+        self._lock = threading.Lock()
+        self._occupied = 0
+        self.rejected = 0
+        self.timed_out = 0
+
+    @property
+    def capacity(self) -> int:
+        return self.max_concurrency + self.queue_size
+
+    def _acquire(self):
+        with self._lock:
+            if self._occupied >= self.capacity:
+                self.rejected += 1
+                raise ExecutorOverloadedError(
+                    f"Превышен лимит одновременных запросов ({self.max_concurrency} выполняются, {self.queue_size} в очереди)."
+                )
+            self._occupied += 1
+
+    def _release(self, *_):
+        with self._lock:
+            self._occupied -= 1
+
+    def acquire_slot(self) -> _Slot:
+        """
+        Резервирует место в очереди. Если очередь заполнена, немедленно выбрасывает
+        `ExecutorOverloadedError`. Место нужно вернуть вызовом `slot.release()`.
+        """
+        self._acquire()
+        return _Slot(self)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Резервирует место в очереди на время обработки запроса (см. `acquire_slot`)."""
+        slot = self.acquire_slot()
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    async def run(self, func, *args, timeout=None):
+        """Резервирует место и выполняет одну задачу в пуле агента."""
+        async with self.slot() as slot:
+            return await slot.run(func, *args, timeout=timeout)
+
+    def stats(self) -> dict:
+        """Возвращает текущую загрузку исполнителя."""
+        with self._lock:
+            occupied = self._occupied
+        return {
+            'occupied': occupied,
+            'capacity': self.capacity,
+            'max_concurrency': self.max_concurrency,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+        }
+
+    def shutdown(self):
+        """Останавливает пул, не дожидаясь завершения выполняющихся ходов."""
+        self._pool.shutdown(wait=False, cancel_futures=True)
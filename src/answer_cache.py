@@ -0,0 +1,179 @@
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+import numpy as np
+from src.config import (
+    ANSWER_CACHE_SIMILARITY_THRESHOLD, ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+def normalize_question(text: str) -> str:
+    """Нормализует вопрос для точного совпадения: регистр, "ё", пробелы и пунктуация по краям."""
+    text = re.sub(r'\s+', ' ', text.lower().replace('ё', 'е')).strip()
+    return text.strip(' .,!?;:«»"\'')
+
+class SemanticAnswerCache:
+    """
+    Семантический кэш готовых ответов агента.
+
+    Вопрос кодируется той же эмбеддинг-моделью, что и поиск по базе знаний, и сравнивается
+    с закэшированными вопросами по косинусному сходству; при сходстве не ниже `threshold`
+    возвращается сохраненный ответ без запуска агента. Кэш предназначен только для вопросов,
+    не зависящих от истории диалога (первый вопрос сессии).
+
+    - векторы хранятся в заранее выделенной матрице, поиск — одно матричное умножение;
+    - записи живут не дольше `ttl_seconds`, при переполнении вытесняются давно не использованные;
+    - записи привязаны к версии базы знаний: при смене версии кэш полностью сбрасывается.
+    """
+
+    def __init__(self, embedder, threshold=ANSWER_CACHE_SIMILARITY_THRESHOLD, ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+                 max_entries=ANSWER_CACHE_MAX_ENTRIES, version_provider=None):
+        self.embedder = embedder
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.version_provider = version_provider
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # нормализованный вопрос -> (слот, ответ, время записи)
+        self._slot_keys = [None] * max_entries
+        self._free_slots = list(range(max_entries - 1, -1, -1))
+        self._matrix = None
+        self._valid = np.zeros(max_entries, dtype=bool)
+        self._version = version_provider() if version_provider else None
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def _embed(self, question: str) -> np.ndarray:
+        vector = np.asarray(self.embedder.encode([question]), dtype=np.float32)[0]
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self):
+        """
+        Сбрасывает кэш, если версия базы знаний изменилась, и возвращает текущую версию.
+        Вызывается под блокировкой.
+        """
+        if self.version_provider is None:
+            return self._version
+        version = self.version_provider()
+        if version != self._version:
+            if self._entries:
+                logger.info(f"Версия базы знаний изменилась ({self._version} -> {version}). Кэш ответов сброшен.")
+            self._clear()
+            self._version = version
+            self.invalidations += 1
+        return version
+
+    def _clear(self):
+        self._entries.clear()
+        self._slot_keys = [None] * self.max_entries
+        self._free_slots = list(range(self.max_entries - 1, -1, -1))
+        self._valid[:] = False
+
+    def _remove(self, key):
+        slot, _, _ = self._entries.pop(key)
+        self._valid[slot] = False
+        self._slot_keys[slot] = None
+        self._free_slots.append(slot)
+
+    def invalidate(self):
+        """Полностью очищает кэш (например, после повторной загрузки базы знаний)."""
+        with self._lock:
+            self._clear()
+            self.invalidations += 1
+
+    def lookup(self, question: str):
+        """
+        Возвращает (закэшированный ответ на похожий вопрос или None, версия базы знаний на момент поиска).
+        Версию нужно передать в `store` вместе с ответом агента.
+        """
+        key = normalize_question(question)
+        now = time.time()
+        with self._lock:
+            version = self._check_version()
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[2] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1], version
+            has_entries = bool(self._entries)
+        if not has_entries:
+            with self._lock:
+                self.misses += 1
+            return None, version
+        return self._lookup_similar(key, now), version
+
+    def _lookup_similar(self, key: str, now: float):
+        """Ищет ответ на вопрос, близкий к `key` по косинусному сходству эмбеддингов."""
+        vector = self._embed(key)
+        with self._lock:
+            if self._matrix is None or not self._valid.any():
+                self.misses += 1
+                return None
+            similarities = self._matrix @ vector
+            similarities[~self._valid] = -np.inf
+            best_slot = int(np.argmax(similarities))
+            best_key = self._slot_keys[best_slot]
+            if similarities[best_slot] < self.threshold or best_key is None:
+                self.misses += 1
+                return None
+            _, answer, created_at = self._entries[best_key]
+            if now - created_at > self.ttl_seconds:
+                self._remove(best_key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(best_key)
+            self.hits += 1
+            logger.info(f"Семантический кэш: найден ответ (сходство {similarities[best_slot]:.3f}).")
+            return answer
+
+    def store(self, question: str, answer: str, version=None):
+        """
+        Сохраняет ответ агента на вопрос, только если версия базы знаний не сменилась
+        с поиска в кэше (`version` — метка из `lookup`): иначе ответ мог быть получен по старой базе.
+        """
+        if not answer:
+            return
+        key = normalize_question(question)
+        vector = self._embed(key)
+        with self._lock:
+            if self._check_version() != version:
+                return
+            if self._matrix is None:
+                self._matrix = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            if key in self._entries:
+                self._remove(key)
+            if not self._free_slots:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+            slot = self._free_slots.pop()
+            self._matrix[slot] = vector
+            self._valid[slot] = True
+            self._slot_keys[slot] = key
+            self._entries[key] = (slot, answer, time.time())
+            self.stores += 1
+
+    def stats(self) -> dict:
+        """Возвращает статистику кэша."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'capacity': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'stores': self.stores,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'kb_version': self._version,
+            }
@@ -0,0 +1,89 @@
+import sys
+import json
+import argparse
+
+DEFAULT_URL = "http://localhost:8000/api/v1/ask/batch"
+
+def load_questions(path: str) -> list:
+    """
+    Читает вопросы из JSON-списка (строки или объекты с полями `query`/`question` и необязательным `id`)
+    или текстового файла по вопросу в строке (пустые строки пропускаются).
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    try:
+        items = json.loads(text)
+    except ValueError:
+        items = None
+    if not isinstance(items, list):
+        return [{'query': line.strip()} for line in text.splitlines() if line.strip()]
+
+    questions = []
+    for position, item in enumerate(items):
+        if isinstance(item, str):
+            questions.append({'query': item})
+        elif isinstance(item, dict) and (item.get('query') or item.get('question')):
+            question = {'query': item.get('query') or item['question']}
+            if item.get('id') is not None:
+                question['id'] = str(item['id'])
+            questions.append(question)
+        else:
+            raise ValueError(f"Элемент {position} не содержит вопроса: {item!r}")
+    return questions
+
+def main(argv=None):
+    """
+    Пакетная отправка вопросов в `/api/v1/ask/batch`:
+    `python -m src.batch_client questions.json --output answers.jsonl`.
+    Ответы записываются в NDJSON по мере готовности, ход обработки выводится в stderr.
+    """
+    import httpx
+
+    parser = argparse.ArgumentParser(description="Пакетная отправка вопросов ассистенту с ответом в NDJSON.")
+    parser.add_argument('input', help="файл с вопросами (JSON-список или по вопросу в строке)")
+    parser.add_argument('--url', default=DEFAULT_URL, help="адрес эндпоинта пакетной обработки")
+    parser.add_argument('--output', help="файл для ответов NDJSON (по умолчанию stdout)")
+    parser.add_argument('--concurrency', type=int, help="одновременно выполняемых ходов агента")
+    parser.add_argument('--no-cache', action='store_true', help="не использовать кэш ответов")
+    parser.add_argument('--timeout', type=float, default=None, help="таймаут чтения потока, с (по умолчанию без ограничения)")
+    args = parser.parse_args(argv)
+
+    questions = load_questions(args.input)
+    if not questions:
+        parser.error("во входном файле нет вопросов")
+    payload = {'questions': questions, 'use_cache': not args.no_cache}
+    if args.concurrency:
+        payload['concurrency'] = args.concurrency
+
+    output = open(args.output, 'w', encoding='utf-8') if args.output else sys.stdout
+    done = failed = 0
+    try:
+        timeout = httpx.Timeout(10.0, read=args.timeout)
+        with httpx.stream('POST', args.url, json=payload, timeout=timeout) as response:
+            if response.status_code != 200:
+                response.read()
+                print(f"Ошибка {response.status_code}: {response.text}", file=sys.stderr)
+                return 1
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                item = json.loads(line)
+                if 'summary' in item:
+                    print(f"Итог: {json.dumps(item['summary'], ensure_ascii=False)}", file=sys.stderr)
+                    continue
+                if 'error' in item and 'index' not in item:
+                    print(f"Ошибка сервера: {item['error']}", file=sys.stderr)
+                    return 1
+                output.write(line + "\n")
+                output.flush()
+                done += 1
+                failed += item.get('status') != 'ok'
+                print(f"\r{done}/{len(questions)} (ошибок: {failed})", end='', file=sys.stderr, flush=True)
+        print(file=sys.stderr)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    return 0 if done == len(questions) and not failed else 1
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -9,25 +9,231 @@ DOCS_DIR = os.path.join(ROOT_DIR, 'docs')
 CHROMA_DB_PATH = os.path.join(ROOT_DIR, 'chroma_db')
 # Путь к базе данных для хранения истории диалогов
 HISTORY_DB_PATH = os.path.join(ROOT_DIR, 'history.db')
+# Путь к манифесту инкрементальной загрузки документов (хэши файлов и ID их чанков)
+INGEST_MANIFEST_PATH = os.path.join(CHROMA_DB_PATH, 'ingest_manifest.json')
+# Путь к персистентному кэшу эмбеддингов (отдельная папка для каждой модели)
+EMBEDDING_CACHE_DIR = os.path.join(ROOT_DIR, 'embedding_cache')
+# Путь к лексическому индексу BM25 (строится вместе с коллекцией ChromaDB)
+LEXICAL_INDEX_PATH = os.path.join(CHROMA_DB_PATH, 'lexical_index.json')
+# Путь к файлу с версией базы знаний (меняется при каждой загрузке, изменившей коллекцию)
+KB_VERSION_PATH = os.path.join(CHROMA_DB_PATH, 'kb_version')
+# Путь к локальному хранилищу векторов (бэкенд 'local')
+LOCAL_VECTOR_STORE_PATH = os.path.join(ROOT_DIR, 'vector_index')
+# Путь к снимку LRU-кэша эмбеддингов запросов (сохраняется при остановке сервера, загружается при старте)
+QUERY_EMBEDDING_SNAPSHOT_PATH = os.path.join(EMBEDDING_CACHE_DIR, 'query_snapshot.npz')
+# Путь к журналу частых запросов к поиску по базе знаний (обновляется при остановке сервера, по нему прогревается кэш поиска)
+RETRIEVAL_QUERY_LOG_PATH = os.path.join(ROOT_DIR, 'retrieval_queries.json')
 
 # --- Настройки LLM ---
 LLM_MODEL_NAME = 'qwen3:latest'
 LLM_MODEL_SERVER = 'http://localhost:11434/v1'
 
+# --- Настройки клиента LLM (src/llm_client.py) ---
+# Переключаться на локальную LLM (LLM_MODEL_NAME на LLM_MODEL_SERVER) при деградации основной
+LLM_FALLBACK_ENABLED = True
+# Пул HTTP-соединений с каждым сервером LLM: всего соединений, из них поддерживаемых открытыми (keep-alive)
+LLM_POOL_MAX_CONNECTIONS = 16
+LLM_POOL_MAX_KEEPALIVE = 8
+LLM_POOL_KEEPALIVE_EXPIRY_SECONDS = 60
+# Таймаут установления соединения и ожидания очередной порции ответа (в секундах)
+LLM_CONNECT_TIMEOUT_SECONDS = 5
+LLM_READ_TIMEOUT_SECONDS = 60
+# Общий срок одного обращения к LLM с учетом повторов и переключений до первого токена ответа
+# (меньше AGENT_REQUEST_TIMEOUT_SECONDS, чтобы ход агента успел завершиться с ошибкой LLM, а не по таймауту)
+LLM_CALL_DEADLINE_SECONDS = 90
+# Повторы на одном сервере при временных ошибках (обрыв соединения, таймаут, 429, 5xx)
+LLM_MAX_RETRIES = 2
+# Экспоненциальная задержка между повторами со случайным разбросом (в секундах). Если сервер просит
+# подождать (Retry-After) дольше LLM_RETRY_MAX_DELAY_SECONDS, запрос сразу уходит на резервный сервер
+LLM_RETRY_BASE_DELAY_SECONDS = 0.5
+LLM_RETRY_MAX_DELAY_SECONDS = 8
+# Если первый токен не получен за это время, на тот же сервер отправляется дублирующий запрос
+# и используется ответ, пришедший первым (None — без дублирования)
+LLM_HEDGE_AFTER_SECONDS = None
+# Количество неудачных обращений подряд, после которого сервер считается деградированным,
+# и время, на которое он переводится в конец очереди серверов (в секундах)
+LLM_FAILURE_THRESHOLD = 3
+LLM_DEGRADED_COOLDOWN_SECONDS = 30
+
 # --- Настройки Эмбеддинг-модели ---
 EMBEDDING_MODEL_NAME = 'Qwen/Qwen3-Embedding-0.6B'
+# Бэкенд инференса: 'torch' (fp32, эталон), 'torch-int8' (динамическое int8-квантование линейных слоев, CPU)
+# или 'onnx' (ONNX Runtime, CPU; при первом запуске модель экспортируется, требуется optimum[onnxruntime])
+EMBEDDING_BACKEND = 'torch'
+# Файл ONNX-модели внутри репозитория модели (например, квантованный 'onnx/model_qint8_avx512_vnni.onnx');
+# None — стандартный 'onnx/model.onnx'
+EMBEDDING_ONNX_FILE_NAME = None
+# Количество потоков инференса на CPU (None — значение по умолчанию библиотеки)
+EMBEDDING_NUM_THREADS = None
+# Размерность эмбеддингов после обрезки (Qwen3-Embedding обучена с Matryoshka: допустимы 32..1024);
+# None — полная размерность
+EMBEDDING_TRUNCATE_DIM = None
+# Пространство имен векторов: эмбеддинги разных бэкендов, файлов ONNX-модели и размерностей
+# не смешиваются в кэшах и коллекции
+EMBEDDING_NAMESPACE = EMBEDDING_MODEL_NAME + (f"@{EMBEDDING_BACKEND}" if EMBEDDING_BACKEND != 'torch' else "") + (
+    f":{EMBEDDING_ONNX_FILE_NAME}" if EMBEDDING_BACKEND == 'onnx' and EMBEDDING_ONNX_FILE_NAME else ""
+) + (f"-dim{EMBEDDING_TRUNCATE_DIM}" if EMBEDDING_TRUNCATE_DIM else "")
+# Проверка совпадения эмбеддингов выбранного бэкенда с эталонными (fp32) при запуске:
+# путь к эталонным эмбеддингам (`python -m src.embedding_backends --write-reference`)
+EMBEDDING_PARITY_REFERENCE_PATH = os.path.join(EMBEDDING_CACHE_DIR, 'parity_reference.npz')
+# Минимальное косинусное сходство с эталоном для каждого проверочного текста
+EMBEDDING_PARITY_MIN_COSINE = 0.98
+# Не запускать нестандартный бэкенд или обрезку без файла эталона (False — запуск с предупреждением в логе).
+# Эталон создается моделью fp32: python -m src.embedding_backends --write-reference
+EMBEDDING_PARITY_REQUIRED = True
+
+# Размер LRU-кэша эмбеддингов поисковых запросов (количество запросов)
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+# Окно (мс), в течение которого одновременные запросы объединяются в один батч
+EMBEDDING_BATCH_WINDOW_MS = 5
+# Максимальный размер батча запросов для одного прохода модели
+EMBEDDING_MAX_BATCH_SIZE = 32
+
+# --- Общий сервис эмбеддингов (для запуска сервера в несколько воркеров) ---
+# Путь к Unix-сокету сервиса `python -m src.embedding_service`. Если задан, воркеры сервера
+# не загружают свою копию модели, а обращаются к сервису (None — модель загружается в каждом процессе)
+EMBEDDING_SERVICE_SOCKET = os.getenv('EMBEDDING_SERVICE_SOCKET') or None
+# Сколько простаивающих соединений с сервисом держит каждый воркер
+EMBEDDING_SERVICE_POOL_SIZE = 8
+# Таймаут одного обращения к сервису (в секундах)
+EMBEDDING_SERVICE_TIMEOUT_SECONDS = 30
+# Для батчей документов таймаут растет с размером: не меньше этого времени на каждый текст (в секундах)
+EMBEDDING_SERVICE_TIMEOUT_PER_TEXT_SECONDS = 1.0
+# Сколько воркер ждет готовности сервиса при старте (сервис может еще загружать модель)
+EMBEDDING_SERVICE_STARTUP_WAIT_SECONDS = 300
 
-# --- Настройки ChromaDB ---
+# --- Настройки хранилища векторов ---
+# Бэкенд: 'chroma' (ChromaDB) или 'local' (матрица эмбеддингов в memory-mapped файле, поиск полным перебором;
+# открывается за миллисекунды и разделяется между процессами-воркерами)
+VECTOR_STORE_BACKEND = 'chroma'
+# Квантование матрицы локального хранилища: None (float32) или 'int8' (в 4 раза меньше памяти)
+LOCAL_VECTOR_STORE_QUANTIZATION = None
+# Имя коллекции ChromaDB (бэкенд 'chroma')
 CHROMA_COLLECTION_NAME = "svo_rag_docs"
 
 # --- Настройки RAG ---
 # Количество извлекаемых чанков
 K_RETRIEVED_CHUNKS = 10
+# Количество кандидатов, запрашиваемых у поиска без переранжирования: с запасом, так как чанки,
+# уже выданные в текущем ходе агента, отбрасываются. Фиксировано, чтобы повторные запросы попадали в кэш поиска
+K_SEARCH_CANDIDATES = 2 * K_RETRIEVED_CHUNKS
 # Размер чанка при нарезке документов
 CHUNK_SIZE = 1000
 # Перекрытие чанков
 CHUNK_OVERLAP = 150
+# Количество процессов для параллельного извлечения текста из PDF
+PDF_EXTRACT_WORKERS = os.cpu_count() or 1
+# Количество страниц PDF в одной задаче пула (крупные файлы делятся на части)
+PDF_PAGES_PER_TASK = 8
+# Размер батча при расчете эмбеддингов и записи чанков в ChromaDB
+EMBEDDING_BATCH_SIZE = 100
+# Бюджет контекста, который инструмент поиска возвращает агенту за один вызов (в токенах)
+CONTEXT_TOKEN_BUDGET = 3000
+# Среднее количество символов на токен для оценки длины контекста (русский текст, токенизатор Qwen)
+CONTEXT_CHARS_PER_TOKEN = 3.0
+# Переранжирование кандидатов поиска кросс-энкодером (требует загрузки дополнительной модели)
+RERANK_ENABLED = False
+# Компактный многоязычный кросс-энкодер, достаточно быстрый на CPU
+RERANK_MODEL_NAME = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+# Максимальная длина пары (запрос, чанк) в токенах для кросс-энкодера
+RERANK_MAX_LENGTH = 512
+# Количество кандидатов, которое поиск отдает на переранжирование
+RERANK_CANDIDATES = 30
+# Размер батча пар при расчете оценок кросс-энкодером
+RERANK_BATCH_SIZE = 16
+# Минимальная оценка кросс-энкодера (0..1), при которой чанк попадает в контекст
+RERANK_SCORE_THRESHOLD = 0.2
+# Границы количества чанков после переранжирования (адаптивный k)
+RERANK_MIN_CHUNKS = 2
+RERANK_MAX_CHUNKS = 6
+# Размер LRU-кэша оценок пар (запрос, чанк)
+RERANK_CACHE_SIZE = 20000
+# Гибридный поиск: объединение векторного поиска и BM25
+HYBRID_SEARCH_ENABLED = True
+# Количество кандидатов от каждого из видов поиска перед объединением
+HYBRID_CANDIDATES = 30
+# Константа k в Reciprocal Rank Fusion
+RRF_K = 60
+# Параметры BM25
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+# --- Настройки семантического кэша ответов ---
+# Включает кэш ответов на вопросы, не зависящие от истории диалога
+ANSWER_CACHE_ENABLED = True
+# Минимальное косинусное сходство вопроса с закэшированным для выдачи готового ответа
+ANSWER_CACHE_SIMILARITY_THRESHOLD = 0.95
+# Время жизни ответа в кэше (в секундах)
+ANSWER_CACHE_TTL_SECONDS = 24 * 60 * 60
+# Максимальное количество ответов в кэше (при переполнении вытесняются давно не использованные)
+ANSWER_CACHE_MAX_ENTRIES = 1000
+
+# --- Настройки запуска сервера ---
+# Синхронизировать базу знаний с папкой документов при старте сервера.
+# Обычно загрузка выполняется отдельной командой `python -m src.ingestion` до раскатки;
+# если коллекция пуста, сервер все равно загрузит документы сам.
+INGEST_ON_STARTUP = False
+# Запросы для прогрева эмбеддинг-модели при старте (первый проход модели самый медленный)
+WARMUP_QUERIES = [
+    "Какие льготы положены участникам СВО?",
+    "Как получить статус ветерана боевых действий?",
+]
+
+# --- Настройки выполнения агента ---
+# Максимальное количество одновременно выполняемых ходов агента
+AGENT_MAX_CONCURRENCY = 8
+# Количество запросов, которые могут ожидать в очереди (сверх лимита возвращается 429)
+AGENT_QUEUE_SIZE = 32
+# Таймаут обработки одного запроса агентом (в секундах)
+AGENT_REQUEST_TIMEOUT_SECONDS = 120
+
+# --- Настройки кэша результатов поиска (src/retrieval_cache.py) ---
+# Повторные запросы агента к базе знаний (тот же нормализованный запрос, k и фильтр) берутся из кэша
+RETRIEVAL_CACHE_ENABLED = True
+# Максимальное количество закэшированных результатов поиска (LRU)
+RETRIEVAL_CACHE_MAX_ENTRIES = 2000
+# Сколько самых частых запросов хранится в журнале запросов
+RETRIEVAL_QUERY_LOG_MAX_QUERIES = 5000
+# Сколько самых частых запросов из журнала выполняется заранее при старте сервера (0 — не прогревать)
+RETRIEVAL_CACHE_PREWARM_QUERIES = 200
+
+# --- Настройки пакетной обработки вопросов (/api/v1/ask/batch) ---
+# Максимальное количество вопросов в одном пакете
+BATCH_MAX_QUESTIONS = 1000
+# Максимальное количество одновременно выполняемых ходов агента для всех пакетов вместе
+# (меньше AGENT_MAX_CONCURRENCY, чтобы пакеты не вытесняли интерактивные запросы)
+BATCH_MAX_CONCURRENCY = 4
+
+# --- Настройки метрик и трассировки запросов ---
+# Границы корзин гистограмм длительности (в секундах)
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+# Запросы дольше порога пишутся в лог с разбивкой по этапам (None — не писать)
+SLOW_REQUEST_THRESHOLD_SECONDS = 15
 
 # --- Настройки истории диалогов ---
 # Количество последних сообщений для хранения в контексте
-HISTORY_MESSAGES_TO_KEEP = 2 
\ No newline at end of file
+HISTORY_MESSAGES_TO_KEEP = 2
+# Количество потоков (и постоянных соединений) для чтения истории
+HISTORY_READ_POOL_SIZE = 4
+# Максимальное количество сообщений, записываемых в одной транзакции
+HISTORY_WRITE_BATCH_SIZE = 200
+# Сколько поток-писатель ждет следующих сообщений перед записью пачки (в миллисекундах)
+HISTORY_WRITE_FLUSH_INTERVAL_MS = 20
+# Интервал фоновой очистки истории (в секундах)
+HISTORY_PRUNE_INTERVAL_SECONDS = 15 * 60
+# Сессии без новых сообщений дольше этого срока удаляются целиком (None — не удалять)
+HISTORY_SESSION_TTL_SECONDS = 30 * 24 * 60 * 60
+
+# --- Настройки сводки диалога (src/session_summarizer.py) ---
+# Сообщения, вышедшие за окно HISTORY_MESSAGES_TO_KEEP, сворачиваются в краткую сводку сессии,
+# которая передается агенту системным сообщением
+HISTORY_SUMMARY_ENABLED = True
+# Сколько новых сообщений за пределами окна накапливается перед обновлением сводки (2 — один обмен)
+HISTORY_SUMMARY_MIN_NEW_MESSAGES = 2
+# Максимальная длина сводки в символах: лимит указывается в промпте, более длинный ответ LLM обрезается
+HISTORY_SUMMARY_MAX_CHARS = 1200
+# Максимальная длина одного сообщения, передаваемого LLM для обновления сводки
+HISTORY_SUMMARY_MESSAGE_MAX_CHARS = 2000
+# Сколько сообщений, еще не вошедших в сводку, хранится в сессии, если сводка не обновляется
+# (например, LLM недоступна); более старые удаляются при очистке
+HISTORY_UNSUMMARIZED_MAX_MESSAGES = 40
@@ -0,0 +1,146 @@
+import logging
+import contextvars
+from src.config import CONTEXT_TOKEN_BUDGET, CONTEXT_CHARS_PER_TOKEN
+
+logger = logging.getLogger(__name__)
+
+SEPARATOR = "\n\n---\n\n"
+NO_NEW_CHUNKS_MESSAGE = (
+    "Новых фрагментов по этому запросу не найдено: все найденные фрагменты уже приведены "
+    "в предыдущих результатах поиска."
+)
+
+# ID чанков, уже выданных агенту в текущем ходе (None — вне хода агента)
+_turn_seen_ids = contextvars.ContextVar('turn_seen_ids', default=None)
+
+def begin_turn():
+    """
+    Начинает новый ход агента в текущем контексте: повторные вызовы поиска
+    в этом ходе не будут возвращать уже выданные чанки.
+    """
+    _turn_seen_ids.set(set())
+
+def turn_seen_ids():
+    """Возвращает множество ID чанков, выданных в текущем ходе, или None вне хода."""
+    return _turn_seen_ids.get()
+
+def estimate_tokens(text: str) -> int:
+    """Приблизительное количество токенов текста (без загрузки токенизатора LLM)."""
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+class _Block:
+    """Непрерывный фрагмент документа: один чанк или несколько склеенных соседних."""
+
+    def __init__(self, hit, rank):
+        metadata = hit.get('metadata') or {}
+        self.ids = [hit['id']]
+        self.source = metadata.get('source')
+        self.chunk_index = metadata.get('chunk_index')
+        start = metadata.get('start_index')
+        self.start = start if isinstance(start, int) and start >= 0 else None
+        self.text = hit['document'] or ""
+        self.rank = rank
+        self.page_start = metadata.get('page_start') or None
+        self.page_end = metadata.get('page_end') or None
+        # Чанк до первого заголовка статьи (преамбула) начинается со статьи, которой заканчивается
+        self.article = metadata.get('article') or metadata.get('article_last') or None
+        self.article_last = metadata.get('article_last') or None
+
+    @property
+    def end(self):
+        return self.start + len(self.text)
+
+    def try_merge(self, other) -> bool:
+        """Присоединяет следующий по тексту блок того же файла, если они перекрываются или соседствуют."""
+        if self.start is not None and other.start is not None:
+            if other.start > self.end:
+                return False
+            if other.end > self.end:
+                self.text += other.text[self.end - other.start:]
+        elif self.chunk_index is not None and other.chunk_index is not None:
+            if other.chunk_index != self.chunk_index + 1:
+                return False
+            self.text += "\n" + other.text
+        else:
+            return False
+        self.ids.extend(other.ids)
+        self.chunk_index = other.chunk_index
+        self.page_end = other.page_end or self.page_end
+        self.article_last = other.article_last or self.article_last
+        self.rank = min(self.rank, other.rank)
+        return True
+
+def _merge_blocks(blocks):
+    """Склеивает перекрывающиеся и соседние чанки одного файла."""
+    by_source = {}
+    loose = []
+    for block in blocks:
+        if block.source is None or (block.start is None and block.chunk_index is None):
+            loose.append(block)
+        else:
+            by_source.setdefault(block.source, []).append(block)
+
+    merged = list(loose)
+    for source_blocks in by_source.values():
+        source_blocks.sort(key=lambda b: (b.start if b.start is not None else -1, b.chunk_index or 0))
+        current = source_blocks[0]
+        for block in source_blocks[1:]:
+            if not current.try_merge(block):
+                merged.append(current)
+                current = block
+        merged.append(current)
+    return merged
+
+def _format_range(first, last) -> str:
+    return str(first) if not last or last == first else f"{first}–{last}"
+
+def _format_block(block) -> str:
+    """Заголовок фрагмента для цитирования: файл, страницы и статьи закона."""
+    if not block.source:
+        return block.text
+    header = block.source
+    if block.page_start:
+        header += f", стр. {_format_range(block.page_start, block.page_end)}"
+    if block.article:
+        header += f", ст. {_format_range(block.article, block.article_last)}"
+    return f"[Источник: {header}]\n{block.text}"
+
+def build_context(hits, token_budget=CONTEXT_TOKEN_BUDGET, seen_ids=None, max_chunks=None) -> str:
+    """
+    Собирает контекст для LLM из результатов поиска (в порядке релевантности):
+
+    - чанки, уже выданные в текущем ходе (`seen_ids`), отбрасываются;
+      из оставшихся берутся не более `max_chunks` самых релевантных;
+    - перекрывающиеся и соседние чанки одного файла склеиваются в один фрагмент без повторов;
+    - фрагменты добавляются по убыванию релевантности, пока укладываются в `token_budget`
+      (самый релевантный фрагмент при необходимости обрезается).
+
+    ID выданных чанков добавляются в `seen_ids`. Возвращает пустую строку, если новых чанков нет.
+    """
+    fresh = [hit for hit in hits if seen_ids is None or hit['id'] not in seen_ids][:max_chunks]
+    blocks = _merge_blocks([_Block(hit, rank) for rank, hit in enumerate(fresh)])
+    blocks.sort(key=lambda block: block.rank)
+
+    parts = []
+    used_tokens = 0
+    separator_tokens = estimate_tokens(SEPARATOR)
+    for block in blocks:
+        text = _format_block(block)
+        tokens = estimate_tokens(text) + (separator_tokens if parts else 0)
+        if used_tokens + tokens > token_budget:
+            if parts:
+                continue
+            # Даже самый релевантный фрагмент не помещается целиком: обрезаем его по бюджету
+            text = text[:int(token_budget * CONTEXT_CHARS_PER_TOKEN)]
+            tokens = estimate_tokens(text)
+        parts.append(text)
+        used_tokens += tokens
+        if seen_ids is not None:
+            seen_ids.update(block.ids)
+
+    if fresh:
+        logger.info(
+            f"Контекст: чанков {len(hits)}, новых {len(fresh)}, фрагментов после склейки {len(blocks)}, "
+            f"включено {len(parts)} (~{used_tokens} токенов из {token_budget})."
+        )
+    return SEPARATOR.join(parts)
@@ -1,58 +1,176 @@
 import os
+import re
+import bisect
 import logging
-from pypdf import PdfReader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from sentence_transformers import SentenceTransformer
-import torch
-from src.config import EMBEDDING_MODEL_NAME, CHUNK_SIZE, CHUNK_OVERLAP
+from src.config import EMBEDDING_BACKEND, EMBEDDING_TRUNCATE_DIM, EMBEDDING_PARITY_REQUIRED, CHUNK_SIZE, CHUNK_OVERLAP, PDF_EXTRACT_WORKERS
+from src.pdf_extractor import extract_pages, iter_pdf_pages
 
 logger = logging.getLogger(__name__)
 
 def initialize_embedding_model():
     """
-    Инициализирует и возвращает эмбеддинг-модель.
+    Инициализирует и возвращает эмбеддинг-модель с бэкендом из конфигурации (`EMBEDDING_BACKEND`).
+    Если бэкенд отличается от эталонного fp32 или эмбеддинги обрезаются, они сверяются
+    с эталонными; при расхождении, а также без файла эталона (если `EMBEDDING_PARITY_REQUIRED`)
+    выбрасывается RuntimeError.
     """
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
-    logger.info(f"Эмбеддинг-модель '{EMBEDDING_MODEL_NAME}' загружена на {device.upper()}.")
+    from src.embedding_backends import load_embedding_model, check_parity
+
+    model = load_embedding_model()
+    if EMBEDDING_BACKEND != 'torch' or EMBEDDING_TRUNCATE_DIM:
+        check_parity(model, required=EMBEDDING_PARITY_REQUIRED)
     return model
 
+def get_text_splitter():
+    """
+    Возвращает рекурсивный сплиттер с настройками нарезки из конфигурации.
+    Сплиттер записывает в метаданные чанка его смещение в тексте файла (`start_index`).
+    """
+    return RecursiveCharacterTextSplitter(
+        chunk_size=CHUNK_SIZE,
+        chunk_overlap=CHUNK_OVERLAP,
+        separators=["\n\n", "\n", ". ", " ", ""],  # Добавил точку для лучшего разбиения
+        length_function=len,
+        add_start_index=True
+    )
+
+# Типы документов по имени файла (проверяются по порядку).
+# Законы РФ, принятые до введения обозначения «ФЗ» (например, 4301-1), тоже относятся к «ФЗ».
+DOC_TYPE_PATTERNS = [
+    ('ФЗ', re.compile(r'ФЗ|закон', re.IGNORECASE)),
+    ('Постановление', re.compile(r'постан', re.IGNORECASE)),
+    ('Приказ', re.compile(r'приказ', re.IGNORECASE)),
+    ('Указ', re.compile(r'указ', re.IGNORECASE)),
+]
+DOC_TYPES = [doc_type for doc_type, _ in DOC_TYPE_PATTERNS]
+
+_FZ_NUMBER_RE = re.compile(r'(\d+)\s*-\s*ФЗ', re.IGNORECASE)
+_DATE_RE = re.compile(r'\d{1,2}[._]\d{1,2}[._]\d{4}')
+_NUMBER_RE = re.compile(r'(?<![\w.])(\d+(?:-\d+)?[а-яё]?)(?![\w.])', re.IGNORECASE)
+# Заголовок статьи закона в начале строки: «Статья 4.» или «Статья 12.1.»
+_ARTICLE_RE = re.compile(r'^[ \t]*Статья\s+(\d+(?:\.\d+)*)\.', re.MULTILINE)
+
+def normalize_doc_number(value: str) -> str:
+    """Приводит номер документа к виду, в котором он хранится в метаданных: «№ 400-фз» → «400-ФЗ»."""
+    value = re.sub(r'^(№|N)\s*', '', (value or "").strip(), flags=re.IGNORECASE)
+    return re.sub(r'\s+', '', value).upper()
+
+def describe_document(filename: str) -> dict:
+    """
+    Определяет по имени файла тип документа (`doc_type`: ФЗ, Постановление, Приказ, Указ)
+    и его номер (`doc_number`, например «400-ФЗ», «4301-1», «668Н»). Неизвестные значения — пустые строки.
+    """
+    name = os.path.splitext(filename)[0].replace('_', ' ')
+    doc_type = next((doc_type for doc_type, pattern in DOC_TYPE_PATTERNS if pattern.search(name)), "")
+    fz_number = _FZ_NUMBER_RE.search(name)
+    if fz_number:
+        doc_number = f"{fz_number.group(1)}-ФЗ"
+    else:
+        # Убираем даты и порядковый префикс вида «14)», остается номер документа
+        rest = _DATE_RE.sub(' ', re.sub(r'^\s*\d+\)', ' ', name))
+        number = _NUMBER_RE.search(rest)
+        doc_number = number.group(1) if number else ""
+    return {'doc_type': doc_type, 'doc_number': normalize_doc_number(doc_number)}
+
+def _article_at(article_starts, article_numbers, position) -> str:
+    """Номер статьи, к которой относится позиция в тексте (пустая строка до первой статьи)."""
+    i = bisect.bisect_right(article_starts, position) - 1
+    return article_numbers[i] if i >= 0 else ""
+
+def _split_pages(file_path, page_texts, text_splitter):
+    """
+    Склеивает тексты страниц одного файла и разбивает результат на чанки.
+    Возвращает документы LangChain; в метаданных каждого чанка — смещение в тексте файла
+    (`start_index`), диапазон страниц (`page_start`, `page_end`, с 1) и статьи закона,
+    на которых чанк начинается и заканчивается (`article`, `article_last`).
+    """
+    text = "".join(page_texts)
+    if not text.strip():  # Убедимся, что текст не пустой
+        logger.warning(f"    ! Предупреждение: Файл {os.path.basename(file_path)} пуст или не удалось извлечь текст.")
+        return []
+
+    page_starts = []
+    offset = 0
+    for page_text in page_texts:
+        page_starts.append(offset)
+        offset += len(page_text)
+    articles = list(_ARTICLE_RE.finditer(text))
+    article_starts = [match.start() for match in articles]
+    article_numbers = [match.group(1) for match in articles]
+
+    documents = text_splitter.create_documents([text])
+    for doc in documents:
+        start = doc.metadata.get('start_index', -1)
+        if start is None or start < 0:
+            doc.metadata.update(start_index=-1, page_start=0, page_end=0, article="", article_last="")
+            continue
+        end = start + max(len(doc.page_content) - 1, 0)
+        doc.metadata.update(
+            page_start=bisect.bisect_right(page_starts, start),
+            page_end=bisect.bisect_right(page_starts, end),
+            article=_article_at(article_starts, article_numbers, start),
+            article_last=_article_at(article_starts, article_numbers, end),
+        )
+    return documents
+
+def _chunk_pages(file_path, page_texts, text_splitter):
+    """Склеивает тексты страниц одного файла и разбивает результат на чанки (только тексты)."""
+    return [doc.page_content for doc in _split_pages(file_path, page_texts, text_splitter)]
+
+def load_and_chunk_pdf(file_path, text_splitter=None):
+    """
+    Читает один PDF-файл и разбивает его текст на чанки.
+    Возвращает пустой список, если текст извлечь не удалось.
+    """
+    logger.info(f"  - Обработка файла: {file_path}")
+    try:
+        page_texts = extract_pages(file_path)
+    except Exception as e:
+        logger.error(f"    ! Ошибка: Не удалось прочитать файл {os.path.basename(file_path)}: {e}", exc_info=True)
+        return []
+    return _chunk_pages(file_path, page_texts, text_splitter or get_text_splitter())
+
+def iter_pdf_documents(file_paths, max_workers=PDF_EXTRACT_WORKERS):
+    """
+    Генератор: параллельно извлекает текст PDF-файлов и отдает пары
+    (путь к файлу, список документов-чанков с метаданными) по мере готовности каждого файла.
+    Весь корпус целиком в памяти не хранится.
+    """
+    text_splitter = get_text_splitter()
+    for file_path, page_texts in iter_pdf_pages(file_paths, max_workers=max_workers):
+        logger.info(f"  - Обработан файл: {file_path}")
+        yield file_path, _split_pages(file_path, page_texts, text_splitter)
+
+def iter_pdf_chunks(file_paths, max_workers=PDF_EXTRACT_WORKERS):
+    """
+    Генератор: то же, что `iter_pdf_documents`, но отдает пары (путь к файлу, список текстов чанков).
+    """
+    for file_path, documents in iter_pdf_documents(file_paths, max_workers=max_workers):
+        yield file_path, [doc.page_content for doc in documents]
+
+def iter_chunks(folder_path, max_workers=PDF_EXTRACT_WORKERS):
+    """
+    Генератор чанков всех PDF из папки. Чанки отдаются по мере обработки файлов
+    и могут сразу передаваться на расчет эмбеддингов батчами.
+    """
+    file_paths = [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path)) if filename.endswith(".pdf")]
+    for _, chunks in iter_pdf_chunks(file_paths, max_workers=max_workers):
+        yield from chunks
+
 def load_and_chunk_pdfs(folder_path):
     """
     Загружает все PDF из папки, читает текст и разбивает на чанки
     с помощью рекурсивного сплиттера.
     """
-    all_texts = []
     logger.info("─" * 50)
     logger.info(f"Начало обработки документов из папки: {folder_path}")
-    for filename in os.listdir(folder_path):
-        if filename.endswith(".pdf"):
-            file_path = os.path.join(folder_path, filename)
-            logger.info(f"  - Обработка файла: {file_path}")
-            try:
-                reader = PdfReader(file_path)
-                text = "".join(page.extract_text() for page in reader.pages if page.extract_text())
-                if text.strip():  # Убедимся, что текст не пустой
-                    all_texts.append(text)
-                else:
-                    logger.warning(f"    ! Предупреждение: Файл {filename} пуст или не удалось извлечь текст.")
-            except Exception as e:
-                logger.error(f"    ! Ошибка: Не удалось прочитать файл {filename}: {e}", exc_info=True)
-
-    if not all_texts:
+    chunk_texts = list(iter_chunks(folder_path))
+
+    if not chunk_texts:
         logger.warning("Не найдено текстов для обработки.")
         return []
 
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=CHUNK_SIZE,
-        chunk_overlap=CHUNK_OVERLAP,
-        separators=["\n\n", "\n", ". ", " ", ""],  # Добавил точку для лучшего разбиения
-        length_function=len
-    )
-    
-    documents = text_splitter.create_documents(all_texts)
-    chunk_texts = [doc.page_content for doc in documents]
-    
     logger.info(f"Обработка завершена. Всего создано {len(chunk_texts)} чанков.")
     logger.info("─" * 50)
-    return chunk_texts 
\ No newline at end of file
+    return chunk_texts
\ No newline at end of file
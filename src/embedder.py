@@ -0,0 +1,204 @@
+import os
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+import numpy as np
+from src.config import (
+    QUERY_EMBEDDING_CACHE_SIZE, EMBEDDING_BATCH_WINDOW_MS, EMBEDDING_MAX_BATCH_SIZE, EMBEDDING_NAMESPACE,
+)
+from src.embedding_cache import encode_with_cache
+
+logger = logging.getLogger(__name__)
+
+class QueryEmbedder:
+    """
+    Сервис эмбеддингов для поисковых запросов.
+
+    - хранит векторы недавних запросов в ограниченном LRU-кэше со счетчиками попаданий и промахов;
+    - объединяет одновременные запросы из разных потоков в один батч: фоновый поток
+      собирает запросы в течение `batch_window_ms` (или до `max_batch_size`)
+      и выполняет один проход модели на весь батч;
+    - одинаковые тексты, уже ожидающие расчета, не кодируются повторно.
+
+    Метод `encode` совместим по сигнатуре с `SentenceTransformer.encode`,
+    поэтому экземпляр можно передавать везде, где ожидается модель.
+    """
+
+    def __init__(self, model, cache=None, cache_size=QUERY_EMBEDDING_CACHE_SIZE,
+                 batch_window_ms=EMBEDDING_BATCH_WINDOW_MS, max_batch_size=EMBEDDING_MAX_BATCH_SIZE):
+        self.model = model
+        self.cache = cache
+        self.cache_size = cache_size
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.batched_texts = 0
+        self._lru = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._worker = None
+        self._closed = False
+
+    def _ensure_worker(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._batch_loop, name="query-embedder", daemon=True)
+            self._worker.start()
+
+    def _batch_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    break
+                batch.append(item)
+            self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        texts = [text for text, _ in batch]
+        try:
+            vectors = encode_with_cache(self.model, texts, cache=self.cache, store=False)
+        except Exception as e:
+            logger.error(f"Ошибка при расчете эмбеддингов батча из {len(texts)} запросов: {e}", exc_info=True)
+            with self._lock:
+                for text, future in batch:
+                    self._inflight.pop(text, None)
+                    future.set_exception(e)
+            return
+
+        with self._lock:
+            self.batches += 1
+            self.batched_texts += len(texts)
+            for (text, future), vector in zip(batch, vectors):
+                self._remember(text, vector)
+                self._inflight.pop(text, None)
+                future.set_result(vector)
+
+    def _remember(self, text, vector):
+        self._lru[text] = vector
+        self._lru.move_to_end(text)
+        while len(self._lru) > self.cache_size:
+            self._lru.popitem(last=False)
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """
+        Возвращает эмбеддинги текстов (матрица float32). Одиночная строка дает вектор.
+        Дополнительные аргументы `SentenceTransformer.encode` игнорируются.
+        """
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        results = [None] * len(texts)
+        waiting = []
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("QueryEmbedder закрыт.")
+            for i, text in enumerate(texts):
+                vector = self._lru.get(text)
+                if vector is not None:
+                    self._lru.move_to_end(text)
+                    self.hits += 1
+                    results[i] = vector
+                    continue
+                self.misses += 1
+                future = self._inflight.get(text)
+                if future is None:
+                    future = Future()
+                    self._inflight[text] = future
+                    self._queue.put((text, future))
+                waiting.append((i, future))
+            if waiting:
+                self._ensure_worker()
+
+        for i, future in waiting:
+            results[i] = future.result()
+
+        if single:
+            return results[0]
+        if not results:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack(results)
+
+    def stats(self) -> dict:
+        """Возвращает статистику LRU-кэша и микробатчинга."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cache_size': len(self._lru),
+                'cache_capacity': self.cache_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'batches': self.batches,
+                'avg_batch_size': self.batched_texts / self.batches if self.batches else 0.0,
+            }
+
+    def save_snapshot(self, path, namespace=EMBEDDING_NAMESPACE) -> int:
+        """
+        Атомарно сохраняет содержимое LRU-кэша на диск (в порядке использования),
+        чтобы после перезапуска частые запросы не пересчитывались моделью.
+        Возвращает количество сохраненных векторов.
+        """
+        with self._lock:
+            texts = list(self._lru)
+            vectors = list(self._lru.values())
+        if not texts:
+            return 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, namespace=np.array(namespace), texts=np.array(texts),
+                     vectors=np.stack(vectors).astype(np.float32))
+        os.replace(tmp_path, path)
+        logger.info(f"Снимок кэша эмбеддингов запросов сохранен: {len(texts)} векторов.")
+        return len(texts)
+
+    def load_snapshot(self, path, namespace=EMBEDDING_NAMESPACE) -> int:
+        """
+        Загружает снимок LRU-кэша, сохраненный `save_snapshot`. Снимок другой модели игнорируется.
+        Возвращает количество загруженных векторов.
+        """
+        if not os.path.exists(path):
+            return 0
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                if str(data['namespace']) != namespace:
+                    logger.info(f"Снимок кэша эмбеддингов запросов создан другой моделью и пропущен: {path}")
+                    return 0
+                texts, vectors = data['texts'].tolist(), data['vectors']
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Не удалось загрузить снимок кэша эмбеддингов запросов {path}: {e}")
+            return 0
+        # Снимок может быть больше текущего кэша: оставляем самые свежие записи
+        texts, vectors = texts[-self.cache_size:], vectors[-self.cache_size:]
+        with self._lock:
+            for text, vector in zip(texts, vectors):
+                self._remember(text, vector)
+        logger.info(f"Снимок кэша эмбеддингов запросов загружен: {len(texts)} векторов.")
+        return len(texts)
+
+    def close(self):
+        """Останавливает фоновый поток батчинга."""
+        with self._lock:
+            self._closed = True
+            worker = self._worker
+        if worker is not None:
+            self._queue.put(None)
+            worker.join(timeout=5)
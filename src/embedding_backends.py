@@ -0,0 +1,195 @@
+import os
+import time
+import logging
+import numpy as np
+from src.config import (
+    EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, EMBEDDING_ONNX_FILE_NAME, EMBEDDING_NUM_THREADS, EMBEDDING_TRUNCATE_DIM,
+    EMBEDDING_PARITY_REFERENCE_PATH, EMBEDDING_PARITY_MIN_COSINE,
+)
+
+logger = logging.getLogger(__name__)
+
+# torch — SentenceTransformer в fp32 (эталон); torch-int8 — динамическое int8-квантование линейных слоев;
+# onnx — ONNX Runtime через бэкенд SentenceTransformer (нужен `optimum[onnxruntime]`)
+BACKENDS = ('torch', 'torch-int8', 'onnx')
+
+# Тексты для проверки совпадения: короткие запросы и фрагменты документов
+PARITY_TEXTS = [
+    "Какие льготы положены участникам СВО?",
+    "Как получить статус ветерана боевых действий?",
+    "Размер ежемесячной денежной выплаты Героям Российской Федерации",
+    "пособие на ребенка военнослужащего, проходящего военную службу по призыву",
+    "Статья 4. Льготы по медицинскому, санаторно-курортному и протезно-ортопедическому обслуживанию. "
+    "Героям, членам их семей предоставляется право на бесплатное медицинское обслуживание.",
+    "Страховая пенсия по случаю потери кормильца назначается нетрудоспособным членам семьи умершего кормильца, "
+    "состоявшим на его иждивении.",
+    "Компенсация расходов на оплату жилого помещения и коммунальных услуг",
+    "Порядок назначения единовременного пособия при рождении ребенка",
+]
+
+class TruncatedEmbeddingModel:
+    """
+    Обертка модели, обрезающая эмбеддинги до первых `dim` компонент и заново нормирующая их.
+    Метод `encode` совместим с `SentenceTransformer.encode`.
+    """
+
+    def __init__(self, model, dim: int):
+        self.model = model
+        self.dim = dim
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        vectors = np.asarray(self.model.encode(sentences, **kwargs), dtype=np.float32)[..., :self.dim]
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms == 0, 1.0, norms)
+
+def _load_torch(device, int8=False):
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(EMBEDDING_MODEL_NAME, device=device)
+    if int8:
+        model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
+def _load_onnx():
+    import onnxruntime
+    from sentence_transformers import SentenceTransformer
+
+    model_kwargs = {'provider': 'CPUExecutionProvider'}
+    if EMBEDDING_ONNX_FILE_NAME:
+        model_kwargs['file_name'] = EMBEDDING_ONNX_FILE_NAME
+    if EMBEDDING_NUM_THREADS:
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = EMBEDDING_NUM_THREADS
+        model_kwargs['session_options'] = session_options
+    return SentenceTransformer(EMBEDDING_MODEL_NAME, device='cpu', backend='onnx', model_kwargs=model_kwargs)
+
+def load_embedding_model(backend=EMBEDDING_BACKEND, truncate_dim=EMBEDDING_TRUNCATE_DIM):
+    """
+    Загружает эмбеддинг-модель выбранным бэкендом; с `truncate_dim` эмбеддинги обрезаются (Matryoshka).
+    torch и sentence_transformers импортируются здесь: их загрузка занимает несколько секунд
+    и нужна только процессам, которые считают эмбеддинги.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд эмбеддинг-модели: {backend}. Допустимые: {', '.join(BACKENDS)}")
+    import torch
+
+    if EMBEDDING_NUM_THREADS:
+        torch.set_num_threads(EMBEDDING_NUM_THREADS)
+    if backend == 'onnx':
+        device = 'cpu'
+        model = _load_onnx()
+    else:
+        # Динамическое int8-квантование поддерживается только на CPU
+        device = 'cuda' if torch.cuda.is_available() and backend == 'torch' else 'cpu'
+        model = _load_torch(device, int8=backend == 'torch-int8')
+    if truncate_dim:
+        model = TruncatedEmbeddingModel(model, truncate_dim)
+    logger.info(
+        f"Эмбеддинг-модель '{EMBEDDING_MODEL_NAME}' загружена: бэкенд {backend}, {device.upper()}"
+        + (f", размерность {truncate_dim}" if truncate_dim else "")
+        + (f", потоков {EMBEDDING_NUM_THREADS}" if EMBEDDING_NUM_THREADS else "") + "."
+    )
+    return model
+
+def write_parity_reference(path=EMBEDDING_PARITY_REFERENCE_PATH, texts=PARITY_TEXTS) -> str:
+    """Считает эталонные эмбеддинги проверочных текстов моделью fp32 полной размерности и сохраняет их."""
+    model = load_embedding_model('torch', truncate_dim=None)
+    vectors = np.asarray(model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, model=np.array(EMBEDDING_MODEL_NAME), texts=np.array(texts), vectors=vectors)
+    os.replace(tmp_path, path)
+    logger.info(f"Эталонные эмбеддинги сохранены: {path} ({len(texts)} текстов).")
+    return path
+
+def _missing_reference(reason: str, required: bool):
+    message = (f"{reason} Проверка бэкенда эмбеддингов невозможна. Создайте эталон моделью fp32: "
+               f"python -m src.embedding_backends --write-reference")
+    if required:
+        raise RuntimeError(message + " (или отключите EMBEDDING_PARITY_REQUIRED).")
+    logger.warning(message + ". Бэкенд включен без проверки.")
+
+def check_parity(model, path=EMBEDDING_PARITY_REFERENCE_PATH, min_cosine=EMBEDDING_PARITY_MIN_COSINE, required=False):
+    """
+    Сравнивает эмбеддинги `model` с эталонными (при обрезке эталон обрезается и нормируется так же).
+    Если сходство хотя бы одного текста ниже `min_cosine`, выбрасывает RuntimeError.
+    Если эталона нет (или он посчитан другой моделью), с `required` выбрасывает RuntimeError,
+    иначе пишет предупреждение и возвращает None.
+    """
+    if not os.path.exists(path):
+        _missing_reference(f"Файл эталонных эмбеддингов {path} не найден.", required)
+        return None
+    with np.load(path, allow_pickle=False) as data:
+        if str(data['model']) != EMBEDDING_MODEL_NAME:
+            _missing_reference(f"Эталонные эмбеддинги {path} посчитаны другой моделью.", required)
+            return None
+        texts, reference = data['texts'].tolist(), data['vectors']
+
+    vectors = np.asarray(model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+    reference = reference[:, :vectors.shape[1]]
+    reference = reference / np.maximum(np.linalg.norm(reference, axis=1, keepdims=True), 1e-12)
+    vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    cosines = np.sum(reference * vectors, axis=1)
+
+    # Порядок соседей важнее абсолютных значений: сравниваем top-1 по матрице сходства текстов
+    same_neighbours = float(np.mean(
+        np.argsort(-(reference @ reference.T), axis=1)[:, 1] == np.argsort(-(vectors @ vectors.T), axis=1)[:, 1]
+    ))
+    stats = {
+        'min_cosine': float(cosines.min()),
+        'mean_cosine': float(cosines.mean()),
+        'same_nearest_neighbour': same_neighbours,
+    }
+    logger.info(f"Проверка эмбеддингов против эталона: {stats}")
+    if stats['min_cosine'] < min_cosine:
+        raise RuntimeError(
+            f"Эмбеддинги бэкенда расходятся с эталоном: минимальное косинусное сходство "
+            f"{stats['min_cosine']:.4f} < {min_cosine}."
+        )
+    return stats
+
+def main(argv=None):
+    """
+    Проверка совпадения бэкенда с эталоном:
+    `python -m src.embedding_backends --write-reference` считает эталон моделью fp32 (один раз),
+    `python -m src.embedding_backends --check` сравнивает с ним выбранный бэкенд и замеряет скорость.
+    """
+    import argparse
+    from src.logger_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Эталонные эмбеддинги и проверка бэкенда эмбеддинг-модели.")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--write-reference', action='store_true', help="посчитать эталон моделью fp32")
+    group.add_argument('--check', action='store_true', help="сравнить выбранный бэкенд с эталоном и замерить скорость")
+    parser.add_argument('--repeats', type=int, default=20, help="повторов при замере скорости")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    if args.write_reference:
+        write_parity_reference()
+        return 0
+
+    model = load_embedding_model()
+    try:
+        stats = check_parity(model, required=True)
+    except RuntimeError as e:
+        logger.error(str(e))
+        return 1
+    model.encode(PARITY_TEXTS[:1])
+    started = time.perf_counter()
+    for i in range(args.repeats):
+        model.encode([PARITY_TEXTS[i % len(PARITY_TEXTS)]])
+    query_ms = (time.perf_counter() - started) / args.repeats * 1000
+    started = time.perf_counter()
+    model.encode(PARITY_TEXTS * 4)
+    batch_ms = (time.perf_counter() - started) * 1000
+    print(f"backend={EMBEDDING_BACKEND} dim={EMBEDDING_TRUNCATE_DIM or 'full'} threads={EMBEDDING_NUM_THREADS or 'default'}")
+    print(f"min_cosine={stats['min_cosine']:.4f} mean_cosine={stats['mean_cosine']:.4f} "
+          f"same_nearest_neighbour={stats['same_nearest_neighbour']:.2f}")
+    print(f"query_ms={query_ms:.1f} batch_{len(PARITY_TEXTS) * 4}_ms={batch_ms:.1f}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
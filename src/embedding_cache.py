@@ -0,0 +1,140 @@
+import os
+import re
+import json
+import hashlib
+import logging
+import threading
+import numpy as np
+from src.config import EMBEDDING_CACHE_DIR, EMBEDDING_NAMESPACE
+
+logger = logging.getLogger(__name__)
+
+# Начальная вместимость матрицы эмбеддингов (в строках); при заполнении она удваивается
+INITIAL_CAPACITY = 1024
+
+def text_hash(text: str) -> str:
+    """Возвращает ключ кэша для текста (SHA-256 его содержимого)."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Персистентный кэш эмбеддингов на диске.
+
+    Векторы хранятся в отображаемой в память матрице float32 (`vectors.f32`),
+    а соответствие "хэш текста -> номер строки" — в `index.json`.
+    Кэш разделен по пространствам имен (по умолчанию — модель, бэкенд инференса и размерность),
+    чтобы векторы разных моделей никогда не смешивались.
+    """
+
+    def __init__(self, cache_dir=EMBEDDING_CACHE_DIR, namespace=EMBEDDING_NAMESPACE):
+        safe_namespace = re.sub(r'[^\w.-]+', '__', namespace)
+        self.path = os.path.join(cache_dir, safe_namespace)
+        self.vectors_path = os.path.join(self.path, 'vectors.f32')
+        self.index_path = os.path.join(self.path, 'index.json')
+        self._lock = threading.RLock()
+        self._index = {}
+        self._dim = None
+        self._rows = 0
+        self._vectors = None
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path) or not os.path.exists(self.vectors_path):
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            dim, rows = int(data['dim']), int(data['rows'])
+            capacity = os.path.getsize(self.vectors_path) // (dim * 4)
+            if capacity < rows:
+                raise ValueError(f"файл векторов содержит {capacity} строк, ожидалось не менее {rows}")
+            self._dim, self._rows, self._index = dim, rows, data['index']
+            if capacity:
+                self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(capacity, dim))
+            logger.info(f"Кэш эмбеддингов загружен из {self.path}: {rows} векторов (размерность {dim}).")
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Кэш эмбеддингов в {self.path} поврежден и будет пересоздан: {e}")
+            self._index, self._dim, self._rows, self._vectors = {}, None, 0, None
+
+    def __len__(self):
+        return self._rows
+
+    def _ensure_capacity(self, rows_needed):
+        capacity = self._vectors.shape[0] if self._vectors is not None else 0
+        if rows_needed <= capacity:
+            return
+        new_capacity = max(rows_needed, capacity * 2, INITIAL_CAPACITY)
+        if self._vectors is not None:
+            self._vectors.flush()
+            self._vectors = None
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.vectors_path, 'ab') as f:
+            f.truncate(new_capacity * self._dim * 4)
+        self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r+', shape=(new_capacity, self._dim))
+
+    def get_many(self, texts):
+        """Возвращает список векторов (или None для отсутствующих в кэше текстов)."""
+        with self._lock:
+            result = []
+            for text in texts:
+                row = self._index.get(text_hash(text))
+                result.append(np.array(self._vectors[row]) if row is not None else None)
+            return result
+
+    def put_many(self, texts, vectors):
+        """Добавляет векторы в кэш. Уже закэшированные тексты пропускаются."""
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if not len(texts):
+            return
+        with self._lock:
+            if self._dim is None:
+                self._dim = vectors.shape[1]
+            elif vectors.shape[1] != self._dim:
+                raise ValueError(f"Размерность векторов {vectors.shape[1]} не совпадает с размерностью кэша {self._dim}.")
+            for text, vector in zip(texts, vectors):
+                key = text_hash(text)
+                if key in self._index:
+                    continue
+                self._ensure_capacity(self._rows + 1)
+                self._vectors[self._rows] = vector
+                self._index[key] = self._rows
+                self._rows += 1
+                self._dirty = True
+
+    def flush(self):
+        """Сбрасывает векторы на диск и атомарно сохраняет индекс."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._vectors.flush()
+            tmp_path = f"{self.index_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'dim': self._dim, 'rows': self._rows, 'index': self._index}, f)
+            os.replace(tmp_path, self.index_path)
+            self._dirty = False
+
+def encode_with_cache(model, texts, cache=None, store=True, **encode_kwargs):
+    """
+    Возвращает эмбеддинги текстов, вызывая модель только для отсутствующих в кэше.
+    При `store=False` кэш используется только для чтения (например, на пути запроса).
+    """
+    texts = list(texts)
+    if cache is None:
+        return np.asarray(model.encode(texts, convert_to_numpy=True, **encode_kwargs), dtype=np.float32)
+
+    cached = cache.get_many(texts)
+    missing = [i for i, vector in enumerate(cached) if vector is None]
+    if missing:
+        missing_texts = [texts[i] for i in missing]
+        fresh = np.asarray(model.encode(missing_texts, convert_to_numpy=True, **encode_kwargs), dtype=np.float32)
+        for i, vector in zip(missing, fresh):
+            cached[i] = vector
+        if store:
+            cache.put_many(missing_texts, fresh)
+            cache.flush()
+    if len(texts) > 1:
+        logger.info(f"Кэш эмбеддингов: найдено {len(texts) - len(missing)} из {len(texts)}, вычислено {len(missing)}.")
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(cached)
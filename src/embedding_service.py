@@ -0,0 +1,228 @@
+import os
+import json
+import time
+import queue
+import socket
+import signal
+import struct
+import logging
+import threading
+import socketserver
+import numpy as np
+from src.config import (
+    EMBEDDING_SERVICE_SOCKET, EMBEDDING_SERVICE_POOL_SIZE, EMBEDDING_SERVICE_TIMEOUT_SECONDS,
+    EMBEDDING_SERVICE_TIMEOUT_PER_TEXT_SECONDS,
+    QUERY_EMBEDDING_SNAPSHOT_PATH, WARMUP_QUERIES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Кадр протокола: 4 байта длины (big-endian) и тело. Запрос — JSON `{"texts": [...]}`, ответ — заголовок
+# `{"shape": [n, dim]}` (или `{"error": "..."}`) и следующий за ним кадр с матрицей float32 (little-endian)
+_LENGTH = struct.Struct('>I')
+
+def _recv_exact(sock, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Соединение с сервисом эмбеддингов закрыто.")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+def send_frame(sock, payload: bytes):
+    sock.sendall(_LENGTH.pack(len(payload)) + payload)
+
+def recv_frame(sock) -> bytes:
+    (size,) = _LENGTH.unpack(_recv_exact(sock, _LENGTH.size))
+    return _recv_exact(sock, size)
+
+class RemoteEmbedder:
+    """
+    Клиент сервиса эмбеддингов. Метод `encode` совместим по сигнатуре с `SentenceTransformer.encode`,
+    поэтому клиент подставляется везде, где ожидается модель (в том числе в `QueryEmbedder`).
+    Соединения переиспользуются (пул до `pool_size` простаивающих). При ошибке подключения или
+    обрыве соединения запрос повторяется один раз на новом соединении; после таймаута ответа
+    не повторяется, чтобы сервис не считал тот же батч дважды. Таймаут батча документов
+    растет с его размером (`timeout_per_text` на текст).
+    """
+
+    def __init__(self, socket_path=EMBEDDING_SERVICE_SOCKET, pool_size=EMBEDDING_SERVICE_POOL_SIZE,
+                 timeout=EMBEDDING_SERVICE_TIMEOUT_SECONDS, timeout_per_text=EMBEDDING_SERVICE_TIMEOUT_PER_TEXT_SECONDS):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.timeout_per_text = timeout_per_text
+        self._idle = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _request(self, sock, texts) -> np.ndarray:
+        send_frame(sock, json.dumps({'texts': texts}, ensure_ascii=False).encode('utf-8'))
+        header = json.loads(recv_frame(sock))
+        if 'error' in header:
+            raise RuntimeError(f"Сервис эмбеддингов вернул ошибку: {header['error']}")
+        rows, dim = header['shape']
+        return np.frombuffer(recv_frame(sock), dtype='<f4').reshape(rows, dim)
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        """Возвращает эмбеддинги текстов (матрица float32). Одиночная строка дает вектор."""
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        timeout = max(self.timeout, len(texts) * self.timeout_per_text)
+        for attempt in (1, 2):
+            try:
+                sock = self._idle.get_nowait()
+            except queue.Empty:
+                try:
+                    sock = self._connect()
+                except OSError:
+                    if attempt == 2:
+                        raise
+                    time.sleep(0.05)
+                    continue
+            try:
+                sock.settimeout(timeout)
+                vectors = self._request(sock, texts)
+            except RuntimeError:
+                # Ошибка расчета на стороне сервиса: соединение исправно и возвращается в пул
+                self._release(sock)
+                raise
+            except ConnectionError as e:
+                # Обрыв (в том числе закрытое сервисом простаивающее соединение): запрос не был обработан
+                sock.close()
+                if attempt == 2:
+                    raise
+                logger.warning(f"Соединение с сервисом эмбеддингов оборвалось ({e}). Повтор на новом соединении.")
+                continue
+            except (OSError, ValueError):
+                # Таймаут ответа или поврежденный кадр: сервис мог уже считать батч, повтор удвоил бы работу
+                sock.close()
+                raise
+            self._release(sock)
+            return vectors[0] if single else vectors
+
+    def _release(self, sock):
+        try:
+            self._idle.put_nowait(sock)
+        except queue.Full:
+            sock.close()
+
+    def wait_until_ready(self, timeout: float) -> bool:
+        """Ждет, пока сервис начнет отвечать (сервис может еще загружать модель)."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.encode([])
+                return True
+            except (OSError, ConnectionError):
+                if time.monotonic() >= deadline:
+                    return False
+                time.sleep(0.5)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+class _EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    """Обслуживает одно соединение воркера: запросы идут последовательно, пока клиент не закроет сокет."""
+
+    def handle(self):
+        embedder = self.server.embedder
+        while True:
+            try:
+                request = json.loads(recv_frame(self.request))
+            except (ConnectionError, OSError):
+                return
+            except ValueError as e:
+                send_frame(self.request, json.dumps({'error': f"некорректный запрос: {e}"}).encode('utf-8'))
+                return
+            try:
+                texts = [str(text) for text in request.get('texts', [])]
+                if not texts:
+                    vectors = np.empty((0, 0), dtype='<f4')
+                elif len(texts) > embedder.max_batch_size:
+                    # Крупные батчи (загрузка документов) считаются напрямую, не вытесняя запросы из LRU-кэша
+                    vectors = np.ascontiguousarray(embedder.model.encode(texts, convert_to_numpy=True), dtype='<f4')
+                else:
+                    vectors = np.ascontiguousarray(embedder.encode(texts), dtype='<f4')
+                send_frame(self.request, json.dumps({'shape': list(vectors.shape)}).encode('utf-8'))
+                send_frame(self.request, vectors.tobytes())
+            except (ConnectionError, OSError):
+                return
+            except Exception as e:
+                logger.error(f"Ошибка расчета эмбеддингов для {len(request.get('texts', []))} текстов: {e}", exc_info=True)
+                send_frame(self.request, json.dumps({'error': str(e)}, ensure_ascii=False).encode('utf-8'))
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Unix-сокет сервер эмбеддингов: модель загружается один раз на все воркеры сервера.
+    Поток на соединение, общий `QueryEmbedder` на всех: запросы воркеров объединяются
+    в общие батчи, а LRU-кэш запросов у сервиса один.
+    """
+    daemon_threads = True
+    # Очередь входящих соединений: все воркеры подключаются одновременно при старте
+    request_queue_size = 128
+
+    def __init__(self, socket_path, embedder):
+        self.embedder = embedder
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)  # сокет от предыдущего запуска
+        os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+        super().__init__(socket_path, _EmbeddingRequestHandler)
+        os.chmod(socket_path, 0o660)
+
+def main(argv=None):
+    """
+    Запуск сервиса: `python -m src.embedding_service [--socket PATH]`. Воркеры сервера подключаются
+    к нему через `RemoteEmbedder`, если задан `EMBEDDING_SERVICE_SOCKET`.
+    """
+    import argparse
+    from src.logger_config import setup_logging
+    from src.data_processor import initialize_embedding_model
+    from src.embedding_cache import EmbeddingCache
+    from src.embedder import QueryEmbedder
+
+    parser = argparse.ArgumentParser(description="Сервис эмбеддингов для воркеров сервера (Unix-сокет).")
+    parser.add_argument('--socket', default=EMBEDDING_SERVICE_SOCKET, help="путь к Unix-сокету")
+    args = parser.parse_args(argv)
+    if not args.socket:
+        parser.error("не задан путь к сокету (--socket или EMBEDDING_SERVICE_SOCKET)")
+
+    setup_logging()
+    model = initialize_embedding_model()
+    if WARMUP_QUERIES:
+        model.encode(WARMUP_QUERIES)
+    embedder = QueryEmbedder(model, cache=EmbeddingCache())
+    embedder.load_snapshot(QUERY_EMBEDDING_SNAPSHOT_PATH)
+
+    server = EmbeddingServer(args.socket, embedder)
+    # serve_forever блокирует главный поток, поэтому остановка выполняется из отдельного
+    signal.signal(signal.SIGTERM, lambda *_: threading.Thread(target=server.shutdown).start())
+    logger.info(f"Сервис эмбеддингов слушает {args.socket}.")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        embedder.save_snapshot(QUERY_EMBEDDING_SNAPSHOT_PATH)
+        embedder.close()
+        logger.info("Сервис эмбеддингов остановлен.")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,82 +1,369 @@
 import sqlite3
-import datetime
+import asyncio
+import time
 import logging
+import threading
+import queue
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Dict
-from src.config import HISTORY_DB_PATH, HISTORY_MESSAGES_TO_KEEP
+from src import metrics
+from src.request_context import record_stage
+from src.config import (
+    HISTORY_DB_PATH, HISTORY_MESSAGES_TO_KEEP, HISTORY_READ_POOL_SIZE,
+    HISTORY_WRITE_BATCH_SIZE, HISTORY_WRITE_FLUSH_INTERVAL_MS,
+    HISTORY_SESSION_TTL_SECONDS, HISTORY_PRUNE_INTERVAL_SECONDS, HISTORY_SUMMARY_ENABLED,
+    HISTORY_UNSUMMARIZED_MAX_MESSAGES,
+)
 
 logger = logging.getLogger(__name__)
 
+INSERT_MESSAGE_SQL = "INSERT INTO conversations (session_id, role, content) VALUES (?, ?, ?)"
+# id монотонно растет, поэтому порядок по нему совпадает с порядком записи,
+# а составной индекс (session_id, id) превращает выборку в обратный проход по диапазону индекса
+SELECT_HISTORY_SQL = "SELECT role, content FROM conversations WHERE session_id = ? ORDER BY id DESC LIMIT ?"
+# Сообщения сессии, еще не вошедшие в сводку (id больше последнего учтенного)
+SELECT_UNSUMMARIZED_SQL = "SELECT id, role, content FROM conversations WHERE session_id = ? AND id > ? ORDER BY id"
+SELECT_SUMMARY_SQL = "SELECT summary, last_message_id FROM session_summaries WHERE session_id = ?"
+UPSERT_SUMMARY_SQL = """
+    INSERT INTO session_summaries (session_id, summary, last_message_id, updated_at)
+    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT (session_id) DO UPDATE SET
+        summary = excluded.summary, last_message_id = excluded.last_message_id, updated_at = excluded.updated_at
+"""
+# Удаляет все сообщения, кроме последних N в каждой сессии, одним запросом. Сообщения, еще не вошедшие
+# в сводку сессии, сохраняются, пока их не больше заданного предела (второй параметр)
+TRIM_SESSIONS_SQL = """
+    DELETE FROM conversations
+    WHERE id IN (
+        SELECT id FROM (
+            SELECT c.id, ROW_NUMBER() OVER (PARTITION BY c.session_id ORDER BY c.id DESC) AS rn,
+                   COALESCE(s.last_message_id, 0) AS summarized_id
+            FROM conversations c LEFT JOIN session_summaries s ON s.session_id = c.session_id
+        )
+        WHERE rn > ? AND (id <= summarized_id OR rn > ?)
+    )
+"""
+# Удаляет сессии, последнее сообщение которых старше заданного интервала
+EXPIRE_SESSIONS_SQL = """
+    DELETE FROM conversations
+    WHERE session_id IN (
+        SELECT session_id FROM conversations
+        GROUP BY session_id
+        HAVING MAX(timestamp) < datetime('now', ?)
+    )
+"""
+# Удаляет сводки сессий, от которых не осталось сообщений
+EXPIRE_SUMMARIES_SQL = "DELETE FROM session_summaries WHERE session_id NOT IN (SELECT session_id FROM conversations)"
+# Системное сообщение со сводкой ранней части диалога
+SUMMARY_MESSAGE_TEMPLATE = "Краткое содержание предыдущей части диалога с пользователем:\n{summary}"
+
+class HistoryStore:
+    """
+    Хранилище истории диалогов в SQLite.
+
+    - база работает в режиме WAL, поэтому чтение не блокируется записью;
+    - чтение выполняется в небольшом пуле потоков, у каждого из которых свое
+      постоянное соединение (sqlite3 кэширует подготовленные выражения на соединении);
+    - запись выполняет один поток-писатель: сообщения ставятся в очередь
+      и вставляются пачками в одной транзакции (write-behind);
+    - перед чтением истории сессии с незаписанными сообщениями очередь сбрасывается,
+      так что клиент всегда видит собственные записи.
+    """
+
+    def __init__(self, db_path=HISTORY_DB_PATH, read_pool_size=HISTORY_READ_POOL_SIZE,
+                 batch_size=HISTORY_WRITE_BATCH_SIZE, flush_interval_ms=HISTORY_WRITE_FLUSH_INTERVAL_MS):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._local = threading.local()
+        self._read_pool = ThreadPoolExecutor(max_workers=read_pool_size, thread_name_prefix="history-read")
+        self._queue = queue.Queue()
+        self._pending = Counter()
+        self._pending_lock = threading.Lock()
+        self._writer = None
+        self._closed = False
+        self._stats_lock = threading.Lock()
+        self.retention_stats = {
+            'runs': 0, 'rows_trimmed': 0, 'rows_expired': 0,
+            'last_run_at': None, 'last_duration_seconds': None,
+        }
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _get_connection(self) -> sqlite3.Connection:
+        """Возвращает постоянное соединение текущего потока."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            conn.row_factory = sqlite3.Row
+            self._local.conn = conn
+        return conn
+
+    def init_db(self):
+        """Создает таблицу диалогов, если она не существует, и запускает поток-писатель."""
+        with self._connect() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    session_id TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            # Составной индекс для выборки истории сессии и очистки; он покрывает и старый индекс по session_id
+            cursor.execute("CREATE INDEX IF NOT EXISTS session_id_id_idx ON conversations (session_id, id)")
+            cursor.execute("DROP INDEX IF EXISTS session_id_idx")
+            # Сводка ранней части диалога: одна строка на сессию, last_message_id — последнее учтенное сообщение
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS session_summaries (
+                    session_id TEXT PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            conn.commit()
+        self._ensure_writer()
+        logger.info("База данных для истории диалогов инициализирована (режим WAL).")
+
+    def _ensure_writer(self):
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._write_loop, name="history-writer", daemon=True)
+            self._writer.start()
+
+    def _write_loop(self):
+        conn = self._connect()
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                batch = [item]
+                # Собираем пачку: все, что уже в очереди, но не дольше flush_interval
+                try:
+                    while len(batch) < self.batch_size:
+                        item = self._queue.get(timeout=self.flush_interval)
+                        if item is None:
+                            self._queue.put(None)
+                            break
+                        batch.append(item)
+                except queue.Empty:
+                    pass
+                self._write_batch(conn, batch)
+        finally:
+            conn.close()
+
+    def _insert_rows(self, conn, rows):
+        """Вставляет пачку сообщений в одной транзакции; при ошибке SQLite пробует еще раз."""
+        try:
+            with conn:
+                conn.executemany(INSERT_MESSAGE_SQL, rows)
+            return
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось записать {len(rows)} сообщений в историю: {e}. Повторная попытка.")
+        try:
+            with conn:
+                conn.executemany(INSERT_MESSAGE_SQL, rows)
+            metrics.HISTORY_WRITE_FAILURES_TOTAL.inc(outcome='retried')
+        except sqlite3.Error as e:
+            metrics.HISTORY_WRITE_FAILURES_TOTAL.inc(outcome='dropped')
+            logger.error(f"Не удалось записать {len(rows)} сообщений в историю: {e}", exc_info=True)
+
+    def _write_batch(self, conn, batch):
+        rows = [item for item in batch if isinstance(item, tuple)]
+        markers = [item for item in batch if isinstance(item, threading.Event)]
+        if rows:
+            started = time.perf_counter()
+            self._insert_rows(conn, rows)
+            record_stage('history_write_batch', time.perf_counter() - started)
+            with self._pending_lock:
+                for session_id, _, _ in rows:
+                    self._pending[session_id] -= 1
+                    if self._pending[session_id] <= 0:
+                        del self._pending[session_id]
+        for marker in markers:
+            marker.set()
+
+    def add_message(self, session_id: str, role: str, content: str):
+        """Ставит сообщение в очередь на запись. Вызов не блокирует поток."""
+        if self._closed:
+            raise RuntimeError("Хранилище истории закрыто.")
+        self._ensure_writer()
+        with self._pending_lock:
+            self._pending[session_id] += 1
+        self._queue.put((session_id, role, content))
+
+    def flush(self, timeout=None) -> bool:
+        """Дожидается записи всех сообщений, поставленных в очередь до вызова."""
+        if self._writer is None:
+            return True
+        marker = threading.Event()
+        self._queue.put(marker)
+        return marker.wait(timeout)
+
+    def _flush_session(self, session_id: str):
+        """Дожидается записи сообщений сессии, если они еще в очереди."""
+        with self._pending_lock:
+            has_pending = self._pending[session_id] > 0
+        if has_pending:
+            self.flush()
+
+    def get_history(self, session_id: str, limit: int = 14, include_summary: bool = False) -> List[Dict[str, str]]:
+        """
+        Извлекает последние `limit` сообщений из истории диалога для указанного session_id.
+        По умолчанию лимит 14 (7 вопросов + 7 ответов). С `include_summary` перед ними
+        добавляется системное сообщение со сводкой более ранней части диалога, если она есть.
+        """
+        self._flush_session(session_id)
+        conn = self._get_connection()
+        cursor = conn.execute(SELECT_HISTORY_SQL, (session_id, limit))
+        # Сообщения извлекаются в обратном порядке (DESC), поэтому их нужно перевернуть
+        messages = [{"role": row["role"], "content": row["content"]} for row in reversed(cursor.fetchall())]
+        if include_summary:
+            row = conn.execute(SELECT_SUMMARY_SQL, (session_id,)).fetchone()
+            if row is not None:
+                messages.insert(0, {"role": "system", "content": SUMMARY_MESSAGE_TEMPLATE.format(summary=row["summary"])})
+        return messages
+
+    async def aget_history(self, session_id: str, limit: int = 14, include_summary: bool = False) -> List[Dict[str, str]]:
+        """Асинхронная версия `get_history`: чтение выполняется в пуле соединений."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._read_pool, self.get_history, session_id, limit, include_summary)
+
+    def get_unsummarized(self, session_id: str, keep_last: int):
+        """
+        Возвращает текущую сводку сессии (или None) и сообщения, которые еще не вошли в нее
+        и уже вышли за окно последних `keep_last` сообщений: список кортежей (id, role, content).
+        """
+        self._flush_session(session_id)
+        conn = self._get_connection()
+        row = conn.execute(SELECT_SUMMARY_SQL, (session_id,)).fetchone()
+        summary, summarized_id = (row["summary"], row["last_message_id"]) if row is not None else (None, 0)
+        rows = conn.execute(SELECT_UNSUMMARIZED_SQL, (session_id, summarized_id)).fetchall()
+        rows = rows[:max(len(rows) - keep_last, 0)]
+        return summary, [(row["id"], row["role"], row["content"]) for row in rows]
+
+    def save_summary(self, session_id: str, summary: str, last_message_id: int):
+        """Сохраняет сводку сессии, учитывающую сообщения до `last_message_id` включительно."""
+        conn = self._get_connection()
+        with conn:
+            conn.execute(UPSERT_SUMMARY_SQL, (session_id, summary, last_message_id))
+
+    async def aadd_message(self, session_id: str, role: str, content: str):
+        """Асинхронная версия `add_message` (постановка в очередь не блокирует цикл событий)."""
+        self.add_message(session_id, role, content)
+
+    def prune_history(self, messages_to_keep=HISTORY_MESSAGES_TO_KEEP, session_ttl_seconds=HISTORY_SESSION_TTL_SECONDS,
+                      unsummarized_to_keep=None):
+        """
+        Очищает историю одним set-based проходом:
+        - удаляет сессии, в которых не было сообщений дольше `session_ttl_seconds` (если задан), и их сводки;
+        - в остальных сессиях оставляет только последние `messages_to_keep` сообщений. Если включена
+          сводка диалога, сообщения, еще не вошедшие в нее, удаляются, только когда их больше
+          `unsummarized_to_keep` (по умолчанию HISTORY_UNSUMMARIZED_MAX_MESSAGES).
+        Возвращает общее количество удаленных записей.
+        """
+        if unsummarized_to_keep is None:
+            unsummarized_to_keep = HISTORY_UNSUMMARIZED_MAX_MESSAGES if HISTORY_SUMMARY_ENABLED else messages_to_keep
+        unsummarized_to_keep = max(unsummarized_to_keep, messages_to_keep)
+        self.flush()
+        started = time.monotonic()
+        conn = self._connect()
+        try:
+            with conn:
+                expired = 0
+                if session_ttl_seconds:
+                    expired = conn.execute(EXPIRE_SESSIONS_SQL, (f"-{int(session_ttl_seconds)} seconds",)).rowcount
+                    conn.execute(EXPIRE_SUMMARIES_SQL)
+                trimmed = conn.execute(TRIM_SESSIONS_SQL, (messages_to_keep, unsummarized_to_keep)).rowcount
+        finally:
+            conn.close()
+        duration = time.monotonic() - started
+
+        with self._stats_lock:
+            self.retention_stats['runs'] += 1
+            self.retention_stats['rows_trimmed'] += trimmed
+            self.retention_stats['rows_expired'] += expired
+            self.retention_stats['last_run_at'] = time.time()
+            self.retention_stats['last_duration_seconds'] = duration
+        metrics.HISTORY_RETENTION_ROWS_TRIMMED.inc(trimmed)
+        metrics.HISTORY_RETENTION_ROWS_EXPIRED.inc(expired)
+        metrics.HISTORY_RETENTION_LAST_DURATION.set(duration)
+
+        total_deleted = trimmed + expired
+        if total_deleted > 0:
+            logger.info(
+                f"Очистка истории: удалено {total_deleted} старых записей за {duration:.3f} с "
+                f"(просроченных сессий: {expired} записей; сверх лимита {messages_to_keep} в сессии: {trimmed})."
+            )
+        return total_deleted
+
+    async def run_retention(self, interval_seconds=HISTORY_PRUNE_INTERVAL_SECONDS):
+        """
+        Фоновая задача: периодически выполняет `prune_history` в пуле потоков.
+        Работает до отмены задачи.
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(interval_seconds)
+            try:
+                await loop.run_in_executor(None, self.prune_history)
+            except Exception as e:
+                metrics.HISTORY_RETENTION_ERRORS_TOTAL.inc()
+                logger.error(f"Ошибка фоновой очистки истории: {e}", exc_info=True)
+
+    def close(self):
+        """Записывает оставшиеся сообщения и останавливает фоновые потоки."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join(timeout=10)
+        self._read_pool.shutdown(wait=True)
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+def get_history_store() -> HistoryStore:
+    """Возвращает общее для процесса хранилище истории."""
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            _default_store = HistoryStore()
+        return _default_store
+
+def set_history_store(store: HistoryStore):
+    """Подменяет общее хранилище истории (например, временной базой в бенчмарках)."""
+    global _default_store
+    with _default_store_lock:
+        _default_store = store
+
 def init_db():
     """Инициализирует базу данных и создает таблицу диалогов, если она не существует."""
-    with sqlite3.connect(HISTORY_DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS conversations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                session_id TEXT NOT NULL,
-                role TEXT NOT NULL,
-                content TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        # Индекс для ускорения поиска по session_id
-        cursor.execute("CREATE INDEX IF NOT EXISTS session_id_idx ON conversations (session_id)")
-        conn.commit()
-    logger.info("База данных для истории диалогов инициализирована.")
+    get_history_store().init_db()
 
 def add_message(session_id: str, role: str, content: str):
     """Добавляет сообщение в историю диалога."""
-    with sqlite3.connect(HISTORY_DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute(
-            "INSERT INTO conversations (session_id, role, content) VALUES (?, ?, ?)",
-            (session_id, role, content)
-        )
-        conn.commit()
+    get_history_store().add_message(session_id, role, content)
 
 def get_history(session_id: str, limit: int = 14) -> List[Dict[str, str]]:
     """
     Извлекает последние `limit` сообщений из истории диалога для указанного session_id.
     По умолчанию лимит 14 (7 вопросов + 7 ответов).
     """
-    with sqlite3.connect(HISTORY_DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute(
-            "SELECT role, content FROM conversations WHERE session_id = ? ORDER BY timestamp DESC LIMIT ?",
-            (session_id, limit)
-        )
-        # Сообщения извлекаются в обратном порядке (DESC), поэтому их нужно перевернуть
-        history = [{"role": row["role"], "content": row["content"]} for row in reversed(cursor.fetchall())]
-        return history
+    return get_history_store().get_history(session_id, limit)
 
 def prune_history():
     """
-    Для каждой сессии оставляет только последние `messages_to_keep` сообщений, удаляя более старые.
+    Удаляет просроченные сессии и оставляет в каждой сессии только последние
+    `HISTORY_MESSAGES_TO_KEEP` сообщений.
     """
-    with sqlite3.connect(HISTORY_DB_PATH) as conn:
-        cursor = conn.cursor()
-        # Сначала получаем все уникальные session_id
-        cursor.execute("SELECT DISTINCT session_id FROM conversations")
-        sessions = [row[0] for row in cursor.fetchall()]
-        
-        total_deleted = 0
-        for session_id in sessions:
-            # Для каждой сессии находим ID сообщений, которые нужно удалить
-            # (все, кроме последних N)
-            cursor.execute("""
-                DELETE FROM conversations 
-                WHERE id IN (
-                    SELECT id FROM conversations 
-                    WHERE session_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT -1 OFFSET ?
-                )
-            """, (session_id, HISTORY_MESSAGES_TO_KEEP))
-            total_deleted += cursor.rowcount
-        
-        conn.commit()
-
-    if total_deleted > 0:
-        logger.info(f"Очистка истории: удалено {total_deleted} старых записей (оставлено по {HISTORY_MESSAGES_TO_KEEP} в каждой сессии).")
-    return total_deleted 
\ No newline at end of file
+    return get_history_store().prune_history()
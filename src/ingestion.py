@@ -0,0 +1,276 @@
+import os
+import json
+import hashlib
+import logging
+import datetime
+import uuid
+from src.config import (
+    DOCS_DIR, INGEST_MANIFEST_PATH, KB_VERSION_PATH, EMBEDDING_NAMESPACE, CHUNK_SIZE, CHUNK_OVERLAP, VECTOR_STORE_BACKEND,
+)
+from src.data_processor import iter_pdf_documents, describe_document
+from src.vector_store import make_chunk_ids, populate_collection, delete_chunks, update_chunk_metadata
+
+logger = logging.getLogger(__name__)
+
+# Версия формата манифеста. При изменении формата все файлы будут загружены заново.
+# 2: в метаданные чанков добавлены позиция в файле (`chunk_index`, `start_index`)
+# 3: добавлены страницы, тип и номер документа, номер статьи (`page_start`, `page_end`,
+#    `doc_type`, `doc_number`, `article`, `article_last`)
+MANIFEST_VERSION = 3
+
+def _current_settings():
+    """Возвращает настройки, от которых зависит содержимое коллекции."""
+    return {
+        'manifest_version': MANIFEST_VERSION,
+        'embedding_model': EMBEDDING_NAMESPACE,
+        'chunk_size': CHUNK_SIZE,
+        'chunk_overlap': CHUNK_OVERLAP,
+        'vector_store_backend': VECTOR_STORE_BACKEND,
+    }
+
+def compute_file_hash(file_path) -> str:
+    """Вычисляет SHA-256 содержимого файла, читая его блоками."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest(manifest_path=INGEST_MANIFEST_PATH) -> dict:
+    """
+    Загружает манифест загруженных документов.
+    Если манифест отсутствует или поврежден, возвращает пустой манифест.
+    """
+    if not os.path.exists(manifest_path):
+        return {'settings': None, 'files': {}}
+    try:
+        with open(manifest_path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        manifest.setdefault('settings', None)
+        manifest.setdefault('files', {})
+        return manifest
+    except (OSError, ValueError) as e:
+        logger.error(f"Не удалось прочитать манифест {manifest_path}: {e}. Будет выполнена полная загрузка.")
+        return {'settings': None, 'files': {}}
+
+def save_manifest(manifest, manifest_path=INGEST_MANIFEST_PATH):
+    """Атомарно сохраняет манифест на диск (через временный файл)."""
+    os.makedirs(os.path.dirname(manifest_path), exist_ok=True)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+def _commit(collection, manifest, manifest_path):
+    """Фиксирует изменения хранилища векторов, затем манифест: манифест не должен опережать хранилище."""
+    collection.persist()
+    save_manifest(manifest, manifest_path)
+
+def read_kb_version(version_path=KB_VERSION_PATH):
+    """Возвращает текущую версию базы знаний или None, если база еще не загружалась."""
+    try:
+        with open(version_path, 'r', encoding='utf-8') as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def write_kb_version(version_path=KB_VERSION_PATH) -> str:
+    """Записывает новую версию базы знаний. Кэши, зависящие от содержимого базы, по ней сбрасываются."""
+    version = f"{datetime.datetime.now(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(os.path.dirname(version_path), exist_ok=True)
+    tmp_path = f"{version_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+    os.replace(tmp_path, version_path)
+    logger.info(f"Версия базы знаний: {version}")
+    return version
+
+def _reset_collection(collection, lexical_index=None):
+    """Удаляет из коллекции все чанки (используется при смене настроек или устаревших ID)."""
+    existing_ids = collection.get(include=[]).get('ids', [])
+    delete_chunks(collection, existing_ids)
+    if lexical_index is not None:
+        lexical_index.clear()
+
+def ensure_lexical_index(collection, lexical_index, batch_size=1000):
+    """
+    Загружает лексический индекс с диска, а если его нет или он не совпадает
+    с коллекцией по количеству чанков — перестраивает по содержимому коллекции.
+    """
+    if lexical_index.load() and lexical_index.doc_count == collection.count():
+        return
+    logger.info("Лексический индекс отсутствует или устарел. Перестроение по коллекции ChromaDB...")
+    lexical_index.clear()
+    offset = 0
+    while True:
+        batch = collection.get(include=['documents'], limit=batch_size, offset=offset)
+        if not batch['ids']:
+            break
+        lexical_index.add_many(batch['ids'], batch['documents'])
+        offset += len(batch['ids'])
+    lexical_index.save()
+
+def sync_collection(collection, model, docs_dir=DOCS_DIR, manifest_path=INGEST_MANIFEST_PATH, cache=None,
+                    lexical_index=None, version_path=KB_VERSION_PATH) -> dict:
+    """
+    Инкрементально синхронизирует коллекцию ChromaDB с PDF-файлами в папке.
+
+    - новые и измененные файлы нарезаются заново, эмбеддинги считаются только для новых чанков;
+    - чанки удаленных файлов и исчезнувшие чанки измененных файлов удаляются;
+    - неизмененные файлы (по SHA-256) пропускаются;
+    - при переданном `cache` эмбеддинги ранее встречавшихся чанков берутся из кэша;
+    - при переданном `lexical_index` индекс BM25 обновляется теми же изменениями;
+    - если содержимое коллекции изменилось, записывается новая версия базы знаний.
+
+    Возвращает статистику синхронизации.
+    """
+    stats = {
+        'added_files': 0, 'updated_files': 0, 'removed_files': 0, 'unchanged_files': 0,
+        'added_chunks': 0, 'deleted_chunks': 0, 'reset': False, 'kb_version': None,
+    }
+    logger.info("─" * 50)
+    logger.info(f"Синхронизация базы знаний с папкой: {docs_dir}")
+
+    manifest = load_manifest(manifest_path)
+    settings = _current_settings()
+    if manifest['settings'] != settings:
+        if manifest['files'] or collection.count() > 0:
+            logger.info("Настройки загрузки изменились или манифест отсутствует. Коллекция будет перестроена.")
+            _reset_collection(collection, lexical_index)
+            stats['reset'] = True
+        manifest = {'settings': settings, 'files': {}}
+        _commit(collection, manifest, manifest_path)
+
+    files = manifest['files']
+    pdf_names = sorted(name for name in os.listdir(docs_dir) if name.endswith(".pdf"))
+
+    # 1. Удаляем чанки файлов, которых больше нет в папке
+    for filename in sorted(set(files) - set(pdf_names)):
+        removed_ids = files.pop(filename).get('chunk_ids', [])
+        delete_chunks(collection, removed_ids)
+        if lexical_index is not None:
+            lexical_index.remove(removed_ids)
+        stats['removed_files'] += 1
+        stats['deleted_chunks'] += len(removed_ids)
+        _commit(collection, manifest, manifest_path)
+        logger.info(f"  - Файл удален из базы знаний: {filename}")
+
+    # 2. Определяем новые и измененные файлы
+    changed = {}
+    for filename in pdf_names:
+        file_hash = compute_file_hash(os.path.join(docs_dir, filename))
+        entry = files.get(filename)
+        if entry and entry.get('hash') == file_hash:
+            stats['unchanged_files'] += 1
+        else:
+            changed[os.path.join(docs_dir, filename)] = file_hash
+
+    # 3. Параллельно нарезаем измененные файлы и записываем их по мере готовности
+    for file_path, documents in iter_pdf_documents(changed):
+        filename = os.path.basename(file_path)
+        entry = files.get(filename)
+        chunks = [doc.page_content for doc in documents]
+        chunk_ids = make_chunk_ids(chunks, source=filename)
+        document_info = describe_document(filename)
+        metadatas = [
+            {'source': filename, 'chunk_index': i, **document_info, **doc.metadata}
+            for i, doc in enumerate(documents)
+        ]
+        old_ids = set(entry.get('chunk_ids', [])) if entry else set()
+
+        stale_ids = old_ids - set(chunk_ids)
+        delete_chunks(collection, stale_ids)
+        if lexical_index is not None:
+            lexical_index.remove(stale_ids)
+
+        new_positions = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id not in old_ids]
+        if new_positions:
+            populate_collection(
+                collection,
+                (chunks[i] for i in new_positions),
+                model,
+                ids=[chunk_ids[i] for i in new_positions],
+                metadatas=[metadatas[i] for i in new_positions],
+                cache=cache,
+            )
+            if lexical_index is not None:
+                lexical_index.add_many([chunk_ids[i] for i in new_positions], [chunks[i] for i in new_positions])
+
+        # Сохранившиеся чанки измененного файла могли сместиться: обновляем их позиции
+        kept_positions = [i for i, chunk_id in enumerate(chunk_ids) if chunk_id in old_ids]
+        if kept_positions:
+            update_chunk_metadata(collection, [chunk_ids[i] for i in kept_positions],
+                                  [metadatas[i] for i in kept_positions])
+
+        files[filename] = {
+            'hash': changed[file_path],
+            'chunk_ids': chunk_ids,
+            'ingested_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        _commit(collection, manifest, manifest_path)
+
+        stats['updated_files' if entry else 'added_files'] += 1
+        stats['added_chunks'] += len(new_positions)
+        stats['deleted_chunks'] += len(stale_ids)
+
+    # Индекс BM25 сохраняется один раз; после сбоя он будет перестроен в ensure_lexical_index
+    if lexical_index is not None:
+        lexical_index.save()
+
+    changed_anything = stats['reset'] or stats['added_files'] or stats['updated_files'] or stats['removed_files']
+    stats['kb_version'] = read_kb_version(version_path)
+    if changed_anything or stats['kb_version'] is None:
+        stats['kb_version'] = write_kb_version(version_path)
+
+    logger.info(
+        f"Синхронизация завершена: добавлено файлов {stats['added_files']}, обновлено {stats['updated_files']}, "
+        f"удалено {stats['removed_files']}, без изменений {stats['unchanged_files']}; "
+        f"новых чанков {stats['added_chunks']}, удалено чанков {stats['deleted_chunks']}."
+    )
+    logger.info("─" * 50)
+    return stats
+
+def main(argv=None):
+    """
+    Загрузка базы знаний отдельным процессом: `python -m src.ingestion [--docs-dir PATH]`.
+    Запускается до раскатки сервера, чтобы сервер при старте не пересчитывал эмбеддинги.
+    Запущенные экземпляры сервера увидят изменения после перезапуска
+    (с бэкендом 'local' хранилище векторов переоткрывается само, но индекс BM25 — только при старте).
+    """
+    import argparse
+    from src.logger_config import setup_logging
+    from src.config import HYBRID_SEARCH_ENABLED, EMBEDDING_SERVICE_SOCKET
+    from src.data_processor import initialize_embedding_model
+    from src.vector_store import get_vector_store
+    from src.embedding_cache import EmbeddingCache
+    from src.embedding_service import RemoteEmbedder
+    from src.lexical_index import LexicalIndex
+
+    parser = argparse.ArgumentParser(description="Синхронизация базы знаний с папкой PDF-документов.")
+    parser.add_argument('--docs-dir', default=DOCS_DIR, help="папка с PDF-документами")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    if not os.path.isdir(args.docs_dir) or not os.listdir(args.docs_dir):
+        logger.error(f"Папка '{args.docs_dir}' пуста или не существует. Невозможно заполнить базу знаний.")
+        return 1
+
+    collection = get_vector_store()
+    lexical_index = None
+    if HYBRID_SEARCH_ENABLED:
+        lexical_index = LexicalIndex()
+        ensure_lexical_index(collection, lexical_index)
+    model = None
+    if EMBEDDING_SERVICE_SOCKET:
+        # Если общий сервис эмбеддингов уже запущен, вторая копия модели не загружается
+        remote_embedder = RemoteEmbedder(EMBEDDING_SERVICE_SOCKET)
+        if remote_embedder.wait_until_ready(timeout=0):
+            logger.info(f"Эмбеддинги считаются сервисом эмбеддингов ({EMBEDDING_SERVICE_SOCKET}).")
+            model = remote_embedder
+    if model is None:
+        model = initialize_embedding_model()
+    sync_collection(collection, model, args.docs_dir, cache=EmbeddingCache(), lexical_index=lexical_index)
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
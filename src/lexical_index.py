@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import math
+import logging
+import threading
+from collections import Counter
+import snowballstemmer
+from src.config import LEXICAL_INDEX_PATH, BM25_K1, BM25_B, RRF_K
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файла индекса и токенизации. При изменении индекс перестраивается.
+INDEX_VERSION = 1
+
+# Составные токены вида "306-ФЗ", "4301-1", "5.1", "668н" сохраняются целиком и дополнительно по частям
+TOKEN_RE = re.compile(r'\w+(?:[-./]\w+)*')
+
+STOP_WORDS = frozenset("""
+    а без более бы был была были было быть в вам вас весь во вот все всего всех вы где да даже для до его ее ей ему
+    если есть еще же за здесь и из или им их к как ко когда кто ли либо мне может мы на над надо наш не него нее нет
+    ни них но ну о об однако он она они оно от очень по под при с со так также такой там те тем то того тоже той
+    только том ты у уже хотя чего чей чем что чтобы чье чья эта эти это я
+""".split())
+
+_stemmer = snowballstemmer.stemmer('russian')
+_stemmer_lock = threading.Lock()
+
+def _stem(word: str) -> str:
+    with _stemmer_lock:
+        return _stemmer.stemWord(word)
+
+def tokenize(text: str) -> list[str]:
+    """
+    Нормализует и токенизирует текст для BM25:
+    нижний регистр, "ё" -> "е", удаление стоп-слов, стемминг русских слов.
+    Числа и номера документов/статей ("306-фз", "4301-1", "5.1") не стеммируются.
+    """
+    tokens = []
+    for raw in TOKEN_RE.findall(text.lower().replace('ё', 'е')):
+        parts = re.split(r'[-./]', raw)
+        if len(parts) > 1:
+            tokens.append(raw)
+        for part in parts:
+            if not part or part in STOP_WORDS:
+                continue
+            if any(ch.isdigit() for ch in part) or len(part) < 3:
+                tokens.append(part)
+            else:
+                tokens.append(_stem(part))
+    return tokens
+
+def reciprocal_rank_fusion(rankings, k=RRF_K) -> list[tuple[str, float]]:
+    """
+    Объединяет несколько ранжированных списков ID методом Reciprocal Rank Fusion:
+    score(d) = sum(1 / (k + rank)), где rank начинается с 1.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+class LexicalIndex:
+    """
+    Инвертированный индекс BM25 по чанкам базы знаний.
+    Поддерживает инкрементальное добавление и удаление чанков (по тем же ID, что и в ChromaDB)
+    и сохраняется на диск в JSON рядом с коллекцией.
+    """
+
+    def __init__(self, path=LEXICAL_INDEX_PATH, k1=BM25_K1, b=BM25_B):
+        self.path = path
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        self._postings = {}   # термин -> {ID чанка: частота термина}
+        self._doc_terms = {}  # ID чанка -> {термин: частота}
+        self._doc_lengths = {}  # ID чанка -> количество токенов
+        self._total_length = 0
+        self._dirty = False
+
+    @property
+    def doc_count(self) -> int:
+        return len(self._doc_terms)
+
+    def clear(self):
+        with self._lock:
+            self._postings.clear()
+            self._doc_terms.clear()
+            self._doc_lengths.clear()
+            self._total_length = 0
+            self._dirty = True
+
+    def add(self, doc_id: str, text: str):
+        """Добавляет (или заменяет) чанк в индексе."""
+        with self._lock:
+            if doc_id in self._doc_terms:
+                self.remove([doc_id])
+            term_counts = Counter(tokenize(text))
+            self._doc_terms[doc_id] = dict(term_counts)
+            self._doc_lengths[doc_id] = sum(term_counts.values())
+            self._total_length += self._doc_lengths[doc_id]
+            for term, tf in term_counts.items():
+                self._postings.setdefault(term, {})[doc_id] = tf
+            self._dirty = True
+
+    def add_many(self, doc_ids, texts):
+        for doc_id, text in zip(doc_ids, texts):
+            self.add(doc_id, text)
+
+    def remove(self, doc_ids):
+        """Удаляет чанки из индекса. Отсутствующие ID игнорируются."""
+        with self._lock:
+            for doc_id in doc_ids:
+                term_counts = self._doc_terms.pop(doc_id, None)
+                if term_counts is None:
+                    continue
+                self._total_length -= self._doc_lengths.pop(doc_id)
+                for term in term_counts:
+                    posting = self._postings.get(term)
+                    if posting is not None:
+                        posting.pop(doc_id, None)
+                        if not posting:
+                            del self._postings[term]
+                self._dirty = True
+
+    def search(self, query: str, k: int = 10, allowed_ids=None) -> list[tuple[str, float]]:
+        """
+        Возвращает до `k` пар (ID чанка, BM25-оценка) в порядке убывания оценки.
+        Если передан `allowed_ids`, учитываются только чанки из этого множества.
+        """
+        with self._lock:
+            doc_count = len(self._doc_terms)
+            if not doc_count:
+                return []
+            avg_length = self._total_length / doc_count
+            scores = {}
+            for term in set(tokenize(query)):
+                posting = self._postings.get(term)
+                if not posting:
+                    continue
+                idf = math.log(1 + (doc_count - len(posting) + 0.5) / (len(posting) + 0.5))
+                for doc_id, tf in posting.items():
+                    if allowed_ids is not None and doc_id not in allowed_ids:
+                        continue
+                    norm = tf + self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / avg_length)
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+    def save(self):
+        """Атомарно сохраняет индекс на диск, если он изменился."""
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': INDEX_VERSION, 'docs': self._doc_terms}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+        logger.info(f"Лексический индекс сохранен: {self.doc_count} чанков, {len(self._postings)} терминов.")
+
+    def load(self) -> bool:
+        """Загружает индекс с диска. Возвращает False, если файла нет или он устарел."""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не удалось прочитать лексический индекс {self.path}: {e}")
+            return False
+        if data.get('version') != INDEX_VERSION:
+            logger.info("Формат лексического индекса устарел, индекс будет перестроен.")
+            return False
+        with self._lock:
+            self.clear()
+            for doc_id, term_counts in data['docs'].items():
+                self._doc_terms[doc_id] = term_counts
+                self._doc_lengths[doc_id] = sum(term_counts.values())
+                self._total_length += self._doc_lengths[doc_id]
+                for term, tf in term_counts.items():
+                    self._postings.setdefault(term, {})[doc_id] = tf
+            self._dirty = False
+        logger.info(f"Лексический индекс загружен: {self.doc_count} чанков, {len(self._postings)} терминов.")
+        return True
@@ -0,0 +1,315 @@
+import copy
+import time
+import random
+import logging
+import threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+import openai
+from qwen_agent.llm.base import ModelServiceError, register_llm
+from qwen_agent.llm.oai import TextChatAtOAI
+from src import metrics
+from src.agent_executor import AgentCancelledError, current_cancel_event
+from src.config import (
+    LLM_POOL_MAX_CONNECTIONS, LLM_POOL_MAX_KEEPALIVE, LLM_POOL_KEEPALIVE_EXPIRY_SECONDS, LLM_CONNECT_TIMEOUT_SECONDS,
+    LLM_READ_TIMEOUT_SECONDS, LLM_CALL_DEADLINE_SECONDS, LLM_MAX_RETRIES, LLM_RETRY_BASE_DELAY_SECONDS,
+    LLM_RETRY_MAX_DELAY_SECONDS, LLM_HEDGE_AFTER_SECONDS, LLM_FAILURE_THRESHOLD, LLM_DEGRADED_COOLDOWN_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
+
+# Параметры, которые OpenAI API v1 принимает только через extra_body (как в TextChatAtOAI)
+_EXTRA_BODY_PARAMS = ('top_k', 'repetition_penalty')
+_EMPTY = object()
+# Период проверки сигнала отмены хода при ожидании дублирующих запросов, с
+_CANCEL_CHECK_SECONDS = 0.1
+
+# Результат разбора ошибки: повторить на том же сервере, перейти к следующему или вернуть ошибку сразу
+RETRY, FALLBACK, FATAL = 'retry', 'fallback', 'fatal'
+
+def classify_error(error: Exception) -> str:
+    """
+    Определяет реакцию на ошибку обращения к LLM. Обрыв соединения, таймаут, 408, 409, 429 и 5xx
+    считаются временными; ошибки доступа и отсутствие модели (401, 403, 404) — проблемой сервера;
+    остальные ошибки 4xx — ошибкой самого запроса, которую другой сервер не исправит.
+    """
+    if isinstance(error, (openai.APIConnectionError, httpx.TransportError)):
+        return RETRY
+    status = getattr(error, 'status_code', None)
+    if status is None:
+        return FATAL
+    if status in (408, 409, 429) or status >= 500:
+        return RETRY
+    if status in (401, 403, 404):
+        return FALLBACK
+    return FATAL
+
+def _retry_after(error: Exception):
+    """Значение заголовка Retry-After в секундах, если сервер его прислал."""
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers['retry-after'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+class _PeekedStream:
+    """
+    Потоковый ответ, первый фрагмент которого уже получен. Сетевые ошибки при чтении
+    остатка потока превращаются в `ModelServiceError`, как и ошибки API.
+    """
+
+    def __init__(self, stream, iterator, first):
+        self._stream = stream
+        self._iterator = iterator
+        self._first = first
+
+    def __iter__(self):
+        try:
+            if self._first is not _EMPTY:
+                yield self._first
+            yield from self._iterator
+        except httpx.TransportError as e:
+            raise ModelServiceError(exception=e)
+        finally:
+            self.close()
+
+    def close(self):
+        self._stream.close()
+
+def _discard(future):
+    """Закрывает ответ проигравшего дублирующего запроса, когда он все-таки завершится."""
+    if not future.cancelled() and future.exception() is None and hasattr(future.result(), 'close'):
+        future.result().close()
+
+class _Endpoint:
+    """Сервер LLM: постоянный клиент с пулом соединений и счетчик ошибок подряд."""
+
+    def __init__(self, cfg: dict):
+        self.model = cfg['model']
+        self.server = cfg['model_server'].strip()
+        self.name = cfg.get('name') or f"{self.model}@{urlparse(self.server).netloc or self.server}"
+        self.client = openai.OpenAI(
+            base_url=self.server,
+            api_key=(cfg.get('api_key') or 'EMPTY').strip(),
+            # Повторы выполняет ManagedChatAtOAI с учетом общего срока обращения
+            max_retries=0,
+            http_client=httpx.Client(
+                limits=httpx.Limits(max_connections=LLM_POOL_MAX_CONNECTIONS,
+                                    max_keepalive_connections=LLM_POOL_MAX_KEEPALIVE,
+                                    keepalive_expiry=LLM_POOL_KEEPALIVE_EXPIRY_SECONDS),
+                timeout=httpx.Timeout(LLM_READ_TIMEOUT_SECONDS, connect=LLM_CONNECT_TIMEOUT_SECONDS),
+            ),
+        )
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.degraded_until = 0.0
+
+    @property
+    def degraded(self) -> bool:
+        return time.monotonic() < self.degraded_until
+
+    def record_success(self):
+        metrics.LLM_ATTEMPTS_TOTAL.inc(endpoint=self.name, outcome='ok')
+        with self._lock:
+            recovered = self.degraded_until > 0
+            self.failures = 0
+            self.degraded_until = 0.0
+        if recovered:
+            metrics.LLM_ENDPOINT_DEGRADED.set(0, endpoint=self.name)
+            logger.info(f"Сервер LLM {self.name} снова отвечает.")
+
+    def record_failure(self, error: Exception):
+        metrics.LLM_ATTEMPTS_TOTAL.inc(endpoint=self.name, outcome='error')
+        with self._lock:
+            self.failures += 1
+            degraded = self.failures >= LLM_FAILURE_THRESHOLD and not self.degraded
+            if degraded:
+                self.degraded_until = time.monotonic() + LLM_DEGRADED_COOLDOWN_SECONDS
+        if degraded:
+            metrics.LLM_ENDPOINT_DEGRADED.set(1, endpoint=self.name)
+            logger.warning(
+                f"Сервер LLM {self.name} считается деградированным на {LLM_DEGRADED_COOLDOWN_SECONDS} с "
+                f"({self.failures} ошибок подряд, последняя: {error})."
+            )
+
+@register_llm('managed_oai')
+class ManagedChatAtOAI(TextChatAtOAI):
+    """
+    `TextChatAtOAI` с управляемым транспортом (тип модели `managed_oai`): постоянный пул соединений
+    на сервер, общий срок обращения до первого токена (`call_deadline`) с учетом повторов временных
+    ошибок, дублирующий запрос через `hedge_after` секунд без ответа и резервные серверы.
+    Сервер с `LLM_FAILURE_THRESHOLD` ошибками подряд на время уходит в конец списка.
+    Конфигурация та же, что у `oai`; резервные серверы задаются списком `fallbacks` из словарей
+    `{'model', 'model_server', 'api_key'}` в порядке приоритета.
+    """
+
+    def __init__(self, cfg: dict = None):
+        cfg = cfg or {}
+        super().__init__(cfg)
+        self.endpoints = [_Endpoint(dict(cfg, model=self.model))]
+        self.endpoints += [_Endpoint(fallback) for fallback in cfg.get('fallbacks', [])]
+        self.call_deadline = cfg.get('call_deadline', LLM_CALL_DEADLINE_SECONDS)
+        self.hedge_after = cfg.get('hedge_after', LLM_HEDGE_AFTER_SECONDS)
+        self._hedge_pool = None
+        if self.hedge_after:
+            self._hedge_pool = ThreadPoolExecutor(max_workers=LLM_POOL_MAX_CONNECTIONS, thread_name_prefix="llm-hedge")
+        # TextChatAtOAI задает транспорт атрибутом экземпляра в __init__, поэтому он заменяется здесь
+        self._chat_complete_create = self._routed_chat_complete_create
+        logger.info(f"Клиент LLM: {' -> '.join(endpoint.name for endpoint in self.endpoints)}"
+                    + (f", дублирование через {self.hedge_after} с" if self.hedge_after else "") + ".")
+
+    def _candidates(self) -> list:
+        """Серверы в порядке обращения: исправные по приоритету, затем деградированные."""
+        healthy = [endpoint for endpoint in self.endpoints if not endpoint.degraded]
+        return healthy + [endpoint for endpoint in self.endpoints if endpoint.degraded]
+
+    def _open(self, endpoint: _Endpoint, kwargs: dict, deadline: float, started=None):
+        """
+        Отправляет запрос; для потокового ответа дожидается первого фрагмента. Таймаут считается
+        от `deadline` в момент отправки (запрос мог ждать свободного потока в пуле дублирования).
+        """
+        if started is not None:
+            started.set()
+        timeout = max(deadline - time.monotonic(), 0.001)
+        response = endpoint.client.chat.completions.create(
+            model=endpoint.model, timeout=httpx.Timeout(timeout, connect=min(timeout, LLM_CONNECT_TIMEOUT_SECONDS)),
+            **kwargs,
+        )
+        if not kwargs.get('stream'):
+            return response
+        try:
+            iterator = iter(response)
+            first = next(iterator, _EMPTY)
+        except BaseException:
+            response.close()
+            raise
+        return _PeekedStream(response, iterator, first)
+
+    @staticmethod
+    def _wait(futures, until: float, cancel_event):
+        """
+        `wait(..., FIRST_COMPLETED)` до момента `until` с проверкой сигнала отмены хода агента.
+        При отмене незавершенные запросы закрываются по завершении и выбрасывается `AgentCancelledError`.
+        """
+        while True:
+            remaining = until - time.monotonic()
+            done, pending = wait(futures, timeout=max(min(remaining, _CANCEL_CHECK_SECONDS), 0),
+                                 return_when=FIRST_COMPLETED)
+            if done or remaining <= _CANCEL_CHECK_SECONDS:
+                return done, pending
+            if cancel_event.is_set():
+                for future in pending:
+                    future.add_done_callback(_discard)
+                raise AgentCancelledError("Ход агента прерван.")
+
+    def _open_hedged(self, endpoint: _Endpoint, kwargs: dict, deadline: float, cancel_event):
+        """
+        Отправляет запрос и, если первый токен не пришел за `hedge_after` секунд после начала
+        отправки, его дубль. Время ожидания свободного потока пула не считается: дубль встал бы
+        в ту же очередь. Возвращается ответ, пришедший первым; второй закрывается по завершении.
+        """
+        started = threading.Event()
+        primary = self._hedge_pool.submit(self._open, endpoint, kwargs, deadline, started)
+        while not started.is_set() and not primary.done() and time.monotonic() < deadline:
+            if cancel_event.is_set():
+                primary.add_done_callback(_discard)
+                raise AgentCancelledError("Ход агента прерван.")
+            started.wait(min(deadline - time.monotonic(), _CANCEL_CHECK_SECONDS))
+        done, _ = self._wait([primary], min(time.monotonic() + self.hedge_after, deadline), cancel_event)
+        if done:
+            return primary.result()
+
+        hedge = self._hedge_pool.submit(self._open, endpoint, kwargs, deadline)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = self._wait(pending, deadline, cancel_event)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    metrics.LLM_HEDGES_TOTAL.inc(endpoint=endpoint.name, winner='hedge' if future is hedge else 'primary')
+                    for other in pending:
+                        other.add_done_callback(_discard)
+                    return future.result()
+                error = future.exception()
+        for future in pending:
+            future.add_done_callback(_discard)
+        if error is not None:
+            raise error
+        raise openai.APITimeoutError(request=httpx.Request('POST', endpoint.server))
+
+    def _backoff(self, attempt: int, error: Exception):
+        """Задержка перед повтором или None, если ждать дольше разумного и лучше сменить сервер."""
+        delay = random.uniform(LLM_RETRY_BASE_DELAY_SECONDS, LLM_RETRY_BASE_DELAY_SECONDS * 2 ** (attempt + 1))
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            if retry_after > LLM_RETRY_MAX_DELAY_SECONDS:
+                return None
+            delay = max(delay, retry_after)
+        return min(delay, LLM_RETRY_MAX_DELAY_SECONDS)
+
+    def _routed_chat_complete_create(self, *args, **kwargs):
+        # Модель берется из конфигурации сервера, срок обращения задается общим дедлайном
+        kwargs.pop('model', None)
+        kwargs.pop('request_timeout', None)
+        if any(param in kwargs for param in _EXTRA_BODY_PARAMS):
+            kwargs['extra_body'] = copy.deepcopy(kwargs.get('extra_body', {}))
+            for param in _EXTRA_BODY_PARAMS:
+                if param in kwargs:
+                    kwargs['extra_body'][param] = kwargs.pop(param)
+
+        deadline = time.monotonic() + self.call_deadline
+        # Вне хода агента отмены нет: пустое событие делает ожидание обычной задержкой
+        cancel_event = current_cancel_event() or threading.Event()
+        last_error = None
+        for position, endpoint in enumerate(self._candidates()):
+            if position:
+                metrics.LLM_FALLBACKS_TOTAL.inc(endpoint=endpoint.name)
+                logger.warning(f"Переключение на резервный сервер LLM {endpoint.name} (ошибка: {last_error}).")
+            for attempt in range(LLM_MAX_RETRIES + 1):
+                if time.monotonic() >= deadline:
+                    break
+                if cancel_event.is_set():
+                    raise AgentCancelledError("Ход агента прерван.")
+                try:
+                    if self._hedge_pool is not None:
+                        response = self._open_hedged(endpoint, kwargs, deadline, cancel_event)
+                    else:
+                        response = self._open(endpoint, kwargs, deadline)
+                except Exception as e:
+                    kind = classify_error(e)
+                    if kind == FATAL:
+                        raise
+                    endpoint.record_failure(e)
+                    last_error = e
+                    delay = self._backoff(attempt, e) if kind == RETRY else None
+                    if delay is None or attempt == LLM_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                        break
+                    metrics.LLM_RETRIES_TOTAL.inc(endpoint=endpoint.name)
+                    logger.warning(f"Ошибка обращения к LLM {endpoint.name}: {e}. Повтор через {delay:.1f} с.")
+                    # Ожидание прерывается сразу, если ход агента отменен (например, по таймауту запроса)
+                    if cancel_event.wait(delay):
+                        raise AgentCancelledError("Ход агента прерван.")
+                    continue
+                endpoint.record_success()
+                return response
+            if time.monotonic() >= deadline:
+                break
+
+        if last_error is None:
+            raise ModelServiceError(code='timeout', message=f"LLM не ответила за {self.call_deadline} с.")
+        raise ModelServiceError(exception=last_error)
+
+    def stats(self) -> dict:
+        """Состояние серверов LLM."""
+        return {endpoint.name: {'failures': endpoint.failures, 'degraded': endpoint.degraded}
+                for endpoint in self.endpoints}
+
+    def close(self):
+        """Закрывает пулы соединений."""
+        if self._hedge_pool is not None:
+            self._hedge_pool.shutdown(wait=False, cancel_futures=True)
+        for endpoint in self.endpoints:
+            endpoint.client.close()
@@ -0,0 +1,363 @@
+import os
+import json
+import shutil
+import logging
+import threading
+import numpy as np
+from src.config import LOCAL_VECTOR_STORE_PATH, LOCAL_VECTOR_STORE_QUANTIZATION
+from src.vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+# Версия формата файлов хранилища
+STORE_FORMAT_VERSION = 1
+CURRENT_FILE = 'current.json'
+
+def _compare(value, operand, check):
+    try:
+        return value is not None and check(value, operand)
+    except TypeError:
+        return False
+
+_OPERATORS = {
+    '$eq': lambda value, operand: value == operand,
+    '$ne': lambda value, operand: value != operand,
+    '$in': lambda value, operand: value in operand,
+    '$nin': lambda value, operand: value not in operand,
+    '$gt': lambda value, operand: _compare(value, operand, lambda a, b: a > b),
+    '$gte': lambda value, operand: _compare(value, operand, lambda a, b: a >= b),
+    '$lt': lambda value, operand: _compare(value, operand, lambda a, b: a < b),
+    '$lte': lambda value, operand: _compare(value, operand, lambda a, b: a <= b),
+}
+
+def matches_where(metadata: dict, where: dict) -> bool:
+    """Проверяет метаданные чанка на соответствие фильтру в формате ChromaDB (`$and`, `$or`, `$eq`, `$in`, ...)."""
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(matches_where(metadata, item) for item in condition):
+                return False
+        elif key == '$or':
+            if not any(matches_where(metadata, item) for item in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for operator, operand in condition.items():
+                if operator not in _OPERATORS:
+                    raise ValueError(f"Неподдерживаемый оператор фильтра: {operator}")
+                if not _OPERATORS[operator](value, operand):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+def _quantize(matrix: np.ndarray):
+    """Симметричное int8-квантование по строкам: вектор ≈ q * scale."""
+    scales = np.abs(matrix).max(axis=1) / 127.0
+    scales[scales == 0] = 1.0
+    quantized = np.round(matrix / scales[:, None]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+class _Snapshot:
+    """Неизменяемое состояние хранилища: читатели работают со ссылкой на снимок без блокировок."""
+
+    def __init__(self, ids, documents, metadatas, matrix, scales=None):
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.matrix = matrix  # float32 или int8 (тогда векторы = matrix * scales)
+        self.scales = scales
+        self.positions = {doc_id: i for i, doc_id in enumerate(ids)}
+
+    def vectors(self, rows=None) -> np.ndarray:
+        """Возвращает векторы строк (все или выбранные) в float32."""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.scales is None:
+            return np.asarray(matrix, dtype=np.float32)
+        scales = self.scales if rows is None else self.scales[rows]
+        return matrix.astype(np.float32) * scales[:, None]
+
+    def scores(self, queries: np.ndarray, rows=None) -> np.ndarray:
+        """Косинусное сходство запросов со строками матрицы (строки нормализованы при записи)."""
+        matrix = self.matrix if rows is None else self.matrix[rows]
+        if self.scales is None:
+            return queries @ np.asarray(matrix).T
+        scales = self.scales if rows is None else self.scales[rows]
+        return (queries @ matrix.astype(np.float32).T) * scales[None, :]
+
+_EMPTY = _Snapshot([], [], [], np.empty((0, 0), dtype=np.float32))
+
+class LocalVectorStore(VectorStore):
+    """
+    Локальное хранилище векторов без отдельной СУБД.
+
+    Эмбеддинги хранятся одной матрицей в файле `.npy` (float32 или int8 с масштабом по строкам),
+    которая открывается через `np.load(mmap_mode='r')`: загрузка занимает миллисекунды,
+    а страницы матрицы разделяются через page cache всеми процессами (воркерами uvicorn),
+    открывшими хранилище. Поиск — полный перебор векторизованным умножением матриц;
+    `distance` в результатах — косинусное расстояние (1 − сходство).
+
+    Изменения накапливаются в памяти и записываются `persist()` в новое поколение
+    (`gen-NNNNNN/`), после чего атомарно переключается `current.json`. Процессы-читатели
+    замечают новое поколение при следующем запросе и переоткрывают файлы.
+    Строки `upsert` копятся в буфере и сливаются в матрицу одним копированием при следующем
+    чтении, изменении или `persist()`, поэтому загрузка батчами не пересобирает матрицу на каждый батч.
+    """
+
+    def __init__(self, path=LOCAL_VECTOR_STORE_PATH, quantization=LOCAL_VECTOR_STORE_QUANTIZATION):
+        if quantization not in (None, 'int8'):
+            raise ValueError(f"Неподдерживаемое квантование: {quantization}")
+        self.path = path
+        self.quantization = quantization
+        self.generation = 0
+        self._snapshot = _EMPTY
+        self._pending = {}  # id -> (вектор, документ, метаданные) еще не слитых в снимок строк
+        self._current_mtime = None
+        self._failed_mtime = None  # mtime `current.json`, который не удалось открыть
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._load()
+
+    # --- Файлы поколений ---
+
+    def _generation_dir(self, generation: int) -> str:
+        return os.path.join(self.path, f"gen-{generation:06d}")
+
+    def _load(self):
+        current_path = os.path.join(self.path, CURRENT_FILE)
+        mtime = None
+        try:
+            mtime = os.stat(current_path).st_mtime_ns
+            with open(current_path, 'r', encoding='utf-8') as f:
+                current = json.load(f)
+            generation_dir = self._generation_dir(current['generation'])
+            with open(os.path.join(generation_dir, 'chunks.json'), 'r', encoding='utf-8') as f:
+                chunks = json.load(f)
+            if chunks.get('format') != STORE_FORMAT_VERSION:
+                logger.warning(f"Формат локального хранилища векторов {self.path} устарел. Хранилище будет пересоздано.")
+                self._failed_mtime = mtime
+                return
+            matrix = np.load(os.path.join(generation_dir, 'vectors.npy'), mmap_mode='r')
+            scales_path = os.path.join(generation_dir, 'scales.npy')
+            scales = np.load(scales_path) if os.path.exists(scales_path) else None
+        except FileNotFoundError:
+            # Поколение могло быть удалено между чтением current.json и открытием файлов: повторим позже
+            return
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Не удалось открыть локальное хранилище векторов {self.path}: {e}")
+            # Повторная попытка — только когда current.json снова изменится, а не на каждый запрос
+            self._failed_mtime = mtime
+            return
+        self._snapshot = _Snapshot(chunks['ids'], chunks['documents'], chunks['metadatas'], matrix, scales)
+        self.generation = current['generation']
+        self._current_mtime = mtime
+        logger.info(f"Локальное хранилище векторов открыто: поколение {self.generation}, чанков {len(chunks['ids'])}.")
+
+    def _maybe_reload(self):
+        """
+        Переоткрывает хранилище, если другой процесс записал новое поколение.
+        Если в этом процессе есть несохраненные изменения, сливает буфер `upsert` в снимок.
+        """
+        if self._dirty:
+            if self._pending:
+                with self._lock:
+                    self._merge_pending()
+            return
+        try:
+            mtime = os.stat(os.path.join(self.path, CURRENT_FILE)).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._current_mtime and mtime != self._failed_mtime:
+            with self._lock:
+                if not self._dirty and mtime != self._current_mtime and mtime != self._failed_mtime:
+                    self._load()
+
+    def persist(self):
+        """Записывает накопленные изменения в новое поколение и переключает на него `current.json`."""
+        with self._lock:
+            if not self._dirty:
+                return
+            self._merge_pending()
+            snapshot = self._snapshot
+            generation = self.generation + 1
+            generation_dir = self._generation_dir(generation)
+            os.makedirs(generation_dir, exist_ok=True)
+            matrix = snapshot.vectors()
+            if self.quantization == 'int8' and len(snapshot.ids):
+                quantized, scales = _quantize(matrix)
+                np.save(os.path.join(generation_dir, 'vectors.npy'), quantized)
+                np.save(os.path.join(generation_dir, 'scales.npy'), scales)
+            else:
+                np.save(os.path.join(generation_dir, 'vectors.npy'), matrix)
+            with open(os.path.join(generation_dir, 'chunks.json'), 'w', encoding='utf-8') as f:
+                json.dump({'format': STORE_FORMAT_VERSION, 'ids': snapshot.ids, 'documents': snapshot.documents,
+                           'metadatas': snapshot.metadatas}, f, ensure_ascii=False)
+
+            current_path = os.path.join(self.path, CURRENT_FILE)
+            tmp_path = f"{current_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'generation': generation}, f)
+            os.replace(tmp_path, current_path)
+            self._current_mtime = os.stat(current_path).st_mtime_ns
+            self.generation = generation
+            self._dirty = False
+
+            # Старые поколения удаляются: уже открытые в других процессах файлы остаются доступны до закрытия
+            for name in os.listdir(self.path):
+                if name.startswith('gen-') and name != os.path.basename(generation_dir):
+                    shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+        logger.info(f"Локальное хранилище векторов сохранено: поколение {generation}, чанков {len(snapshot.ids)}.")
+
+    # --- Запись ---
+
+    def count(self) -> int:
+        self._maybe_reload()
+        return len(self._snapshot.ids)
+
+    def _dimension(self):
+        """Размерность векторов хранилища (с учетом буфера) или None, если оно пусто. Под блокировкой."""
+        if len(self._snapshot.ids):
+            return self._snapshot.matrix.shape[1]
+        for vector, _, _ in self._pending.values():
+            return vector.shape[0]
+        return None
+
+    def upsert(self, ids, embeddings, documents, metadatas=None):
+        ids = list(ids)
+        if not ids:
+            return
+        vectors = _normalize_rows(np.asarray(embeddings, dtype=np.float32))
+        metadatas = list(metadatas) if metadatas is not None else [{} for _ in ids]
+        with self._lock:
+            dimension = self._dimension()
+            if dimension is not None and vectors.shape[1] != dimension:
+                raise ValueError(
+                    f"Размерность эмбеддингов {vectors.shape[1]} не совпадает с хранилищем ({dimension})."
+                )
+            for i, doc_id in enumerate(ids):
+                self._pending[doc_id] = (vectors[i], documents[i], metadatas[i] or {})
+            self._dirty = True
+
+    def _merge_pending(self):
+        """Сливает буфер `upsert` в новый снимок. Вызывается под блокировкой."""
+        if not self._pending:
+            return
+        snapshot = self._snapshot
+        new_ids, new_documents, new_metadatas = list(snapshot.ids), list(snapshot.documents), list(snapshot.metadatas)
+        appended = []
+        replaced = {}
+        for doc_id, (vector, document, metadata) in self._pending.items():
+            row = snapshot.positions.get(doc_id)
+            if row is None:
+                new_ids.append(doc_id)
+                new_documents.append(document)
+                new_metadatas.append(metadata)
+                appended.append(vector)
+            else:
+                new_documents[row] = document
+                new_metadatas[row] = metadata
+                replaced[row] = vector
+        # Новая матрица собирается одним копированием: старая может быть memmap только для чтения,
+        # а текущий снимок читается без блокировок и не должен меняться
+        old_count = len(snapshot.ids)
+        dimension = next(iter(self._pending.values()))[0].shape[0]
+        matrix = np.empty((len(new_ids), dimension), dtype=np.float32)
+        if old_count:
+            matrix[:old_count] = snapshot.vectors()
+        if appended:
+            matrix[old_count:] = np.stack(appended)
+        for row, vector in replaced.items():
+            matrix[row] = vector
+        self._snapshot = _Snapshot(new_ids, new_documents, new_metadatas, matrix)
+        self._pending = {}
+
+    def update(self, ids, metadatas):
+        with self._lock:
+            self._merge_pending()
+            snapshot = self._snapshot
+            new_metadatas = list(snapshot.metadatas)
+            for doc_id, metadata in zip(ids, metadatas):
+                row = snapshot.positions.get(doc_id)
+                if row is not None:
+                    new_metadatas[row] = metadata or {}
+            self._snapshot = _Snapshot(snapshot.ids, snapshot.documents, new_metadatas, snapshot.matrix, snapshot.scales)
+            self._dirty = True
+
+    def delete(self, ids):
+        removed = set(ids)
+        with self._lock:
+            self._merge_pending()
+            snapshot = self._snapshot
+            keep = [i for i, doc_id in enumerate(snapshot.ids) if doc_id not in removed]
+            if len(keep) == len(snapshot.ids):
+                return
+            self._snapshot = _Snapshot(
+                [snapshot.ids[i] for i in keep],
+                [snapshot.documents[i] for i in keep],
+                [snapshot.metadatas[i] for i in keep],
+                snapshot.vectors(np.array(keep, dtype=np.int64)) if keep else np.empty((0, 0), dtype=np.float32),
+            )
+            self._dirty = True
+
+    # --- Чтение ---
+
+    def _filter_rows(self, snapshot, where):
+        if where is None:
+            return None
+        return np.array([i for i, metadata in enumerate(snapshot.metadatas) if matches_where(metadata, where)],
+                        dtype=np.int64)
+
+    def get(self, ids=None, where=None, include=('documents', 'metadatas'), limit=None, offset=None) -> dict:
+        self._maybe_reload()
+        snapshot = self._snapshot
+        if ids is not None:
+            rows = [snapshot.positions[doc_id] for doc_id in ids if doc_id in snapshot.positions]
+            if where is not None:
+                rows = [row for row in rows if matches_where(snapshot.metadatas[row], where)]
+        else:
+            filtered = self._filter_rows(snapshot, where)
+            rows = list(range(len(snapshot.ids))) if filtered is None else filtered.tolist()
+        rows = rows[offset or 0:]
+        if limit is not None:
+            rows = rows[:limit]
+        return {
+            'ids': [snapshot.ids[row] for row in rows],
+            'documents': [snapshot.documents[row] for row in rows] if 'documents' in include else None,
+            'metadatas': [snapshot.metadatas[row] for row in rows] if 'metadatas' in include else None,
+            'embeddings': snapshot.vectors(np.array(rows, dtype=np.int64)) if 'embeddings' in include else None,
+        }
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=('documents', 'metadatas', 'distances')) -> dict:
+        self._maybe_reload()
+        snapshot = self._snapshot
+        queries = _normalize_rows(np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32)))
+        rows = self._filter_rows(snapshot, where)
+        result = {key: [] for key in ('ids', 'documents', 'metadatas', 'distances')}
+        candidate_count = len(snapshot.ids) if rows is None else len(rows)
+        if candidate_count == 0:
+            for key in result:
+                result[key] = [[] for _ in queries]
+            return result
+
+        scores = snapshot.scores(queries, rows)
+        k = min(n_results, candidate_count)
+        for query_scores in scores:
+            if k < candidate_count:
+                top = np.argpartition(-query_scores, k - 1)[:k]
+                top = top[np.argsort(-query_scores[top])]
+            else:
+                top = np.argsort(-query_scores)
+            found = top if rows is None else rows[top]
+            result['ids'].append([snapshot.ids[row] for row in found])
+            result['documents'].append([snapshot.documents[row] for row in found])
+            result['metadatas'].append([snapshot.metadatas[row] for row in found])
+            result['distances'].append((1.0 - query_scores[top]).astype(float).tolist())
+        for key in ('documents', 'metadatas', 'distances'):
+            if key not in include:
+                result[key] = None
+        return result
@@ -1,19 +1,22 @@
 import logging
 import sys
+from src.request_context import RequestIdFilter
 
 def setup_logging():
     """
     Настраивает и конфигурирует стандартный логгер Python.
     """
-    # Создаем форматтер, который будет добавлять время, уровень и сообщение
+    # Создаем форматтер, который будет добавлять время, уровень, ID запроса и сообщение
     formatter = logging.Formatter(
-        '%(asctime)s - %(levelname)s - [%(module)s] - %(message)s',
+        '%(asctime)s - %(levelname)s - [%(module)s] - [%(request_id)s] - %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S'
     )
 
     # Создаем обработчик, который будет выводить логи в консоль (stdout)
     handler = logging.StreamHandler(sys.stdout)
     handler.setFormatter(formatter)
+    # ID запроса берется из контекста (см. src/request_context.py); вне запроса выводится "-"
+    handler.addFilter(RequestIdFilter())
 
     # Получаем корневой логгер, устанавливаем ему уровень INFO
     # и добавляем наш обработчик
@@ -0,0 +1,188 @@
+import math
+import threading
+from src.config import METRICS_LATENCY_BUCKETS
+
+def _format_value(value) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+class _Metric:
+    """Базовый класс метрики с именованными метками."""
+    metric_type = None
+
+    def __init__(self, name: str, documentation: str, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        self._function = None
+        (registry or REGISTRY).register(self)
+
+    def _key(self, labels: dict) -> tuple:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function):
+        """Значение метрики без меток вычисляется вызовом `function()` при каждом сборе."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception:
+                return []
+            return [(self.name, {}, value)] if value is not None else []
+        with self._lock:
+            items = list(self._values.items())
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in items]
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return lines
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик."""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """Текущее значение (может как расти, так и уменьшаться)."""
+    metric_type = 'gauge'
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными границами корзин (кумулятивная, как в Prometheus)."""
+    metric_type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=METRICS_LATENCY_BUCKETS, registry=None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][i] += 1
+                    break
+            state['sum'] += value
+            state['count'] += 1
+
+    def _samples(self):
+        with self._lock:
+            items = [(key, dict(state, counts=list(state['counts']))) for key, state in self._values.items()]
+        samples = []
+        for key, state in items:
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets, state['counts']):
+                cumulative += count
+                samples.append((f"{self.name}_bucket", dict(labels, le=_format_value(float(bound))), cumulative))
+            samples.append((f"{self.name}_sum", labels, state['sum']))
+            samples.append((f"{self.name}_count", labels, state['count']))
+        return samples
+
+class MetricsRegistry:
+    """Набор метрик процесса; `render` отдает их в текстовом формате Prometheus."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"Метрика {metric.name} уже зарегистрирована.")
+            self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+REGISTRY = MetricsRegistry()
+
+# --- Метрики приложения ---
+
+REQUESTS_TOTAL = Counter('svo_rag_requests_total', "Количество HTTP-запросов.", ('endpoint', 'status'))
+REQUEST_DURATION = Histogram('svo_rag_request_duration_seconds', "Длительность обработки HTTP-запроса.", ('endpoint',))
+STAGE_DURATION = Histogram(
+    'svo_rag_stage_duration_seconds',
+    "Длительность этапов обработки запроса (история, эмбеддинг, поиск, переранжирование, LLM, инструменты).",
+    ('stage',)
+)
+AGENT_LLM_ROUNDS = Histogram(
+    'svo_rag_agent_llm_rounds', "Количество обращений к LLM за один ход агента.", buckets=(1, 2, 3, 4, 5, 6, 8, 10)
+)
+AGENT_TOOL_CALLS = Histogram(
+    'svo_rag_agent_tool_calls', "Количество вызовов инструментов за один ход агента.", buckets=(0, 1, 2, 3, 4, 5, 6, 8)
+)
+SLOW_REQUESTS_TOTAL = Counter('svo_rag_slow_requests_total', "Количество запросов дольше порога медленного запроса.")
+
+AGENT_SLOTS_OCCUPIED = Gauge('svo_rag_agent_slots_occupied', "Занятые места в очереди агента (выполняются и ожидают).")
+AGENT_SLOTS_CAPACITY = Gauge('svo_rag_agent_slots_capacity', "Вместимость очереди агента.")
+AGENT_REJECTED_TOTAL = Counter('svo_rag_agent_rejected_total', "Запросы, отклоненные из-за переполненной очереди (429).")
+AGENT_TIMEOUTS_TOTAL = Counter('svo_rag_agent_timeouts_total', "Ходы агента, прерванные по таймауту.")
+QUERY_EMBEDDING_CACHE_HITS = Counter('svo_rag_query_embedding_cache_hits_total', "Попадания в LRU-кэш эмбеддингов запросов.")
+QUERY_EMBEDDING_CACHE_MISSES = Counter('svo_rag_query_embedding_cache_misses_total', "Промахи LRU-кэша эмбеддингов запросов.")
+RERANK_CACHE_HITS = Counter('svo_rag_rerank_cache_hits_total', "Оценки пар (запрос, чанк), взятые из кэша переранжирования.")
+RERANK_CACHE_MISSES = Counter('svo_rag_rerank_cache_misses_total', "Оценки пар (запрос, чанк), рассчитанные кросс-энкодером.")
+ANSWER_CACHE_HITS = Counter('svo_rag_answer_cache_hits_total', "Ответы, выданные из семантического кэша.")
+ANSWER_CACHE_MISSES = Counter('svo_rag_answer_cache_misses_total', "Промахи семантического кэша ответов.")
+ANSWER_CACHE_SIZE = Gauge('svo_rag_answer_cache_size', "Количество ответов в семантическом кэше.")
+RETRIEVAL_CACHE_HITS = Counter('svo_rag_retrieval_cache_hits_total', "Запросы к базе знаний, результаты которых взяты из кэша поиска.")
+RETRIEVAL_CACHE_MISSES = Counter('svo_rag_retrieval_cache_misses_total', "Промахи кэша результатов поиска.")
+RETRIEVAL_CACHE_SIZE = Gauge('svo_rag_retrieval_cache_size', "Количество результатов в кэше поиска.")
+LLM_ATTEMPTS_TOTAL = Counter('svo_rag_llm_attempts_total', "Обращения к серверам LLM по результату.", ('endpoint', 'outcome'))
+LLM_RETRIES_TOTAL = Counter('svo_rag_llm_retries_total', "Повторные обращения к серверу LLM после временной ошибки.", ('endpoint',))
+LLM_HEDGES_TOTAL = Counter('svo_rag_llm_hedges_total', "Дублирующие запросы к LLM по победителю.", ('endpoint', 'winner'))
+LLM_FALLBACKS_TOTAL = Counter('svo_rag_llm_fallbacks_total', "Обращения, переключенные на резервный сервер LLM.", ('endpoint',))
+LLM_ENDPOINT_DEGRADED = Gauge('svo_rag_llm_endpoint_degraded', "1, если сервер LLM считается деградированным.", ('endpoint',))
+HISTORY_RETENTION_ROWS_TRIMMED = Counter(
+    'svo_rag_history_retention_rows_trimmed_total', "Сообщения, удаленные очисткой истории сверх лимита сессии."
+)
+HISTORY_RETENTION_ROWS_EXPIRED = Counter(
+    'svo_rag_history_retention_rows_expired_total', "Сообщения просроченных сессий, удаленные очисткой истории."
+)
+HISTORY_RETENTION_LAST_DURATION = Gauge(
+    'svo_rag_history_retention_last_duration_seconds', "Длительность последнего прохода очистки истории."
+)
+HISTORY_RETENTION_ERRORS_TOTAL = Counter('svo_rag_history_retention_errors_total', "Неудачные проходы фоновой очистки истории.")
+HISTORY_WRITE_FAILURES_TOTAL = Counter(
+    'svo_rag_history_write_failures_total',
+    "Неудачные записи пачек сообщений в историю (retried — записана повторно, dropped — потеряна).", ('outcome',)
+)
+
+def render_metrics() -> str:
+    """Возвращает все метрики процесса в текстовом формате Prometheus."""
+    return REGISTRY.render()
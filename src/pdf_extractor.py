@@ -0,0 +1,99 @@
+import os
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pypdf import PdfReader
+from src.config import PDF_EXTRACT_WORKERS, PDF_PAGES_PER_TASK
+
+# Модуль намеренно импортирует только pypdf: дочерние процессы пула запускаются через
+# "spawn" и не должны тянуть за собой torch и sentence_transformers.
+
+logger = logging.getLogger(__name__)
+
+def count_pages(file_path) -> int:
+    """Возвращает количество страниц в PDF-файле."""
+    return len(PdfReader(file_path).pages)
+
+def extract_pages(file_path, start=0, end=None) -> list[str]:
+    """
+    Извлекает текст страниц [start, end) одного PDF-файла.
+    Текст каждой страницы извлекается ровно один раз; пустые страницы возвращаются как "".
+    """
+    reader = PdfReader(file_path)
+    return [page.extract_text() or "" for page in reader.pages[start:end]]
+
+def _plan_tasks(file_paths, pages_per_task):
+    """Разбивает файлы на задачи по диапазонам страниц."""
+    for file_path in file_paths:
+        try:
+            page_count = count_pages(file_path)
+        except Exception as e:
+            logger.error(f"    ! Ошибка: Не удалось прочитать файл {os.path.basename(file_path)}: {e}", exc_info=True)
+            continue
+        ranges = [(start, min(start + pages_per_task, page_count)) for start in range(0, page_count, pages_per_task)]
+        yield file_path, ranges or [(0, 0)]
+
+def iter_pdf_pages(file_paths, max_workers=PDF_EXTRACT_WORKERS, pages_per_task=PDF_PAGES_PER_TASK):
+    """
+    Параллельно извлекает текст страниц PDF-файлов в пуле процессов.
+
+    Файлы и диапазоны страниц внутри одного файла обрабатываются одновременно.
+    Генератор отдает пары (путь к файлу, список текстов страниц) по мере готовности файлов,
+    а число одновременно выполняемых задач ограничено, поэтому в памяти держатся
+    только файлы, находящиеся в обработке.
+    """
+    file_paths = list(file_paths)
+    if not file_paths:
+        return
+
+    if max_workers is None or max_workers <= 1:
+        for file_path, ranges in _plan_tasks(file_paths, pages_per_task):
+            try:
+                yield file_path, [text for start, end in ranges for text in extract_pages(file_path, start, end)]
+            except Exception as e:
+                logger.error(f"    ! Ошибка: Не удалось прочитать файл {os.path.basename(file_path)}: {e}", exc_info=True)
+        return
+
+    planned = _plan_tasks(file_paths, pages_per_task)
+    queue = deque()          # задачи, ожидающие отправки в пул: (путь, номер части, start, end)
+    parts = {}               # путь -> {номер части: тексты страниц}
+    expected = {}            # путь -> количество частей
+    failed = set()
+    pending = {}
+    max_in_flight = max_workers * 2
+
+    def refill(executor):
+        while len(pending) < max_in_flight:
+            if not queue:
+                next_file = next(planned, None)
+                if next_file is None:
+                    return
+                file_path, ranges = next_file
+                expected[file_path] = len(ranges)
+                parts[file_path] = {}
+                queue.extend((file_path, i, start, end) for i, (start, end) in enumerate(ranges))
+            file_path, part, start, end = queue.popleft()
+            if file_path in failed:
+                continue
+            pending[executor.submit(extract_pages, file_path, start, end)] = (file_path, part)
+
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        refill(executor)
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path, part = pending.pop(future)
+                if file_path in failed:
+                    continue
+                try:
+                    parts[file_path][part] = future.result()
+                except Exception as e:
+                    logger.error(f"    ! Ошибка: Не удалось прочитать файл {os.path.basename(file_path)}: {e}", exc_info=True)
+                    failed.add(file_path)
+                    parts.pop(file_path, None)
+                    continue
+                if len(parts[file_path]) == expected[file_path]:
+                    file_parts = parts.pop(file_path)
+                    yield file_path, [text for i in range(expected[file_path]) for text in file_parts[i]]
+            refill(executor)
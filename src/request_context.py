@@ -0,0 +1,113 @@
+import time
+import uuid
+import logging
+import threading
+import contextlib
+import contextvars
+from src.config import SLOW_REQUEST_THRESHOLD_SECONDS
+from src.metrics import (
+    REQUESTS_TOTAL, REQUEST_DURATION, STAGE_DURATION, AGENT_LLM_ROUNDS, AGENT_TOOL_CALLS, SLOW_REQUESTS_TOTAL,
+)
+
+logger = logging.getLogger(__name__)
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+_trace_var = contextvars.ContextVar('request_trace', default=None)
+
+class RequestTrace:
+    """
+    Разбивка одного запроса по этапам. Этапы могут записываться из разных потоков
+    (рабочие потоки агента получают копию контекста запроса), поэтому запись защищена блокировкой.
+    """
+
+    def __init__(self, request_id: str, endpoint: str):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.stages = []  # (этап, длительность в секундах)
+        self.finished = False
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages.append((stage, seconds))
+
+    def count(self, stage: str) -> int:
+        with self._lock:
+            return sum(1 for name, _ in self.stages if name == stage)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def breakdown(self) -> dict:
+        """Суммарное время и количество по каждому этапу, в порядке первого появления."""
+        result = {}
+        with self._lock:
+            stages = list(self.stages)
+        for stage, seconds in stages:
+            entry = result.setdefault(stage, {'count': 0, 'total_ms': 0.0})
+            entry['count'] += 1
+            entry['total_ms'] += seconds * 1000
+        return {stage: dict(entry, total_ms=round(entry['total_ms'], 1)) for stage, entry in result.items()}
+
+def current_request_id() -> str:
+    return request_id_var.get()
+
+def current_trace():
+    """Возвращает разбивку текущего запроса или None вне запроса."""
+    return _trace_var.get()
+
+def begin_request(endpoint: str, request_id: str = None) -> RequestTrace:
+    """Начинает учет запроса в текущем контексте: задает ID запроса для логов и разбивку по этапам."""
+    trace = RequestTrace(request_id or uuid.uuid4().hex[:12], endpoint)
+    request_id_var.set(trace.request_id)
+    _trace_var.set(trace)
+    return trace
+
+def finish_request(trace: RequestTrace, status: int, endpoint: str = None):
+    """
+    Завершает учет запроса: записывает метрики и, если запрос дольше
+    `SLOW_REQUEST_THRESHOLD_SECONDS`, пишет в лог разбивку по этапам.
+    Повторные вызовы игнорируются.
+    """
+    with trace._lock:
+        if trace.finished:
+            return
+        trace.finished = True
+    endpoint = endpoint or trace.endpoint
+    trace.endpoint = endpoint
+    duration = trace.elapsed()
+    REQUESTS_TOTAL.inc(endpoint=endpoint, status=status)
+    REQUEST_DURATION.observe(duration, endpoint=endpoint)
+    llm_rounds = trace.count('llm')
+    if llm_rounds:
+        AGENT_LLM_ROUNDS.observe(llm_rounds)
+        AGENT_TOOL_CALLS.observe(trace.count('tool'))
+    if SLOW_REQUEST_THRESHOLD_SECONDS is not None and duration >= SLOW_REQUEST_THRESHOLD_SECONDS:
+        SLOW_REQUESTS_TOTAL.inc()
+        logger.warning(
+            f"Медленный запрос {endpoint} (статус {status}): {duration:.2f} с. Этапы: {trace.breakdown()}"
+        )
+
+def record_stage(name: str, seconds: float):
+    """Записывает длительность этапа в метрики и в разбивку текущего запроса."""
+    STAGE_DURATION.observe(seconds, stage=name)
+    trace = _trace_var.get()
+    if trace is not None:
+        trace.add(name, seconds)
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Контекстный менеджер для замера этапа обработки запроса (см. `record_stage`)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+class RequestIdFilter(logging.Filter):
+    """Добавляет в записи лога ID текущего запроса (`%(request_id)s`)."""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
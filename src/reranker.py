@@ -0,0 +1,109 @@
+import logging
+import threading
+from collections import OrderedDict
+from src.config import (
+    RERANK_MODEL_NAME, RERANK_MAX_LENGTH, RERANK_BATCH_SIZE, RERANK_SCORE_THRESHOLD, RERANK_MIN_CHUNKS,
+    RERANK_MAX_CHUNKS, RERANK_CACHE_SIZE,
+)
+from src.request_context import stage
+
+logger = logging.getLogger(__name__)
+
+def initialize_reranker_model():
+    """
+    Загружает кросс-энкодер для переранжирования.
+    Как и эмбеддинг-модель, импортируется лениво: нужен только при включенном переранжировании.
+    """
+    import torch
+    from sentence_transformers import CrossEncoder
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = CrossEncoder(RERANK_MODEL_NAME, max_length=RERANK_MAX_LENGTH, device=device)
+    logger.info(f"Модель переранжирования '{RERANK_MODEL_NAME}' загружена на {device.upper()}.")
+    return model
+
+class Reranker:
+    """
+    Переранжирование кандидатов поиска кросс-энкодером.
+
+    Кросс-энкодер оценивает пару (запрос, чанк) целиком и точнее векторной близости,
+    поэтому поиск может запросить кандидатов с запасом, а агенту отдать только
+    чанки с оценкой не ниже `threshold` — от `min_chunks` до `max_chunks` штук.
+
+    Оценки пар хранятся в LRU-кэше по ключу (запрос, ID чанка): ID чанка производен
+    от его содержимого, поэтому оценка не устаревает при обновлении базы знаний.
+    `model` — любой объект с методом `predict(pairs, batch_size=...)` (например, `CrossEncoder`).
+    """
+
+    def __init__(self, model, threshold=RERANK_SCORE_THRESHOLD, min_chunks=RERANK_MIN_CHUNKS,
+                 max_chunks=RERANK_MAX_CHUNKS, batch_size=RERANK_BATCH_SIZE, cache_size=RERANK_CACHE_SIZE):
+        self.model = model
+        self.threshold = threshold
+        self.min_chunks = min_chunks
+        self.max_chunks = max_chunks
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score(self, query: str, hits) -> list[float]:
+        """Возвращает оценки релевантности чанков запросу; модель вызывается одним батчем только для новых пар."""
+        scores = [None] * len(hits)
+        missing = []
+        with self._lock:
+            for i, hit in enumerate(hits):
+                key = (query, hit['id'])
+                cached = self._scores.get(key)
+                if cached is None:
+                    missing.append(i)
+                else:
+                    self._scores.move_to_end(key)
+                    scores[i] = cached
+            self.hits += len(hits) - len(missing)
+            self.misses += len(missing)
+
+        if missing:
+            pairs = [(query, hits[i]['document'] or "") for i in missing]
+            with stage('rerank'):
+                predicted = self.model.predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+            with self._lock:
+                for i, value in zip(missing, predicted):
+                    scores[i] = float(value)
+                    self._scores[(query, hits[i]['id'])] = scores[i]
+                while len(self._scores) > self.cache_size:
+                    self._scores.popitem(last=False)
+        return scores
+
+    def rerank(self, query: str, hits) -> list[dict]:
+        """
+        Сортирует кандидатов по оценке кросс-энкодера и отсекает нерелевантные (адаптивный k).
+        Возвращает результаты в формате `search_chunks` с ключом `rerank_score`.
+        """
+        if not hits:
+            return []
+        scores = self.score(query, hits)
+        ranked = sorted(
+            (dict(hit, rerank_score=score) for hit, score in zip(hits, scores)),
+            key=lambda hit: hit['rerank_score'], reverse=True
+        )
+        kept = [hit for hit in ranked[:self.max_chunks] if hit['rerank_score'] >= self.threshold]
+        if len(kept) < self.min_chunks:
+            kept = ranked[:min(self.min_chunks, self.max_chunks)]
+        logger.info(
+            f"Переранжирование: кандидатов {len(hits)}, оставлено {len(kept)} "
+            f"(лучшая оценка {ranked[0]['rerank_score']:.3f}, порог {self.threshold})."
+        )
+        return kept
+
+    def stats(self) -> dict:
+        """Возвращает статистику кэша оценок пар."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'cache_size': len(self._scores),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
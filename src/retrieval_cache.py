@@ -0,0 +1,190 @@
+import os
+import re
+import json
+import logging
+import threading
+from collections import OrderedDict, Counter
+from src.answer_cache import normalize_question
+from src.config import (
+    RETRIEVAL_CACHE_MAX_ENTRIES, RETRIEVAL_QUERY_LOG_PATH, RETRIEVAL_QUERY_LOG_MAX_QUERIES, K_SEARCH_CANDIDATES,
+    RERANK_ENABLED, RERANK_CANDIDATES,
+)
+
+logger = logging.getLogger(__name__)
+
+# Строка лога поиска (см. vector_store.search_chunks и KnowledgeBaseRetriever.call)
+_LOG_QUERY_RE = re.compile(r"Поиск информации по запросу: '(.*)'(?: \(из кэша\))?$")
+
+def make_key(query: str, k: int, where=None) -> tuple:
+    """Ключ кэша: нормализованный запрос, k и фильтр по метаданным в каноническом виде."""
+    return normalize_question(query), int(k), json.dumps(where, sort_keys=True, ensure_ascii=False) if where else ''
+
+class RetrievalCache:
+    """
+    LRU-кэш кандидатов поиска инструмента `knowledge_base_retriever`: повторный запрос не считает
+    эмбеддинг и не обращается к хранилищу векторов, а фильтрация выданных чанков и переранжирование
+    выполняются после кэша. Записи привязаны к версии базы знаний (`kb_version`) и сбрасываются при ее смене.
+    `get` возвращает копию закэшированных кандидатов и метку версии, `put` сохраняет результат,
+    только если версия не сменилась за время поиска. Частоты запросов сохраняются в журнал,
+    по которому при старте сервера кэш прогревается (`prewarm`).
+    """
+
+    def __init__(self, max_entries=RETRIEVAL_CACHE_MAX_ENTRIES, version_provider=None,
+                 max_logged_queries=RETRIEVAL_QUERY_LOG_MAX_QUERIES):
+        self.max_entries = max_entries
+        self.version_provider = version_provider
+        self.max_logged_queries = max_logged_queries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._version = version_provider() if version_provider else None
+        self._query_counts = Counter()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self):
+        """Сбрасывает кэш, если версия базы знаний изменилась. Вызывается под блокировкой."""
+        if self.version_provider is None:
+            return self._version
+        version = self.version_provider()
+        if version != self._version:
+            if self._entries:
+                logger.info(f"Версия базы знаний изменилась ({self._version} -> {version}). Кэш поиска сброшен.")
+            self._entries.clear()
+            self._version = version
+            self.invalidations += 1
+        return version
+
+    def get(self, key: tuple, record: bool = True):
+        """
+        Возвращает (копия кандидатов или None, версия базы знаний на момент обращения).
+        С `record=False` обращение не учитывается в статистике и журнале запросов (прогрев).
+        """
+        with self._lock:
+            version = self._check_version()
+            if record:
+                self._query_counts[key] += 1
+                if len(self._query_counts) > 2 * self.max_logged_queries:
+                    self._query_counts = Counter(dict(self._query_counts.most_common(self.max_logged_queries)))
+            hits = self._entries.get(key)
+            if hits is None:
+                self.misses += record
+                return None, version
+            self._entries.move_to_end(key)
+            self.hits += record
+        # Кандидаты дополняются полями при переранжировании, поэтому наружу отдаются копии
+        return [dict(hit) for hit in hits], version
+
+    def put(self, key: tuple, hits: list, version=None):
+        """Сохраняет кандидатов поиска, выполненного при версии `version` (метка из `get`)."""
+        with self._lock:
+            if self._check_version() != version:
+                return
+            self._entries[key] = [dict(hit) for hit in hits]
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self):
+        """Полностью очищает кэш."""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'invalidations': self.invalidations,
+            }
+
+    def save_query_log(self, path=RETRIEVAL_QUERY_LOG_PATH) -> int:
+        """
+        Добавляет частоты запросов этого процесса к журналу и атомарно сохраняет
+        не более `max_logged_queries` самых частых. Возвращает количество записей журнала.
+        """
+        with self._lock:
+            counts = Counter(self._query_counts)
+        if not counts:
+            return 0
+        for key, count in load_query_log(path):
+            counts[key] += count
+        return write_query_log(counts.most_common(self.max_logged_queries), path)
+
+    def prewarm(self, search, path=RETRIEVAL_QUERY_LOG_PATH, limit=None, embedder=None) -> int:
+        """
+        Выполняет заранее самые частые запросы из журнала: `search(query, k, where)` должна
+        вернуть кандидатов поиска. Если передан `embedder`, эмбеддинги запросов сначала
+        считаются одним батчем. Возвращает количество заполненных записей.
+        """
+        entries = load_query_log(path)[:min(limit or self.max_entries, self.max_entries)]
+        if embedder is not None and entries:
+            embedder.encode(list(dict.fromkeys(query for (query, _, _), _ in entries)))
+        warmed = 0
+        for key, _ in entries:
+            query, k, where = key
+            hits, version = self.get(key, record=False)
+            if hits is not None:
+                continue
+            try:
+                self.put(key, search(query, k, json.loads(where) if where else None), version)
+                warmed += 1
+            except Exception as e:
+                logger.warning(f"Не удалось выполнить запрос '{query}' при прогреве кэша поиска: {e}")
+        if warmed:
+            logger.info(f"Кэш поиска прогрет: {warmed} частых запросов из {path}.")
+        return warmed
+
+def load_query_log(path=RETRIEVAL_QUERY_LOG_PATH) -> list:
+    """Читает журнал запросов: список ((запрос, k, фильтр), частота) по убыванию частоты."""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            items = json.load(f)
+        return [((item['query'], int(item['k']), item.get('where', '')), int(item['count'])) for item in items]
+    except FileNotFoundError:
+        return []
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Журнал запросов поиска {path} не прочитан: {e}")
+        return []
+
+def write_query_log(entries, path=RETRIEVAL_QUERY_LOG_PATH) -> int:
+    """Атомарно записывает журнал запросов из пар ((запрос, k, фильтр), частота)."""
+    items = [{'query': query, 'k': k, 'where': where, 'count': count} for (query, k, where), count in entries]
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(items, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+    return len(items)
+
+def main(argv=None):
+    """Дополняет журнал запросов запросами из логов сервера: `python -m src.retrieval_cache --from-log server.log`."""
+    import argparse
+    from src.logger_config import setup_logging
+
+    parser = argparse.ArgumentParser(description="Дополняет журнал запросов поиска запросами из логов сервера.")
+    parser.add_argument('--from-log', nargs='+', required=True, metavar='LOG', help="файлы логов сервера")
+    parser.add_argument('--k', type=int, default=RERANK_CANDIDATES if RERANK_ENABLED else K_SEARCH_CANDIDATES,
+                        help="k для запросов из логов (как у инструмента поиска: K_SEARCH_CANDIDATES, "
+                             "с переранжированием — RERANK_CANDIDATES)")
+    parser.add_argument('--output', default=RETRIEVAL_QUERY_LOG_PATH, help="путь к журналу запросов")
+    args = parser.parse_args(argv)
+
+    setup_logging()
+    counts = Counter(dict(load_query_log(args.output)))
+    found = 0
+    for log_path in args.from_log:
+        with open(log_path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                match = _LOG_QUERY_RE.search(line.rstrip('\n'))
+                if match:
+                    counts[make_key(match.group(1), args.k)] += 1
+                    found += 1
+    written = write_query_log(counts.most_common(RETRIEVAL_QUERY_LOG_MAX_QUERIES), args.output)
+    logger.info(f"Из логов взято {found} запросов; в журнале {written} уникальных запросов: {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,18 +1,40 @@
 import sys
 import os
+import time
 import asyncio
 import logging
 import re
+from typing import Optional
 
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.responses import StreamingResponse, JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from qwen_agent.agents import Assistant
 from qwen_agent.llm import get_chat_model
-from src.agent_config import get_llm_config, get_system_instruction, KnowledgeBaseRetriever
-from src.data_processor import initialize_embedding_model, load_and_chunk_pdfs
-from src.vector_store import get_chroma_collection, populate_collection
-from src.history_manager import init_db, get_history, add_message, prune_history
-from src.config import DOCS_DIR, HISTORY_MESSAGES_TO_KEEP
+from src.agent_config import get_llm_config, get_system_instruction, KnowledgeBaseRetriever, InstrumentedAssistant
+from src.data_processor import initialize_embedding_model
+from src.vector_store import get_vector_store
+from src.ingestion import sync_collection, ensure_lexical_index, read_kb_version
+from src.lexical_index import LexicalIndex
+from src.embedding_cache import EmbeddingCache
+from src.embedder import QueryEmbedder
+from src.embedding_service import RemoteEmbedder
+from src.answer_cache import SemanticAnswerCache, normalize_question
+from src.retrieval_cache import RetrievalCache
+from src.reranker import Reranker, initialize_reranker_model
+from src.agent_executor import AgentExecutor, ExecutorOverloadedError, AgentTimeoutError, run_agent_turn
+from src.streaming import AgentEventTranslator, format_sse, format_ndjson
+from src.history_manager import get_history_store
+from src.session_summarizer import SessionSummarizer
+from src.request_context import begin_request, finish_request, current_trace, current_request_id, request_id_var, stage
+from src import metrics
+from src.config import (
+    DOCS_DIR, INGEST_MANIFEST_PATH, HISTORY_MESSAGES_TO_KEEP, HYBRID_SEARCH_ENABLED, ANSWER_CACHE_ENABLED,
+    INGEST_ON_STARTUP, WARMUP_QUERIES, QUERY_EMBEDDING_SNAPSHOT_PATH, RERANK_ENABLED,
+    EMBEDDING_SERVICE_SOCKET, EMBEDDING_SERVICE_STARTUP_WAIT_SECONDS, BATCH_MAX_QUESTIONS, BATCH_MAX_CONCURRENCY,
+    HISTORY_SUMMARY_ENABLED, RETRIEVAL_CACHE_ENABLED, RETRIEVAL_CACHE_PREWARM_QUERIES,
+    RETRIEVAL_QUERY_LOG_PATH,
+)
 from src.logger_config import setup_logging
 
 # --- Настройка логирования ---
@@ -28,6 +50,17 @@ class AskRequest(BaseModel):
 class AskResponse(BaseModel):
     answer: str
 
+class BatchQuestion(BaseModel):
+    query: str
+    id: Optional[str] = None
+
+class BatchAskRequest(BaseModel):
+    questions: list[BatchQuestion]
+    # Количество одновременно выполняемых ходов агента (не больше BATCH_MAX_CONCURRENCY)
+    concurrency: Optional[int] = None
+    # Использовать семантический кэш ответов (для регрессионных прогонов после изменений его стоит отключать)
+    use_cache: bool = True
+
 def _strip_think_content(text: str) -> str:
     """
     Принудительно удаляет блоки <think>...</think> из ответа LLM.
@@ -36,6 +69,15 @@ def _strip_think_content(text: str) -> str:
         return ""
     return re.sub(r'<think>.*?</think>', '', text, flags=re.DOTALL).strip()
 
+def _extract_final_answer(assistant_responses) -> str:
+    """
+    Извлекает контент из последнего сообщения ассистента.
+    Qwen-Agent с `thought_in_content=False` возвращает ответ в `content` без "мыслей".
+    """
+    if assistant_responses and assistant_responses[-1].get('role') == 'assistant':
+        return _strip_think_content(assistant_responses[-1].get('content', ''))
+    return ""
+
 
 # --- Инициализация FastAPI и состояние приложения ---
 
@@ -46,66 +88,256 @@ app = FastAPI(
 )
 
 # Мы будем использовать state FastAPI для хранения этих объектов
-app_state = {} 
+app_state = {"phase": "starting", "ready": False, "startup_error": None}
 
 # --- Логика инициализации и зависимостей FastAPI ---
 
+def _set_phase(phase: str):
+    app_state["phase"] = phase
+    logger.info(f"Этап запуска: {phase}")
+
 @app.on_event("startup")
 async def startup_event():
     """
-    Асинхронная инициализация всех необходимых компонентов при старте сервера.
+    Запускает инициализацию компонентов в фоне и сразу начинает принимать соединения:
+    `/health` отвечает с первых секунд, а `/ready` — только после полной готовности.
     """
+    app_state["startup_task"] = asyncio.create_task(_initialize())
+
+async def _initialize():
+    """
+    Асинхронная инициализация всех необходимых компонентов сервера.
+    При ошибке сервер остается живым, но не готовым, а `/health` сообщает о сбое.
+    """
+    try:
+        await _initialize_components()
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        logger.error(f"Ошибка инициализации сервера на этапе '{app_state['phase']}': {e}", exc_info=True)
+        app_state["startup_error"] = str(e)
+        _set_phase("failed")
+
+async def _initialize_components():
     logger.info("Инициализация сервера...")
+    loop = asyncio.get_event_loop()
     
     # Инициализация и очистка истории
-    init_db()
-    prune_history()
-
-    loop = asyncio.get_event_loop()
+    _set_phase("history")
+    history_store = get_history_store()
+    app_state["history_store"] = history_store
+    await loop.run_in_executor(None, history_store.init_db)
+    await loop.run_in_executor(None, history_store.prune_history)
+    app_state["history_retention_task"] = asyncio.create_task(history_store.run_retention())
     
     # 1. Инициализация моделей
-    app_state["embedding_model"] = await loop.run_in_executor(None, initialize_embedding_model)
+    _set_phase("embedding_model")
+    if EMBEDDING_SERVICE_SOCKET:
+        # Несколько воркеров: модель загружена один раз в общем сервисе эмбеддингов
+        remote_embedder = RemoteEmbedder(EMBEDDING_SERVICE_SOCKET)
+        if not await loop.run_in_executor(None, remote_embedder.wait_until_ready, EMBEDDING_SERVICE_STARTUP_WAIT_SECONDS):
+            raise RuntimeError(f"Сервис эмбеддингов не отвечает по сокету {EMBEDDING_SERVICE_SOCKET}.")
+        app_state["embedding_model"] = remote_embedder
+    else:
+        app_state["embedding_model"] = await loop.run_in_executor(None, initialize_embedding_model)
+    app_state["embedding_cache"] = await loop.run_in_executor(None, EmbeddingCache)
+    if WARMUP_QUERIES and not EMBEDDING_SERVICE_SOCKET:
+        # Прогрев: первый проход модели заметно медленнее последующих
+        await loop.run_in_executor(None, app_state["embedding_model"].encode, WARMUP_QUERIES)
+    # Сервис эмбеддингов запросов: LRU-кэш и объединение одновременных запросов в батчи
+    app_state["query_embedder"] = QueryEmbedder(app_state["embedding_model"], cache=app_state["embedding_cache"])
+    if not EMBEDDING_SERVICE_SOCKET:
+        # С общим сервисом снимок кэша запросов ведет сам сервис
+        await loop.run_in_executor(None, app_state["query_embedder"].load_snapshot, QUERY_EMBEDDING_SNAPSHOT_PATH)
     logger.info("Модель для эмбеддингов загружена.")
+
+    app_state["reranker"] = None
+    if RERANK_ENABLED:
+        _set_phase("reranker_model")
+        reranker_model = await loop.run_in_executor(None, initialize_reranker_model)
+        app_state["reranker"] = Reranker(reranker_model)
     
-    # 2. Инициализация ChromaDB
-    app_state["chroma_collection"] = await loop.run_in_executor(None, get_chroma_collection)
-    logger.info("База векторов ChromaDB инициализирована.")
+    # 2. Инициализация хранилища векторов (ChromaDB или локальное, см. VECTOR_STORE_BACKEND)
+    _set_phase("vector_store")
+    app_state["chroma_collection"] = await loop.run_in_executor(None, get_vector_store)
+    logger.info("Хранилище векторов инициализировано.")
     
-    # 3. Загрузка документов в базу, если это необходимо
+    # 3. Лексический индекс и (при необходимости) синхронизация базы знаний с папкой документов
+    _set_phase("knowledge_base")
     collection = app_state["chroma_collection"]
-    if await loop.run_in_executor(None, collection.count) == 0:
-        logger.info("База знаний пуста. Начинается обработка и заполнение...")
-        if not os.path.exists(DOCS_DIR) or not os.listdir(DOCS_DIR):
+    lexical_index = None
+    if HYBRID_SEARCH_ENABLED:
+        lexical_index = LexicalIndex()
+        await loop.run_in_executor(None, ensure_lexical_index, collection, lexical_index)
+    app_state["lexical_index"] = lexical_index
+    collection_is_empty = await loop.run_in_executor(None, collection.count) == 0
+    if not os.path.exists(DOCS_DIR) or not os.listdir(DOCS_DIR):
+        if collection_is_empty:
             error_msg = f"Папка '{DOCS_DIR}' пуста или не существует. Невозможно заполнить базу знаний."
             logger.error(error_msg)
             raise RuntimeError(error_msg)
-        
-        document_chunks = await loop.run_in_executor(None, load_and_chunk_pdfs, DOCS_DIR)
-        await loop.run_in_executor(None, populate_collection, collection, document_chunks, app_state["embedding_model"])
+        logger.warning(f"Папка '{DOCS_DIR}' пуста или не существует. Используется текущее содержимое базы знаний.")
+    elif INGEST_ON_STARTUP or collection_is_empty:
+        await loop.run_in_executor(
+            None, sync_collection, collection, app_state["embedding_model"], DOCS_DIR,
+            INGEST_MANIFEST_PATH, app_state["embedding_cache"], lexical_index
+        )
     else:
-        logger.info("База знаний уже заполнена, пропуск обработки документов.")
+        logger.info("Загрузка документов при старте отключена (обновление базы знаний: python -m src.ingestion).")
+
+    # Семантический кэш ответов: привязан к версии базы знаний и сбрасывается при ее смене
+    app_state["answer_cache"] = None
+    if ANSWER_CACHE_ENABLED:
+        app_state["answer_cache"] = SemanticAnswerCache(app_state["query_embedder"], version_provider=read_kb_version)
+    # Кэш результатов поиска для повторяющихся запросов агента, тоже привязан к версии базы знаний
+    app_state["retrieval_cache"] = None
+    if RETRIEVAL_CACHE_ENABLED:
+        app_state["retrieval_cache"] = RetrievalCache(version_provider=read_kb_version)
 
     # 4. Настройка и создание экземпляра агента (бота)
+    _set_phase("agent")
     llm_cfg = get_llm_config()
     system_instruction = get_system_instruction()
     
     # Инициализация и настройка кастомного инструмента
     knowledge_retriever = KnowledgeBaseRetriever(
-        embedding_model=app_state["embedding_model"],
+        embedding_model=app_state["query_embedder"],
         chroma_collection=app_state["chroma_collection"],
-        cfg=llm_cfg
+        cfg=llm_cfg,
+        lexical_index=app_state["lexical_index"],
+        reranker=app_state["reranker"],
+        retrieval_cache=app_state["retrieval_cache"]
     )
 
     tools = [knowledge_retriever]
     
-    app_state["bot"] = Assistant(
-        llm=llm_cfg,
+    # Модель создается здесь, а не внутри Assistant, чтобы закрыть ее пулы соединений при остановке
+    app_state["llm"] = get_chat_model(llm_cfg)
+    app_state["bot"] = InstrumentedAssistant(
+        llm=app_state["llm"],
         system_message=system_instruction,
         function_list=tools
     )
+    app_state["agent_executor"] = AgentExecutor()
+    # Общее для всех пакетов ограничение ходов агента (см. BATCH_MAX_CONCURRENCY)
+    app_state["batch_semaphore"] = asyncio.Semaphore(BATCH_MAX_CONCURRENCY)
+    app_state["summarizer"] = None
+    if HISTORY_SUMMARY_ENABLED:
+        app_state["summarizer"] = SessionSummarizer(app_state["history_store"], app_state["llm"])
+        app_state["summarizer"].start()
+    _register_metric_collectors()
     logger.info("Агент (бот) успешно создан и настроен с KnowledgeBaseRetriever.")
+    app_state["ready"] = True
+    _set_phase("ready")
     logger.info("--- Сервер готов к работе ---")
 
+    # Частые запросы из журнала выполняются в фоне, уже после готовности сервера
+    if app_state["retrieval_cache"] is not None and RETRIEVAL_CACHE_PREWARM_QUERIES:
+        app_state["retrieval_prewarm"] = loop.run_in_executor(
+            None, lambda: app_state["retrieval_cache"].prewarm(
+                knowledge_retriever.search, limit=RETRIEVAL_CACHE_PREWARM_QUERIES, embedder=app_state["query_embedder"]
+            )
+        )
+
+def _register_metric_collectors():
+    """Привязывает метрики-снимки к статистике исполнителя агента и кэшей."""
+    agent_executor = app_state["agent_executor"]
+    metrics.AGENT_SLOTS_OCCUPIED.set_function(lambda: agent_executor.stats()['occupied'])
+    metrics.AGENT_SLOTS_CAPACITY.set_function(lambda: agent_executor.capacity)
+    metrics.AGENT_REJECTED_TOTAL.set_function(lambda: agent_executor.rejected)
+    metrics.AGENT_TIMEOUTS_TOTAL.set_function(lambda: agent_executor.timed_out)
+    query_embedder = app_state["query_embedder"]
+    metrics.QUERY_EMBEDDING_CACHE_HITS.set_function(lambda: query_embedder.hits)
+    metrics.QUERY_EMBEDDING_CACHE_MISSES.set_function(lambda: query_embedder.misses)
+    reranker = app_state.get("reranker")
+    if reranker is not None:
+        metrics.RERANK_CACHE_HITS.set_function(lambda: reranker.hits)
+        metrics.RERANK_CACHE_MISSES.set_function(lambda: reranker.misses)
+    answer_cache = app_state.get("answer_cache")
+    if answer_cache is not None:
+        metrics.ANSWER_CACHE_HITS.set_function(lambda: answer_cache.hits)
+        metrics.ANSWER_CACHE_MISSES.set_function(lambda: answer_cache.misses)
+        metrics.ANSWER_CACHE_SIZE.set_function(lambda: answer_cache.stats()['size'])
+    retrieval_cache = app_state.get("retrieval_cache")
+    if retrieval_cache is not None:
+        metrics.RETRIEVAL_CACHE_HITS.set_function(lambda: retrieval_cache.hits)
+        metrics.RETRIEVAL_CACHE_MISSES.set_function(lambda: retrieval_cache.misses)
+        metrics.RETRIEVAL_CACHE_SIZE.set_function(lambda: retrieval_cache.stats()['size'])
+
+# Служебные эндпоинты не учитываются в метриках запросов и не получают ID запроса
+UNTRACED_PATHS = {"/health", "/ready", "/metrics"}
+# Потоковые ответы завершают учет запроса сами, по окончании потока
+STREAMING_MEDIA_TYPES = ("text/event-stream", "application/x-ndjson")
+
+@app.middleware("http")
+async def request_context_middleware(request: Request, call_next):
+    """
+    Присваивает запросу ID (из заголовка X-Request-ID или новый), который попадает во все логи
+    обработки, и записывает метрики запроса. Потоковые ответы завершают учет сами, по окончании потока.
+    """
+    if request.url.path in UNTRACED_PATHS:
+        return await call_next(request)
+    trace = begin_request(request.url.path, request.headers.get("X-Request-ID"))
+    try:
+        response = await call_next(request)
+    except Exception:
+        finish_request(trace, 500)
+        raise
+    route = request.scope.get("route")
+    trace.endpoint = getattr(route, "path", "unmatched")
+    response.headers["X-Request-ID"] = trace.request_id
+    if not response.headers.get("content-type", "").startswith(STREAMING_MEDIA_TYPES):
+        finish_request(trace, response.status_code)
+    return response
+
+@app.on_event("shutdown")
+def shutdown_event():
+    """
+    Останавливает фоновые компоненты при остановке сервера.
+    """
+    startup_task = app_state.get("startup_task")
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+    answer_cache = app_state.get("answer_cache")
+    if answer_cache:
+        logger.info(f"Статистика кэша ответов: {answer_cache.stats()}")
+    retrieval_cache = app_state.get("retrieval_cache")
+    if retrieval_cache:
+        logger.info(f"Статистика кэша поиска: {retrieval_cache.stats()}")
+        try:
+            retrieval_cache.save_query_log(RETRIEVAL_QUERY_LOG_PATH)
+        except OSError as e:
+            logger.error(f"Не удалось сохранить журнал запросов поиска: {e}")
+    query_embedder = app_state.get("query_embedder")
+    if query_embedder:
+        logger.info(f"Статистика кэша эмбеддингов запросов: {query_embedder.stats()}")
+        if not EMBEDDING_SERVICE_SOCKET:
+            try:
+                query_embedder.save_snapshot(QUERY_EMBEDDING_SNAPSHOT_PATH)
+            except OSError as e:
+                logger.error(f"Не удалось сохранить снимок кэша эмбеддингов запросов: {e}")
+        query_embedder.close()
+    if isinstance(app_state.get("embedding_model"), RemoteEmbedder):
+        app_state["embedding_model"].close()
+    agent_executor = app_state.get("agent_executor")
+    if agent_executor:
+        agent_executor.shutdown()
+    summarizer = app_state.get("summarizer")
+    if summarizer:
+        logger.info(f"Статистика сводок диалогов: {summarizer.stats}")
+        summarizer.close()
+    llm = app_state.get("llm")
+    if hasattr(llm, "close"):
+        logger.info(f"Состояние серверов LLM: {llm.stats()}")
+        llm.close()
+    retention_task = app_state.get("history_retention_task")
+    if retention_task:
+        retention_task.cancel()
+    history_store = app_state.get("history_store")
+    if history_store:
+        logger.info(f"Статистика очистки истории: {history_store.retention_stats}")
+        history_store.close()
+
 def get_bot() -> Assistant:
     """Зависимость (dependency) для получения экземпляра бота в эндпоинтах."""
     bot = app_state.get("bot")
@@ -113,17 +345,91 @@ def get_bot() -> Assistant:
         raise HTTPException(status_code=503, detail="Бот не инициализирован. Попробуйте позже.")
     return bot
 
+def get_agent_executor() -> AgentExecutor:
+    """Зависимость (dependency) для получения исполнителя ходов агента."""
+    agent_executor = app_state.get("agent_executor")
+    if not agent_executor:
+        raise HTTPException(status_code=503, detail="Бот не инициализирован. Попробуйте позже.")
+    return agent_executor
+
+async def _lookup_cached_answer(query: str, history: list):
+    """
+    Ищет готовый ответ в семантическом кэше. Кэш используется только для первого вопроса
+    сессии: ответ на уточняющий вопрос зависит от истории диалога.
+    Возвращает (ответ или None, версия базы знаний для `_store_cached_answer`).
+    """
+    answer_cache = app_state.get("answer_cache")
+    if answer_cache is None or history:
+        return None, None
+    loop = asyncio.get_running_loop()
+    try:
+        with stage('answer_cache_lookup'):
+            return await loop.run_in_executor(None, answer_cache.lookup, query)
+    except Exception as e:
+        logger.error(f"Ошибка поиска в кэше ответов: {e}", exc_info=True)
+        return None, None
+
+async def _store_cached_answer(query: str, answer: str, version):
+    """
+    Сохраняет ответ на первый вопрос сессии в семантический кэш
+    (если версия базы знаний не сменилась с `_lookup_cached_answer`).
+    """
+    answer_cache = app_state.get("answer_cache")
+    if answer_cache is None or not answer:
+        return
+    loop = asyncio.get_running_loop()
+    try:
+        with stage('answer_cache_store'):
+            await loop.run_in_executor(None, answer_cache.store, query, answer, version)
+    except Exception as e:
+        logger.error(f"Ошибка записи в кэш ответов: {e}", exc_info=True)
+
+async def _save_cached_turn(session_id: str, query: str, answer: str):
+    """Записывает в историю вопрос и ответ, выданный из кэша."""
+    history_store = get_history_store()
+    with stage('history_write'):
+        await history_store.aadd_message(session_id, 'user', query)
+        await history_store.aadd_message(session_id, 'assistant', answer)
+
+def _schedule_summary(session_id: str):
+    """Ставит сессию в очередь на обновление сводки диалога (выполняется в фоне)."""
+    summarizer = app_state.get("summarizer")
+    if summarizer is not None:
+        summarizer.schedule(session_id)
+
 # --- API эндпоинты ---
 
 @app.get("/", summary="Проверка работы сервера")
 def read_root():
     return {"status": "SVO RAG AI Assistant API is running"}
 
+@app.get("/metrics", summary="Метрики в формате Prometheus")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/health", summary="Проверка жизнеспособности процесса (liveness)")
+def health():
+    """Отвечает сразу после запуска процесса. 503 — только если инициализация завершилась ошибкой."""
+    if app_state["phase"] == "failed":
+        return JSONResponse(status_code=503, content={"status": "failed", "detail": app_state["startup_error"]})
+    return {"status": "ok", "phase": app_state["phase"]}
+
+@app.get("/ready", summary="Проверка готовности к обработке запросов (readiness)")
+def ready():
+    """200, когда модель, база знаний и агент инициализированы; иначе 503 с текущим этапом запуска."""
+    if not app_state["ready"]:
+        return JSONResponse(status_code=503, content={"status": "not_ready", "phase": app_state["phase"]})
+    return {"status": "ready"}
+
 @app.post("/api/v1/ask", response_model=AskResponse, summary="Задать вопрос ассистенту")
-async def ask(request: AskRequest, bot: Assistant = Depends(get_bot)):
+async def ask(request: AskRequest, bot: Assistant = Depends(get_bot),
+              agent_executor: AgentExecutor = Depends(get_agent_executor)):
     """
     Принимает вопрос, обрабатывает его с помощью RAG-агента и возвращает полный ответ.
     Учитывает историю диалога по session_id.
+    Агент и работа с БД выполняются вне цикла событий; при переполненной очереди
+    возвращается 429, при превышении таймаута — 504.
+    Ответ на первый вопрос сессии может быть выдан из семантического кэша без запуска агента.
     """
     query = request.query
     session_id = request.session_id
@@ -131,41 +437,312 @@ async def ask(request: AskRequest, bot: Assistant = Depends(get_bot)):
     if not query or not session_id:
         raise HTTPException(status_code=400, detail="Поля 'query' и 'session_id' не могут быть пустыми")
 
+    history_store = get_history_store()
     try:
         # 1. Получаем историю диалога
-        messages = get_history(session_id, limit=HISTORY_MESSAGES_TO_KEEP)
-        
-        # 2. Добавляем текущий вопрос пользователя
-        messages.append({'role': 'user', 'content': query})
-        
-        # 3. Сохраняем вопрос пользователя в БД
-        add_message(session_id, 'user', query)
-
-        final_content = ""
-        assistant_responses = []
-
-        # Запускаем генератор и дожидаемся, пока он полностью отработает.
-        # Переменная assistant_responses будет содержать итоговый список сообщений от ассистента.
-        for responses in bot.run(messages=messages):
-            assistant_responses = responses
-
-        # Извлекаем контент из последнего сообщения ассистента.
-        # Qwen-Agent с `thought_in_content=False` возвращает ответ в `content` без "мыслей".
-        if assistant_responses and assistant_responses[-1].get('role') == 'assistant':
-            raw_content = assistant_responses[-1].get('content', '')
-            final_content = _strip_think_content(raw_content)
+        with stage('history_read'):
+            messages = await history_store.aget_history(
+                session_id, limit=HISTORY_MESSAGES_TO_KEEP, include_summary=HISTORY_SUMMARY_ENABLED
+            )
+        is_first_question = not messages
+
+        # 2. Для первого вопроса сессии пробуем выдать готовый ответ из кэша, не занимая агента
+        cached_answer, cache_version = await _lookup_cached_answer(query, messages)
+        if cached_answer is not None:
+            await _save_cached_turn(session_id, query, cached_answer)
+            return AskResponse(answer=cached_answer)
+
+        # Место в очереди резервируется до записи в БД, чтобы отклоненный запрос ничего не записал
+        async with agent_executor.slot() as slot:
+            # 3. Добавляем текущий вопрос пользователя
+            messages.append({'role': 'user', 'content': query})
+            
+            # 4. Сохраняем вопрос пользователя в БД
+            with stage('history_write'):
+                await history_store.aadd_message(session_id, 'user', query)
+
+            # 5. Запускаем агента в пуле исполнителя и дожидаемся, пока он полностью отработает.
+            # Переменная assistant_responses будет содержать итоговый список сообщений от ассистента.
+            assistant_responses = await slot.run(run_agent_turn, bot, messages)
+
+        final_content = _extract_final_answer(assistant_responses)
         
         if final_content:
-            # 5. Сохраняем ответ ассистента в БД
-            add_message(session_id, 'assistant', final_content)
+            # 6. Сохраняем ответ ассистента в БД и в кэш ответов
+            with stage('history_write'):
+                await history_store.aadd_message(session_id, 'assistant', final_content)
+            _schedule_summary(session_id)
+            if is_first_question:
+                await _store_cached_answer(query, final_content, cache_version)
 
         return AskResponse(answer=final_content)
 
+    except ExecutorOverloadedError as e:
+        logger.warning(f"Запрос отклонен: {e}")
+        raise HTTPException(status_code=429, detail="Сервер перегружен. Повторите запрос позже.")
+    except AgentTimeoutError as e:
+        logger.error(f"Таймаут обработки запроса: {e}")
+        raise HTTPException(status_code=504, detail="Превышено время ожидания ответа ассистента.")
     except Exception as e:
         logger.error(f"Критическая ошибка при обработке запроса: {e}", exc_info=True)
         # Возвращаем общее сообщение об ошибке, но в логах будет видно детальное исключение
         raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
 
+async def _stream_answer(bot: Assistant, slot, session_id: str, messages: list, cache_query: str = None,
+                         cache_version=None, trace=None):
+    """
+    Асинхронный генератор SSE-событий для одного хода агента.
+    Агент выполняется в пуле исполнителя, промежуточные списки сообщений передаются
+    в цикл событий через очередь и превращаются в события `delta`, `tool_call`, `tool_result`.
+    В конце ответ сохраняется в историю и отправляется событие `done` (или `error`).
+    Если передан `cache_query`, итоговый ответ сохраняется в кэш ответов для этого вопроса
+    (`cache_version` — версия базы знаний из `_lookup_cached_answer`).
+    Учет запроса (`trace`) завершается по окончании потока.
+    """
+    loop = asyncio.get_running_loop()
+    status = 200
+    queue = asyncio.Queue()
+    translator = AgentEventTranslator()
+
+    def on_responses(responses):
+        # Копируем сообщения: Qwen-Agent продолжает изменять список в рабочем потоке
+        snapshot = [dict(message) for message in responses]
+        loop.call_soon_threadsafe(queue.put_nowait, snapshot)
+
+    try:
+        future = slot.submit(run_agent_turn, bot, messages, on_responses=on_responses)
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(queue.put_nowait, None))
+        deadline = loop.time() + slot.timeout
+
+        finished = False
+        while not finished:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise slot.timeout_error()
+            try:
+                item = await asyncio.wait_for(queue.get(), remaining)
+            except asyncio.TimeoutError:
+                raise slot.timeout_error()
+            # Списки сообщений накопительные, поэтому достаточно обработать самый свежий
+            while item is not None and not queue.empty():
+                item = queue.get_nowait()
+            if item is None:
+                finished = True
+                continue
+            for event, data in translator.feed(item):
+                yield format_sse(event, data)
+
+        assistant_responses = future.result()
+        for event, data in translator.feed(assistant_responses) + translator.finish():
+            yield format_sse(event, data)
+
+        final_content = _extract_final_answer(assistant_responses)
+        if final_content:
+            with stage('history_write'):
+                await get_history_store().aadd_message(session_id, 'assistant', final_content)
+            _schedule_summary(session_id)
+            if cache_query is not None:
+                await _store_cached_answer(cache_query, final_content, cache_version)
+        yield format_sse('done', {'answer': final_content})
+
+    except AgentTimeoutError as e:
+        status = 504
+        logger.error(f"Таймаут обработки потокового запроса: {e}")
+        yield format_sse('error', {'detail': "Превышено время ожидания ответа ассистента."})
+    except Exception as e:
+        status = 500
+        logger.error(f"Критическая ошибка при потоковой обработке запроса: {e}", exc_info=True)
+        yield format_sse('error', {'detail': f"Внутренняя ошибка сервера: {str(e)}"})
+    finally:
+        slot.release()
+        if trace is not None:
+            finish_request(trace, status)
+
+async def _stream_cached_answer(answer: str, trace=None):
+    """SSE-события для ответа из кэша: весь текст одним `delta` и сразу `done`."""
+    try:
+        yield format_sse('delta', {'content': answer})
+        yield format_sse('done', {'answer': answer})
+    finally:
+        if trace is not None:
+            finish_request(trace, 200)
+
+@app.post("/api/v1/ask/stream", summary="Задать вопрос ассистенту с потоковым ответом (SSE)")
+async def ask_stream(request: AskRequest, bot: Assistant = Depends(get_bot),
+                     agent_executor: AgentExecutor = Depends(get_agent_executor)):
+    """
+    Принимает вопрос и возвращает ответ потоком Server-Sent Events по мере генерации.
+    События: `delta` (фрагмент текста), `status` (уже отправленный текст оказался пояснением
+    перед вызовом инструмента),
+    `tool_call` и `tool_result` (ход поиска по базе знаний),
+    `done` (итоговый ответ, уже сохраненный в историю) или `error`.
+    """
+    query = request.query
+    session_id = request.session_id
+
+    if not query or not session_id:
+        raise HTTPException(status_code=400, detail="Поля 'query' и 'session_id' не могут быть пустыми")
+
+    history_store = get_history_store()
+    try:
+        with stage('history_read'):
+            messages = await history_store.aget_history(
+                session_id, limit=HISTORY_MESSAGES_TO_KEEP, include_summary=HISTORY_SUMMARY_ENABLED
+            )
+        is_first_question = not messages
+        cached_answer, cache_version = await _lookup_cached_answer(query, messages)
+        if cached_answer is not None:
+            await _save_cached_turn(session_id, query, cached_answer)
+    except Exception as e:
+        logger.error(f"Критическая ошибка при обработке запроса: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+    sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if cached_answer is not None:
+        return StreamingResponse(_stream_cached_answer(cached_answer, current_trace()), media_type="text/event-stream", headers=sse_headers)
+
+    try:
+        slot = agent_executor.acquire_slot()
+    except ExecutorOverloadedError as e:
+        logger.warning(f"Запрос отклонен: {e}")
+        raise HTTPException(status_code=429, detail="Сервер перегружен. Повторите запрос позже.")
+
+    try:
+        messages.append({'role': 'user', 'content': query})
+        with stage('history_write'):
+            await history_store.aadd_message(session_id, 'user', query)
+    except Exception as e:
+        slot.release()
+        logger.error(f"Критическая ошибка при обработке запроса: {e}", exc_info=True)
+        raise HTTPException(status_code=500, detail=f"Внутренняя ошибка сервера: {str(e)}")
+
+    return StreamingResponse(
+        _stream_answer(bot, slot, session_id, messages, cache_query=query if is_first_question else None,
+                       cache_version=cache_version, trace=current_trace()),
+        media_type="text/event-stream",
+        headers=sse_headers,
+    )
+
+async def _answer_batch_question(bot: Assistant, agent_executor: AgentExecutor, query: str, use_cache: bool) -> dict:
+    """
+    Отвечает на один вопрос пакета без истории диалога. Место у исполнителя резервируется
+    на общих основаниях: если очередь заполнена интерактивными запросами, вопрос получает статус
+    `rejected`. Таймаут хода отсчитывается с начала выполнения, а не с постановки в очередь пула.
+    """
+    started = time.perf_counter()
+    result = {'status': 'ok', 'answer': '', 'cached': False}
+    try:
+        cached_answer, cache_version = await _lookup_cached_answer(query, []) if use_cache else (None, None)
+        if cached_answer is not None:
+            result.update(answer=cached_answer, cached=True)
+        else:
+            slot = agent_executor.acquire_slot()
+            try:
+                assistant_responses = await slot.run(run_agent_turn, bot, [{'role': 'user', 'content': query}],
+                                                     include_queue=False)
+            finally:
+                slot.release()
+            result['answer'] = _extract_final_answer(assistant_responses)
+            if use_cache:
+                await _store_cached_answer(query, result['answer'], cache_version)
+    except ExecutorOverloadedError as e:
+        logger.warning(f"Вопрос пакета отклонен: {e}")
+        result.update(status='rejected', detail="Сервер перегружен, повторите вопрос позже.")
+    except AgentTimeoutError as e:
+        logger.error(f"Таймаут обработки вопроса пакета: {e}")
+        result.update(status='timeout', detail="Превышено время ожидания ответа ассистента.")
+    except Exception as e:
+        logger.error(f"Ошибка при обработке вопроса пакета: {e}", exc_info=True)
+        result.update(status='error', detail=f"Внутренняя ошибка сервера: {str(e)}")
+    result['elapsed_ms'] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+async def _stream_batch(bot: Assistant, agent_executor: AgentExecutor, request: BatchAskRequest, trace=None):
+    """
+    Асинхронный генератор NDJSON для пакета вопросов:
+
+    - одинаковые (после нормализации) вопросы обрабатываются один раз, результат выдается для каждого;
+    - при использовании кэша ответов эмбеддинги нормализованных вопросов (ключи, по которым кэш ищет ответ)
+      считаются одним батчем, дальше кэш берет их из LRU-кэша эмбеддингов;
+    - ходы агента выполняются параллельно, не более `concurrency` одновременно в пакете
+      и не более `BATCH_MAX_CONCURRENCY` во всех пакетах вместе;
+    - строка с результатом отправляется, как только вопрос обработан (порядок — по готовности,
+      поле `index` — позиция вопроса в запросе); последняя строка — итог пакета (`summary`).
+    """
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    status = 200
+    questions = request.questions
+    concurrency = max(1, min(request.concurrency or BATCH_MAX_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    batch_id = current_request_id()
+
+    groups = {}
+    for index, question in enumerate(questions):
+        groups.setdefault(normalize_question(question.query), []).append(index)
+
+    results = asyncio.Queue()
+    semaphore = asyncio.Semaphore(concurrency)
+    batch_semaphore = app_state["batch_semaphore"]
+
+    async def answer_group(indices):
+        # Задача получает копию контекста: свой ID в логах у каждого вопроса пакета
+        request_id_var.set(f"{batch_id}.{indices[0]}")
+        async with semaphore, batch_semaphore:
+            result = await _answer_batch_question(bot, agent_executor, questions[indices[0]].query, request.use_cache)
+        for index in indices:
+            results.put_nowait(dict(result, index=index, id=questions[index].id, query=questions[index].query,
+                                    duplicate_of=indices[0] if index != indices[0] else None))
+
+    tasks = []
+    counts = {'ok': 0, 'timeout': 0, 'rejected': 0, 'error': 0, 'cached': 0}
+    try:
+        query_embedder = app_state.get("query_embedder")
+        if request.use_cache and app_state.get("answer_cache") is not None and query_embedder is not None:
+            with stage('batch_encode'):
+                await loop.run_in_executor(None, query_embedder.encode, list(groups))
+        tasks = [asyncio.create_task(answer_group(indices)) for indices in groups.values()]
+        for _ in range(len(questions)):
+            result = await results.get()
+            counts[result['status']] += 1
+            counts['cached'] += result['cached']
+            yield format_ndjson(result)
+        yield format_ndjson({'summary': dict(
+            counts, questions=len(questions), unique_questions=len(groups), concurrency=concurrency,
+            elapsed_ms=round((time.perf_counter() - started) * 1000, 1),
+        )})
+    except Exception as e:
+        status = 500
+        logger.error(f"Критическая ошибка при обработке пакета вопросов: {e}", exc_info=True)
+        yield format_ndjson({'error': f"Внутренняя ошибка сервера: {str(e)}"})
+    finally:
+        # При обрыве соединения незавершенные вопросы отменяются, их места в очереди освобождаются
+        for task in tasks:
+            task.cancel()
+        if trace is not None:
+            finish_request(trace, status)
+
+@app.post("/api/v1/ask/batch", summary="Пакетная обработка вопросов (NDJSON)")
+async def ask_batch(request: BatchAskRequest, bot: Assistant = Depends(get_bot),
+                    agent_executor: AgentExecutor = Depends(get_agent_executor)):
+    """
+    Принимает список вопросов (например, для регрессионной проверки) и возвращает ответы потоком NDJSON
+    по мере готовности. Вопросы обрабатываются независимо, без истории диалога, и в историю не записываются.
+    Каждая строка: `index`, `id`, `query`, `status` (ok, timeout, rejected, error), `answer`, `cached`, `duplicate_of`,
+    `elapsed_ms`; последняя строка — `summary`.
+    """
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="Список 'questions' не может быть пустым")
+    if len(request.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=413, detail=f"Слишком много вопросов в пакете (максимум {BATCH_MAX_QUESTIONS})")
+    if any(not question.query.strip() for question in request.questions):
+        raise HTTPException(status_code=400, detail="Поле 'query' не может быть пустым")
+
+    return StreamingResponse(
+        _stream_batch(bot, agent_executor, request, trace=current_trace()),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 # --- Запуск сервера (для локальной отладки) ---
 
 if __name__ == "__main__":
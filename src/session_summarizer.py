@@ -0,0 +1,105 @@
+import re
+import queue
+import logging
+import threading
+from src.config import (
+    HISTORY_MESSAGES_TO_KEEP, HISTORY_SUMMARY_MIN_NEW_MESSAGES, HISTORY_SUMMARY_MAX_CHARS,
+    HISTORY_SUMMARY_MESSAGE_MAX_CHARS,
+)
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = """Ты ведешь краткую сводку консультации по законам о социальной поддержке.
+Обнови сводку с учетом новых сообщений диалога. Сохрани то, что важно для следующих вопросов:
+кто пользователь и к какой льготной категории относится, о чем он спрашивал, какие ответы получил
+(с указанием документов и статей), что осталось невыясненным. Не добавляй ничего от себя.
+Пиши по-русски, сжато, не более {max_chars} символов, без вступлений и заголовков.
+
+Текущая сводка:
+{summary}
+
+Новые сообщения:
+{messages}
+
+Обновленная сводка:"""
+
+_ROLE_LABELS = {'user': 'Пользователь', 'assistant': 'Ассистент'}
+_THINK_RE = re.compile(r'<think>.*?</think>', re.DOTALL)
+
+def _truncate(text: str, max_chars: int) -> str:
+    return text if len(text) <= max_chars else text[:max_chars].rstrip() + "…"
+
+class SessionSummarizer:
+    """
+    Обновляет сводки сессий (таблица `session_summaries`) в одном фоновом потоке, чтобы не задерживать
+    ответы; пока сводка не обновлена, агент видит прежнюю. `schedule(session_id)` ставит сессию
+    в очередь (повторная постановка до обработки не дублирует работу); сводка пересчитывается
+    из прежней сводки и новых сообщений, когда за окно последних сообщений вышло
+    не меньше `min_new_messages` из них.
+    """
+
+    def __init__(self, history_store, llm, keep_last=HISTORY_MESSAGES_TO_KEEP,
+                 min_new_messages=HISTORY_SUMMARY_MIN_NEW_MESSAGES, max_chars=HISTORY_SUMMARY_MAX_CHARS):
+        self.history_store = history_store
+        self.llm = llm
+        self.keep_last = keep_last
+        self.min_new_messages = min_new_messages
+        self.max_chars = max_chars
+        self._queue = queue.Queue()
+        self._scheduled = set()
+        self._lock = threading.Lock()
+        self._worker = None
+        self.stats = {'updated': 0, 'skipped': 0, 'failed': 0}
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="history-summarizer", daemon=True)
+            self._worker.start()
+
+    def schedule(self, session_id: str):
+        """Ставит сессию в очередь на обновление сводки. Вызов не блокирует поток."""
+        with self._lock:
+            if session_id in self._scheduled:
+                return
+            self._scheduled.add(session_id)
+        self._queue.put(session_id)
+
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            if session_id is None:
+                return
+            with self._lock:
+                self._scheduled.discard(session_id)
+            try:
+                self.update(session_id)
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"Не удалось обновить сводку сессии {session_id}: {e}", exc_info=True)
+
+    def update(self, session_id: str) -> bool:
+        """Обновляет сводку сессии, если накопилось достаточно новых сообщений. Возвращает True при обновлении."""
+        summary, rows = self.history_store.get_unsummarized(session_id, self.keep_last)
+        if len(rows) < self.min_new_messages:
+            self.stats['skipped'] += 1
+            return False
+        messages = "\n".join(
+            f"{_ROLE_LABELS.get(role, role)}: {_truncate(content, HISTORY_SUMMARY_MESSAGE_MAX_CHARS)}"
+            for _, role, content in rows
+        )
+        prompt = SUMMARY_PROMPT.format(summary=summary or "(пусто)", messages=messages, max_chars=self.max_chars)
+        responses = self.llm.chat(messages=[{'role': 'user', 'content': prompt}], stream=False)
+        new_summary = _THINK_RE.sub('', responses[-1]['content'] if responses else '').strip()
+        if not new_summary:
+            raise RuntimeError("LLM вернула пустую сводку.")
+        self.history_store.save_summary(session_id, _truncate(new_summary, self.max_chars), rows[-1][0])
+        self.stats['updated'] += 1
+        logger.info(f"Сводка сессии {session_id} обновлена ({len(rows)} новых сообщений, {len(new_summary)} символов).")
+        return True
+
+    def close(self, timeout=10):
+        """Останавливает фоновый поток; необработанные сессии будут учтены при следующем ответе."""
+        if self._worker is not None:
+            self._queue.put(None)
+            self._worker.join(timeout=timeout)
+            self._worker = None
@@ -0,0 +1,170 @@
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+THINK_OPEN = '<think>'
+THINK_CLOSE = '</think>'
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Длина самого длинного суффикса `text`, являющегося началом `tag`."""
+    for length in range(min(len(text), len(tag) - 1), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+class ThinkFilter:
+    """
+    Инкрементально удаляет блоки <think>...</think> из потока текста.
+    Теги могут быть разрезаны между чанками: незавершенный фрагмент тега
+    придерживается в буфере до прихода следующего чанка.
+    Ведущие пробелы ответа отбрасываются, как и в `_strip_think_content`.
+    """
+
+    def __init__(self):
+        self._buffer = ""
+        self._inside = False
+        self._started = False
+
+    def _clean(self, text: str) -> str:
+        if not self._started:
+            text = text.lstrip()
+            self._started = bool(text)
+        return text
+
+    def feed(self, text: str) -> str:
+        """Принимает очередной чанк и возвращает текст, который можно показать пользователю."""
+        self._buffer += text
+        output = []
+        while self._buffer:
+            tag = THINK_CLOSE if self._inside else THINK_OPEN
+            index = self._buffer.find(tag)
+            if index >= 0:
+                if not self._inside:
+                    output.append(self._buffer[:index])
+                self._buffer = self._buffer[index + len(tag):]
+                self._inside = not self._inside
+                continue
+            keep = _partial_tag_length(self._buffer, tag)
+            if not self._inside:
+                output.append(self._buffer[:len(self._buffer) - keep])
+            self._buffer = self._buffer[len(self._buffer) - keep:]
+            break
+        return self._clean("".join(output))
+
+    def flush(self) -> str:
+        """Завершает поток и возвращает остаток буфера (вне блока <think>)."""
+        rest = "" if self._inside else self._buffer
+        self._buffer = ""
+        return self._clean(rest)
+
+# Разметка вызова инструмента в тексте модели (форматы nous и qwen). Qwen-Agent вырезает ее из `content`
+# только целиком, поэтому ее незавершенное начало придерживается, чтобы не попасть в ответ
+TOOL_CALL_MARKERS = ('<tool_call>', '✿FUNCTION✿')
+
+def _tool_call_tail_length(text: str) -> int:
+    """Длина хвоста `text`, который является разметкой вызова инструмента или ее началом."""
+    for marker in TOOL_CALL_MARKERS:
+        index = text.find(marker)
+        if index >= 0:
+            return len(text) - index
+    return max(_partial_tag_length(text, marker) for marker in TOOL_CALL_MARKERS)
+
+class AgentEventTranslator:
+    """
+    Превращает накопительные списки сообщений, которые отдает `bot.run`,
+    в инкрементальные события для клиента:
+
+    - `delta` — новый фрагмент текста ассистента (без блоков <think> и разметки вызова инструмента);
+    - `status` — текст сообщения ассистента целиком, если за ним последовал вызов инструмента:
+      этот текст уже отправлен фрагментами `delta`, но это пояснение, а не ответ (итоговый ответ — в `done`);
+    - `tool_call` — агент вызвал инструмент (имя и аргументы);
+    - `tool_result` — инструмент вернул результат.
+
+    Текст отправляется сразу; придерживается только хвост, который может оказаться началом
+    разметки вызова инструмента (не длиннее самой разметки).
+    """
+
+    def __init__(self):
+        self._emitted = {}       # индекс сообщения -> уже обработанная длина content
+        self._filters = {}       # индекс сообщения -> ThinkFilter
+        self._pending = {}       # индекс сообщения -> придержанный хвост текста
+        self._texts = {}         # индекс сообщения -> отправленный текст
+        self._settled = set()    # индексы завершенных сообщений
+        self._announced = set()  # индексы сообщений, о которых уже отправлено событие инструмента
+
+    def feed(self, responses) -> list[tuple[str, dict]]:
+        events = []
+        for index, message in enumerate(responses):
+            role = message.get('role')
+            next_message = responses[index + 1] if index + 1 < len(responses) else None
+            if role == 'assistant':
+                function_call = message.get('function_call')
+                if function_call:
+                    # Вызов инструмента известен полностью, только когда за ним появилось следующее сообщение
+                    if next_message is not None and index not in self._announced:
+                        self._announced.add(index)
+                        events.append(('tool_call', {
+                            'name': function_call.get('name'),
+                            'arguments': function_call.get('arguments'),
+                        }))
+                    continue
+                events.extend(self._content_delta(index, message.get('content')))
+                if next_message is not None:
+                    before_tool = next_message.get('role') == 'assistant' and next_message.get('function_call')
+                    events.extend(self._settle(index, before_tool=bool(before_tool)))
+            elif role == 'function' and index not in self._announced:
+                self._announced.add(index)
+                events.append(('tool_result', {'name': message.get('name')}))
+        return events
+
+    def _emit(self, index, text):
+        if not text:
+            return []
+        self._texts[index] = self._texts.get(index, "") + text
+        return [('delta', {'content': text})]
+
+    def _content_delta(self, index, content):
+        if not isinstance(content, str) or index in self._settled:
+            return []
+        emitted = self._emitted.get(index, 0)
+        if len(content) <= emitted:
+            return []
+        self._emitted[index] = len(content)
+        text = self._pending.pop(index, "") + self._filters.setdefault(index, ThinkFilter()).feed(content[emitted:])
+        keep = _tool_call_tail_length(text)
+        if keep:
+            self._pending[index] = text[len(text) - keep:]
+        return self._emit(index, text[:len(text) - keep])
+
+    def _settle(self, index, before_tool=False):
+        """Отправляет остаток текста завершенного сообщения."""
+        if index in self._settled:
+            return []
+        self._settled.add(index)
+        rest = self._pending.pop(index, "")
+        if index in self._filters:
+            rest += self._filters[index].flush()
+        if before_tool:
+            # Придержанный хвост перед вызовом инструмента — начало его разметки
+            rest = rest[:len(rest) - _tool_call_tail_length(rest)]
+        events = self._emit(index, rest)
+        text = self._texts.get(index, "").strip()
+        if before_tool and text:
+            events.append(('status', {'content': text}))
+        return events
+
+    def finish(self) -> list[tuple[str, dict]]:
+        """Отдает придержанный текст сообщений после окончания генерации."""
+        events = []
+        for index in sorted(set(self._filters) | set(self._pending)):
+            events.extend(self._settle(index))
+        return events
+
+def format_sse(event: str, data: dict) -> str:
+    """Форматирует событие в формате Server-Sent Events."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def format_ndjson(data: dict) -> str:
+    """Форматирует объект как одну строку NDJSON."""
+    return json.dumps(data, ensure_ascii=False) + "\n"
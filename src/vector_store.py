@@ -1,69 +1,282 @@
-import chromadb
+import hashlib
+import itertools
 import logging
-from src.config import CHROMA_DB_PATH, CHROMA_COLLECTION_NAME
+from src.config import (
+    CHROMA_DB_PATH, CHROMA_COLLECTION_NAME, EMBEDDING_BATCH_SIZE, HYBRID_CANDIDATES, VECTOR_STORE_BACKEND,
+    LOCAL_VECTOR_STORE_PATH, LOCAL_VECTOR_STORE_QUANTIZATION,
+)
+from src.embedding_cache import encode_with_cache
+from src.lexical_index import reciprocal_rank_fusion
+from src.request_context import stage
 
 logger = logging.getLogger(__name__)
 
-def get_chroma_collection():
+class VectorStore:
+    """
+    Интерфейс хранилища векторов: подмножество API коллекции ChromaDB, которым пользуется проект
+    (форматы аргументов и результатов — как у ChromaDB). Реализации:
+    `ChromaVectorStore` и `LocalVectorStore` (src/local_vector_store.py).
+    """
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def upsert(self, ids, embeddings, documents, metadatas=None):
+        raise NotImplementedError
+
+    def update(self, ids, metadatas):
+        raise NotImplementedError
+
+    def delete(self, ids):
+        raise NotImplementedError
+
+    def get(self, ids=None, where=None, include=('documents', 'metadatas'), limit=None, offset=None) -> dict:
+        raise NotImplementedError
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=('documents', 'metadatas', 'distances')) -> dict:
+        raise NotImplementedError
+
+    def persist(self):
+        """Фиксирует изменения на диске. Вызывается после каждого файла при синхронизации базы знаний."""
+
+class ChromaVectorStore(VectorStore):
+    """Хранилище векторов в коллекции ChromaDB (изменения сохраняются самой ChromaDB)."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def count(self) -> int:
+        return self.collection.count()
+
+    def upsert(self, ids, embeddings, documents, metadatas=None):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def update(self, ids, metadatas):
+        self.collection.update(ids=ids, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def get(self, ids=None, where=None, include=('documents', 'metadatas'), limit=None, offset=None) -> dict:
+        return self.collection.get(ids=ids, where=where, include=list(include), limit=limit, offset=offset)
+
+    def query(self, query_embeddings, n_results=10, where=None,
+              include=('documents', 'metadatas', 'distances')) -> dict:
+        return self.collection.query(query_embeddings=query_embeddings, n_results=n_results, where=where,
+                                     include=list(include))
+
+def get_chroma_collection(path=CHROMA_DB_PATH, name=CHROMA_COLLECTION_NAME):
     """
     Инициализирует персистентный клиент ChromaDB и возвращает коллекцию.
     Данные будут храниться на диске в папке 'chroma_db'.
     """
-    client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-    collection = client.get_or_create_collection(name=CHROMA_COLLECTION_NAME)
-    logger.info(f"ChromaDB коллекция '{CHROMA_COLLECTION_NAME}' готова. Текущее количество документов: {collection.count()}.")
+    import chromadb
+
+    client = chromadb.PersistentClient(path=path)
+    collection = client.get_or_create_collection(name=name)
+    logger.info(f"ChromaDB коллекция '{name}' готова. Текущее количество документов: {collection.count()}.")
     return collection
 
-def populate_collection(collection, chunks, model):
+def get_vector_store(backend=VECTOR_STORE_BACKEND, path=None, quantization=LOCAL_VECTOR_STORE_QUANTIZATION) -> VectorStore:
+    """
+    Открывает хранилище векторов выбранного бэкенда:
+    'chroma' — коллекция ChromaDB, 'local' — memory-mapped матрица эмбеддингов (`LocalVectorStore`).
+    """
+    if backend == 'chroma':
+        return ChromaVectorStore(get_chroma_collection(path or CHROMA_DB_PATH))
+    if backend == 'local':
+        from src.local_vector_store import LocalVectorStore
+        store = LocalVectorStore(path or LOCAL_VECTOR_STORE_PATH, quantization=quantization)
+        logger.info(f"Локальное хранилище векторов готово. Текущее количество документов: {store.count()}.")
+        return store
+    raise ValueError(f"Неизвестный бэкенд хранилища векторов: {backend}")
+
+def _chunk_id(source, chunk, seen):
+    digest = hashlib.sha1(f"{source}\x00{chunk}".encode("utf-8")).hexdigest()
+    occurrence = seen.get(digest, 0)
+    seen[digest] = occurrence + 1
+    return digest if occurrence == 0 else f"{digest}-{occurrence}"
+
+def make_chunk_ids(chunks, source=""):
+    """
+    Создает стабильные ID чанков на основе их содержимого и имени исходного файла.
+    Повторная загрузка тех же чанков дает те же ID, поэтому запись идемпотентна.
+    Одинаковые чанки внутри одного файла различаются порядковым суффиксом.
+    """
+    seen = {}
+    return [_chunk_id(source, chunk, seen) for chunk in chunks]
+
+def populate_collection(collection, chunks, model, ids=None, metadatas=None, cache=None, batch_size=EMBEDDING_BATCH_SIZE):
     """
     Заполняет коллекцию ChromaDB чанками документов.
+    `chunks` может быть генератором: эмбеддинги считаются и записываются батчами,
+    так что в памяти одновременно находится только один батч.
+    Если `ids` не переданы, они вычисляются из содержимого чанков.
+    Если передан `cache`, эмбеддинги считаются только для отсутствующих в нем чанков.
+    Возвращает количество записанных чанков.
     """
-    if not chunks:
+    logger.info("Начинается заполнение коллекции...")
+
+    # ID, производные от содержимого, делают повторные запуски идемпотентными
+    seen = {}
+    id_iter = iter(ids) if ids is not None else None
+    metadata_iter = iter(metadatas) if metadatas is not None else None
+    rows = (
+        (chunk, next(id_iter) if id_iter else _chunk_id("", chunk, seen), next(metadata_iter) if metadata_iter else None)
+        for chunk in chunks
+    )
+
+    # Считаем эмбеддинги и добавляем данные в коллекцию батчами для эффективности
+    total = 0
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            break
+        batch_chunks = [row[0] for row in batch]
+        embeddings = encode_with_cache(model, batch_chunks, cache=cache)
+        logger.info(f"Добавление батча в ChromaDB: {total+1}-{total+len(batch)}")
+        collection.upsert(
+            embeddings=embeddings.tolist(), # ChromaDB ожидает list
+            documents=batch_chunks,
+            metadatas=[row[2] for row in batch] if metadata_iter else None,
+            ids=[row[1] for row in batch]
+        )
+        total += len(batch)
+
+    if total == 0:
         logger.warning("Нет чанков для добавления в коллекцию.")
-        return
+        return 0
 
-    logger.info(f"Начинается заполнение коллекции... Всего чанков: {len(chunks)}")
-    
-    # Создаем эмбеддинги для чанков
-    embeddings = model.encode(chunks, show_progress_bar=True, convert_to_numpy=True)
-    
-    # Создаем уникальные ID для каждого чанка, это требование ChromaDB
-    ids = [f"chunk_{i}" for i in range(len(chunks))]
+    logger.info(f"Заполнение коллекции успешно завершено. Добавлено чанков: {total}.")
+    logger.info(f"Новое количество документов в коллекции: {collection.count()}.")
+    return total
+
+def update_chunk_metadata(collection, ids, metadatas):
+    """
+    Обновляет метаданные существующих чанков без пересчета эмбеддингов
+    (например, позиции чанков, сдвинувшихся после правки файла).
+    """
+    ids, metadatas = list(ids), list(metadatas)
+    batch_size = 500
+    for i in range(0, len(ids), batch_size):
+        collection.update(ids=ids[i:i + batch_size], metadatas=metadatas[i:i + batch_size])
+
+def delete_chunks(collection, ids):
+    """
+    Удаляет чанки с указанными ID из коллекции ChromaDB батчами.
+    """
+    ids = list(ids)
+    batch_size = 500
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i + batch_size])
+    if ids:
+        logger.info(f"Из коллекции удалено {len(ids)} чанков.")
+
+
+def build_metadata_filter(doc_type=None, doc_number=None, article=None):
+    """
+    Собирает фильтр ChromaDB (`where`) по метаданным чанков: типу документа, его номеру
+    и номеру статьи (чанк подходит, если статья в нем начинается или продолжается).
+    Возвращает None, если ни одно условие не задано.
+    """
+    conditions = []
+    if doc_type:
+        conditions.append({'doc_type': doc_type})
+    if doc_number:
+        conditions.append({'doc_number': doc_number})
+    if article:
+        conditions.append({'$or': [{'article': article}, {'article_last': article}]})
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+def search_chunks(query, model, collection, k=3, cache=None, where=None) -> list[dict]:
+    """
+    Ищет в коллекции ChromaDB k наиболее релевантных чанков
+    (при переданном `where` — только среди чанков, подходящих под фильтр метаданных).
+    Возвращает список словарей с ключами `id`, `document`, `metadata` и `distance`.
+    """
+    logger.info(f"Поиск информации по запросу: '{query}'")
+    # Создаем эмбеддинг для запроса (кэш на пути запроса используется только для чтения)
+    with stage('embed'):
+        query_embedding = encode_with_cache(model, [query], cache=cache, store=False).tolist()
     
-    # Добавляем данные в коллекцию батчами для эффективности
-    batch_size = 100
-    for i in range(0, len(chunks), batch_size):
-        end_i = min(i + batch_size, len(chunks))
-        logger.info(f"Добавление батча в ChromaDB: {i+1}-{end_i}")
-        collection.add(
-            embeddings=embeddings[i:end_i].tolist(), # ChromaDB ожидает list
-            documents=chunks[i:end_i],
-            ids=ids[i:end_i]
+    # Выполняем поиск в ChromaDB
+    with stage('vector_query'):
+        results = collection.query(
+            query_embeddings=query_embedding,
+            n_results=k,
+            where=where,
+            include=['documents', 'metadatas', 'distances']
         )
     
-    logger.info("Заполнение коллекции успешно завершено.")
-    logger.info(f"Новое количество документов в коллекции: {collection.count()}.")
+    ids = results.get('ids', [[]])[0]
+    documents = results.get('documents', [[]])[0]
+    metadatas = (results.get('metadatas') or [[None] * len(ids)])[0]
+    distances = (results.get('distances') or [[None] * len(ids)])[0]
+    return [
+        {'id': doc_id, 'document': document, 'metadata': metadata or {}, 'distance': distance}
+        for doc_id, document, metadata, distance in zip(ids, documents, metadatas, distances)
+    ]
+
+def hybrid_search(query, model, collection, lexical_index, k=3, candidates=HYBRID_CANDIDATES, cache=None,
+                  where=None) -> list[dict]:
+    """
+    Гибридный поиск: объединяет `candidates` лучших результатов векторного поиска
+    и BM25 по лексическому индексу методом Reciprocal Rank Fusion и возвращает k лучших.
+    Фильтр `where` применяется к обоим видам поиска.
+    Формат результатов как у `search_chunks`, плюс ключ `score` (оценка RRF).
+    """
+    candidates = max(candidates, k)
+    vector_hits = search_chunks(query, model, collection, k=candidates, cache=cache, where=where)
+    allowed_ids = None
+    if where is not None:
+        # Лексический индекс не хранит метаданные: ограничиваем его чанками, подходящими под фильтр
+        with stage('metadata_filter'):
+            allowed_ids = set(collection.get(where=where, include=[])['ids'])
+    with stage('lexical_query'):
+        lexical_hits = lexical_index.search(query, k=candidates, allowed_ids=allowed_ids)
+    fused = reciprocal_rank_fusion([[hit['id'] for hit in vector_hits], [doc_id for doc_id, _ in lexical_hits]])[:k]
+
+    hits_by_id = {hit['id']: hit for hit in vector_hits}
+    # Тексты чанков, найденных только лексическим поиском, дозапрашиваем из коллекции
+    missing_ids = [doc_id for doc_id, _ in fused if doc_id not in hits_by_id]
+    if missing_ids:
+        with stage('chunk_fetch'):
+            extra = collection.get(ids=missing_ids, include=['documents', 'metadatas'])
+        for doc_id, document, metadata in zip(extra['ids'], extra['documents'], extra['metadatas'] or [None] * len(extra['ids'])):
+            hits_by_id[doc_id] = {'id': doc_id, 'document': document, 'metadata': metadata or {}, 'distance': None}
+
+    results = [dict(hits_by_id[doc_id], score=score) for doc_id, score in fused if doc_id in hits_by_id]
+    logger.info(
+        f"Гибридный поиск: векторных кандидатов {len(vector_hits)}, лексических {len(lexical_hits)}, "
+        f"отобрано {len(results)}."
+    )
+    return results
 
+def search_hits(query, model, collection, k=3, cache=None, lexical_index=None, where=None) -> list[dict]:
+    """
+    Ищет k наиболее релевантных чанков и возвращает их с метаданными (формат `search_chunks`).
+    Если передан `lexical_index`, используется гибридный поиск (векторный + BM25).
+    `where` — фильтр по метаданным (см. `build_metadata_filter`).
+    """
+    if lexical_index is not None:
+        return hybrid_search(query, model, collection, lexical_index, k=k, cache=cache, where=where)
+    return search_chunks(query, model, collection, k=k, cache=cache, where=where)
 
-def search_in_store(query, model, collection, k=3) -> list[str]:
+def search_in_store(query, model, collection, k=3, cache=None, lexical_index=None, where=None) -> list[str]:
     """
     Ищет в коллекции ChromaDB k наиболее релевантных чанков и возвращает их как список строк.
+    Если передан `lexical_index`, используется гибридный поиск (векторный + BM25).
     """
     if collection is None:
         logger.error("Коллекция ChromaDB не инициализирована.")
         return ["Коллекция ChromaDB не инициализирована."]
 
-    logger.info(f"Поиск информации по запросу: '{query}'")
-    # Создаем эмбеддинг для запроса
-    query_embedding = model.encode([query]).tolist()
-    
-    # Выполняем поиск в ChromaDB
-    results = collection.query(
-        query_embeddings=query_embedding,
-        n_results=k
-    )
+    hits = search_hits(query, model, collection, k=k, cache=cache, lexical_index=lexical_index, where=where)
     
     # Извлекаем найденные документы для формирования контекста
-    documents = results.get('documents', [[]])[0]
+    documents = [hit['document'] for hit in hits]
     logger.info(f"Найдено {len(documents)} релевантн(ых) чанков.")
-    return documents 
\ No newline at end of file
+    return documents
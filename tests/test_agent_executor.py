@@ -0,0 +1,47 @@
+import time
+import asyncio
+import threading
+import pytest
+from src.agent_executor import AgentExecutor, AgentTimeoutError, ExecutorOverloadedError
+
+def _sleep(seconds, cancel_event):
+    cancel_event.wait(seconds)
+    return seconds
+
+def test_queue_wait_not_counted_without_include_queue():
+    executor = AgentExecutor(max_concurrency=1, queue_size=1, timeout=0.3)
+
+    async def main():
+        busy = executor.acquire_slot()
+        busy.submit(lambda cancel_event: time.sleep(0.4))
+        queued = executor.acquire_slot()
+        try:
+            return await queued.run(_sleep, 0.1, include_queue=False)
+        finally:
+            busy.release()
+            queued.release()
+
+    assert asyncio.run(main()) == 0.1
+    executor.shutdown()
+
+def test_queue_wait_counted_by_default():
+    executor = AgentExecutor(max_concurrency=1, queue_size=1, timeout=0.2)
+    release = threading.Event()
+
+    async def main():
+        busy = executor.acquire_slot()
+        busy.submit(lambda cancel_event: release.wait(1))
+        queued = executor.acquire_slot()
+        with pytest.raises(ExecutorOverloadedError):
+            executor.acquire_slot()
+        try:
+            with pytest.raises(AgentTimeoutError):
+                await queued.run(_sleep, 0.01)
+        finally:
+            release.set()
+            busy.release()
+            queued.release()
+
+    asyncio.run(main())
+    assert executor.timed_out == 1
+    executor.shutdown()
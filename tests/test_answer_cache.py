@@ -0,0 +1,19 @@
+import numpy as np
+from src.answer_cache import SemanticAnswerCache
+
+class _Embedder:
+    def encode(self, texts):
+        return np.array([[1.0, float(len(text))] for text in texts], dtype=np.float32)
+
+def test_store_skipped_when_version_changed_after_lookup():
+    versions = ['v1']
+    cache = SemanticAnswerCache(_Embedder(), max_entries=4, version_provider=lambda: versions[0])
+
+    answer, version = cache.lookup("Какие льготы положены?")
+    assert answer is None and version == 'v1'
+    versions[0] = 'v2'  # база знаний перезагружена, пока агент отвечал
+    cache.store("Какие льготы положены?", "старый ответ", version)
+    assert cache.lookup("Какие льготы положены?") == (None, 'v2')
+
+    cache.store("Какие льготы положены?", "новый ответ", 'v2')
+    assert cache.lookup("какие льготы положены") == ("новый ответ", 'v2')
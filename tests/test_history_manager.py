@@ -0,0 +1,53 @@
+import sqlite3
+from src import metrics
+from src.history_manager import HistoryStore
+
+class _FlakyConnection:
+    """Соединение, у которого первые `failures` вызовов executemany завершаются ошибкой SQLite."""
+
+    def __init__(self, conn, failures):
+        self.conn = conn
+        self.failures = failures
+
+    def __enter__(self):
+        return self.conn.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.conn.__exit__(*exc_info)
+
+    def executemany(self, sql, rows):
+        if self.failures:
+            self.failures -= 1
+            raise sqlite3.OperationalError("database is locked")
+        return self.conn.executemany(sql, rows)
+
+def _failures(outcome):
+    return metrics.HISTORY_WRITE_FAILURES_TOTAL._values.get((outcome,), 0)
+
+def test_write_batch_retries_once(tmp_path):
+    store = HistoryStore(db_path=str(tmp_path / 'history.db'))
+    store.init_db()
+    conn = store._connect()
+    retried, dropped = _failures('retried'), _failures('dropped')
+
+    store._write_batch(_FlakyConnection(conn, failures=1), [('s1', 'user', 'вопрос')])
+    assert store.get_history('s1') == [{'role': 'user', 'content': 'вопрос'}]
+    assert _failures('retried') == retried + 1
+
+    store._write_batch(_FlakyConnection(conn, failures=2), [('s2', 'user', 'вопрос')])
+    assert store.get_history('s2') == []
+    assert _failures('dropped') == dropped + 1
+    conn.close()
+    store.close()
+
+def test_prune_history_updates_metrics(tmp_path):
+    store = HistoryStore(db_path=str(tmp_path / 'history.db'))
+    store.init_db()
+    for i in range(5):
+        store.add_message('s1', 'user', f"сообщение {i}")
+    trimmed = metrics.HISTORY_RETENTION_ROWS_TRIMMED._values.get((), 0)
+
+    assert store.prune_history(messages_to_keep=2, session_ttl_seconds=None, unsummarized_to_keep=2) == 3
+    assert metrics.HISTORY_RETENTION_ROWS_TRIMMED._values[()] == trimmed + 3
+    assert metrics.HISTORY_RETENTION_LAST_DURATION._values[()] >= 0
+    store.close()
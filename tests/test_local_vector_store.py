@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+from src.local_vector_store import LocalVectorStore
+
+@pytest.mark.parametrize('quantization', [None, 'int8'])
+def test_upsert_existing_id_after_reopen(tmp_path, quantization):
+    store = LocalVectorStore(path=str(tmp_path), quantization=quantization)
+    store.upsert(['a', 'b'], [[1.0, 0.0, 0.0], [0.0, 1.0, 0.0]], ['doc a', 'doc b'])
+    store.persist()
+
+    reopened = LocalVectorStore(path=str(tmp_path), quantization=quantization)
+    reopened.upsert(['b', 'c'], [[0.0, 0.0, 1.0], [1.0, 1.0, 0.0]], ['doc b2', 'doc c'])
+
+    assert reopened.count() == 3
+    result = reopened.query([[0.0, 0.0, 1.0]], n_results=1, include=['documents'])
+    assert result['ids'][0] == ['b']
+    assert result['documents'][0] == ['doc b2']
+    reopened.persist()
+    assert LocalVectorStore(path=str(tmp_path)).get(ids=['b'])['documents'] == ['doc b2']
+
+def test_upsert_does_not_mutate_previous_snapshot(tmp_path):
+    store = LocalVectorStore(path=str(tmp_path))
+    store.upsert(['a'], [[1.0, 0.0]], ['doc a'])
+    assert store.count() == 1
+    snapshot = store._snapshot
+    store.upsert(['a'], [[0.0, 1.0]], ['doc a2'])
+    assert store.count() == 1
+    np.testing.assert_allclose(snapshot.vectors(), [[1.0, 0.0]])
+
+def test_batched_upserts_merge_once(tmp_path, monkeypatch):
+    store = LocalVectorStore(path=str(tmp_path))
+    merged = []
+    merge = store._merge_pending
+    monkeypatch.setattr(store, '_merge_pending', lambda: merged.append(len(store._pending)) or merge())
+    for i in range(10):
+        store.upsert([f"id{i}", "id0"], [[float(i), 1.0], [0.0, 1.0]], [f"doc {i}", "doc 0"])
+    store.persist()
+    assert [count for count in merged if count] == [10]
+
+    reopened = LocalVectorStore(path=str(tmp_path))
+    assert reopened.count() == 10
+    np.testing.assert_allclose(reopened.get(ids=['id0'], include=['embeddings'])['embeddings'], [[0.0, 1.0]])
+    assert reopened.query([[1.0, 0.0]], n_results=1)['ids'][0] == ['id9']
+
+def test_failed_load_not_retried_until_current_changes(tmp_path, monkeypatch):
+    store = LocalVectorStore(path=str(tmp_path))
+    store.upsert(['a'], [[1.0, 0.0]], ['doc a'])
+    store.persist()
+    with open(tmp_path / 'current.json', 'w', encoding='utf-8') as f:
+        f.write('{')
+
+    reader = LocalVectorStore(path=str(tmp_path))
+    loads = []
+    load = reader._load
+    monkeypatch.setattr(reader, '_load', lambda: loads.append(1) or load())
+    assert reader.count() == 0 and reader.count() == 0
+    assert loads == []
+
+    store._dirty = True
+    store.persist()
+    assert reader.count() == 1
+    assert loads == [1]
@@ -0,0 +1,50 @@
+from src.streaming import AgentEventTranslator, ThinkFilter
+
+def _feed_all(translator, steps):
+    events = []
+    for responses in steps:
+        events.extend(translator.feed(responses))
+    return events + translator.finish()
+
+def test_think_filter_tag_split_between_chunks():
+    think_filter = ThinkFilter()
+    output = [think_filter.feed(chunk) for chunk in ["<thi", "nk>скрыто</th", "ink> Ответ"]]
+    assert "".join(output) + think_filter.flush() == "Ответ"
+
+def test_text_before_tool_call_is_status():
+    preamble = {'role': 'assistant', 'content': "Поищу в базе знаний."}
+    call = {'role': 'assistant', 'content': '',
+            'function_call': {'name': 'knowledge_base_retriever', 'arguments': '{"query": "льготы"}'}}
+    result = {'role': 'function', 'name': 'knowledge_base_retriever', 'content': '...'}
+    steps = [
+        [{'role': 'assistant', 'content': "Поищу"}],
+        [{'role': 'assistant', 'content': "Поищу в базе знаний.\n<tool_c"}],
+        [preamble],
+        [preamble, call],
+        [preamble, call, result],
+        [preamble, call, result, {'role': 'assistant', 'content': "Льготы"}],
+        [preamble, call, result, {'role': 'assistant', 'content': "Льготы положены."}],
+    ]
+    events = _feed_all(AgentEventTranslator(), steps)
+    assert events == [
+        ('delta', {'content': "Поищу"}),
+        ('delta', {'content': " в базе знаний.\n"}),
+        ('status', {'content': "Поищу в базе знаний."}),
+        ('tool_call', {'name': 'knowledge_base_retriever', 'arguments': '{"query": "льготы"}'}),
+        ('tool_result', {'name': 'knowledge_base_retriever'}),
+        ('delta', {'content': "Льготы"}),
+        ('delta', {'content': " положены."}),
+    ]
+
+def test_one_line_answer_streams_in_several_deltas():
+    steps = [
+        [{'role': 'assistant', 'content': "<think>план</think>Льготы"}],
+        [{'role': 'assistant', 'content': "<think>план</think>Льготы положены <"}],
+        [{'role': 'assistant', 'content': "<think>план</think>Льготы положены <всем>."}],
+    ]
+    events = _feed_all(AgentEventTranslator(), steps)
+    assert events == [
+        ('delta', {'content': "Льготы"}),
+        ('delta', {'content': " положены "}),
+        ('delta', {'content': "<всем>."}),
+    ]